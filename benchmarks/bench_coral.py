@@ -0,0 +1,48 @@
+"""
+Compare the SVD reference CORAL with the batched eigh implementation.
+
+Usage:
+    python -m benchmarks.bench_coral --sizes 512 1024 --batch 4
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import CONTENT_IMAGE, STYLE_IMAGE, measure, read_file
+from model.adain_utils import color_stats, coral, coral_batch, coral_svd
+from utils.image_io import load_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024])
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'variant':>22} {'ms/image':>9} {'max abs diff':>13}")
+    for size in args.sizes:
+        style = load_image(read_file(STYLE_IMAGE), size)
+        content = load_image(read_file(CONTENT_IMAGE), size)
+        expected = coral_svd(style, content)
+        styles = style.unsqueeze(0).expand(args.batch, -1, -1, -1).contiguous()
+        contents = content.unsqueeze(0).expand(args.batch, -1, -1, -1).contiguous()
+        cached = color_stats(styles)
+
+        variants = [
+            ('svd', lambda: coral_svd(style, content), 1),
+            ('eigh', lambda: coral(style, content), 1),
+            (f'eigh batch {args.batch}', lambda: coral_batch(styles, contents), args.batch),
+            (f'eigh batch {args.batch} cached', lambda: coral_batch(styles, contents, source_stats=cached),
+             args.batch),
+        ]
+        for name, fn, images in variants:
+            stats = measure(fn, repeat=args.repeat)
+            output = fn()
+            diff = (output.view(-1, *expected.shape) - expected).abs().max().item()
+            print(f"{size:>6} {name:>22} {stats['mean_ms'] / images:>9.2f} {diff:>13.5f}")
+
+
+if __name__ == '__main__':
+    with torch.no_grad():
+        main()
@@ -0,0 +1,395 @@
+"""
+End-to-end load test: run bot.py against a local stand-in for the Telegram
+Bot API and let simulated users go through every mode concurrently.
+
+Each user sends /start, picks a mode from the keyboard and sends its
+photos; latency is measured from the last photo to the result arriving at
+the fake server, so it covers downloading, queueing, inference, encoding
+and uploading. With a preview_size in the config, the time to the first
+(preview) result is reported as well. The bot runs in a temporary working directory, so user data
+and saved results do not touch the repository.
+
+  standard          Style Transfer with a content and a style photo
+  color_preserving  Color-Preserving with a content and a style photo
+  selected_style    a pre-saved style with one content photo
+  gallery           all pre-saved styles with one content photo
+  alpha_preview     Style Transfer with the alpha preview of four results
+
+Usage:
+    python -m benchmarks.bench_e2e [--random-weights] [--users 2] [--rounds 2] \\
+        [--config bench.json] [--output e2e.json]
+
+`--config` is a JSON file with bot config keys (e.g. inference_workers,
+batch_max_size, output_size) that override the defaults used here.
+"""
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import itertools
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from PIL import Image
+
+from benchmarks.common import CONTENT_IMAGE, STYLE_IMAGE, git_commit, peak_rss_mb, read_file, write_random_weights
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOKEN = "123456:benchmark"
+MODES = ('standard', 'color_preserving', 'selected_style', 'gallery', 'alpha_preview')
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': "Style bot", 'username': "style_bot"}
+
+# Photo sent as a preview next to every full-size photo, like Telegram does
+THUMBNAIL_SIZE = 90
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    Minimal Bot API server: queues updates for getUpdates, serves photos
+    through getFile, and reports every method the bot calls for a chat to
+    `on_event(chat_id, method, params, timestamp)`.
+    """
+    daemon_threads = True
+
+    def __init__(self, on_event, host='127.0.0.1', port=0):
+        super().__init__((host, port), _Handler)
+        self.on_event = on_event
+        self.files = {}
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    def handle_error(self, request, client_address):
+        # The bot drops its pending getUpdates call when it stops
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def add_photo(self, name, data):
+        """Register a photo and return its PhotoSize list (thumbnail and full size)"""
+        image = Image.open(BytesIO(data))
+        thumbnail = image.convert('RGB')
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        buffer = BytesIO()
+        thumbnail.save(buffer, format='JPEG')
+        sizes = []
+        for file_id, file_data, size in ((f'{name}_thumb', buffer.getvalue(), thumbnail.size),
+                                         (name, data, image.size)):
+            self.files[file_id] = file_data
+            sizes.append({'file_id': file_id, 'file_unique_id': file_id, 'width': size[0], 'height': size[1],
+                          'file_size': len(file_data)})
+        return sizes
+
+    def push_message(self, user_id, **fields):
+        """Queue a message from a user for the bot's next getUpdates"""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}", 'language_code': 'en'},
+            **fields
+        }
+        with self._cond:
+            self._updates.append({'update_id': next(self._update_ids), 'message': message})
+            self._cond.notify_all()
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Updates below the offset were confirmed by the bot
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._updates)
+
+    def reply(self, method, params):
+        """Return the result of a Bot API call"""
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.files[file_id]),
+                    'file_path': f'photos/{file_id}.jpg'}
+        if 'chat_id' not in params:
+            return True
+        chat_id = int(params['chat_id'])
+        self.on_event(chat_id, method, params, time.perf_counter())
+        if method == 'sendMediaGroup':
+            return [self._bot_message(chat_id, method) for _ in json.loads(params['media'])]
+        if method.startswith(('send', 'edit')):
+            return self._bot_message(chat_id, method, params.get('text'))
+        return True
+
+    def _bot_message(self, chat_id, method, text=None):
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'from': BOT_USER,
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if text is not None:
+            message['text'] = text
+        if method in ('sendPhoto', 'sendMediaGroup', 'editMessageMedia'):
+            message['photo'] = [{'file_id': 'result', 'file_unique_id': 'result', 'width': 1, 'height': 1}]
+        return message
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _params(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                params[name] = payload if part.get_filename() else payload.decode()
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return dict(parse_qsl(body.decode()))
+
+    def do_POST(self):
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        try:
+            result = self.server.reply(method, self._params())
+            body, status = json.dumps({'ok': True, 'result': result}).encode(), 200
+        except Exception as e:
+            body, status = json.dumps({'ok': False, 'error_code': 400, 'description': repr(e)}).encode(), 400
+        self._send(status, body, 'application/json')
+
+    def do_GET(self):
+        file_id = os.path.splitext(os.path.basename(self.path))[0]
+        if file_id not in self.server.files:
+            self._send(404, b'', 'text/plain')
+            return
+        self._send(200, self.server.files[file_id], 'image/jpeg')
+
+
+def mode_steps(bot):
+    """(keyboard texts, photos) a user sends per round, by mode"""
+    options = bot.KEYBOARD_OPTIONS['en']
+    return {
+        'standard': ([options[0][0]], ['content', 'style']),
+        'color_preserving': ([options[0][1]], ['content', 'style']),
+        'selected_style': ([next(iter(bot.PRE_SAVED_STYLES))], ['content']),
+        'gallery': ([bot.GALLERY_OPTION['en']], ['content']),
+        'alpha_preview': ([options[0][0], options[2][1]], ['content', 'style'])
+    }
+
+
+class SimulatedUser:
+    """A chat that goes through one mode and waits for the bot's replies"""
+
+    def __init__(self, user_id, mode, steps, server, photos, failure_texts):
+        self.user_id = user_id
+        self.mode = mode
+        self.steps = steps
+        self.server = server
+        self.photos = photos
+        self.failure_texts = failure_texts
+        self.events = asyncio.Queue()
+        self.latencies = []
+        self.first_latencies = []
+        self.failures = []
+
+    async def expect_reply(self):
+        return await self.events.get()
+
+    async def send_text(self, text):
+        fields = {'text': text}
+        if text.startswith('/'):
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        self.server.push_message(self.user_id, **fields)
+        await self.expect_reply()
+
+    async def run_round(self):
+        texts, photos = self.steps
+        for text in texts:
+            await self.send_text(text)
+        for photo in photos[:-1]:
+            self.server.push_message(self.user_id, photo=self.photos[photo])
+            await self.expect_reply()
+
+        started = time.perf_counter()
+        self.server.push_message(self.user_id, photo=self.photos[photos[-1]])
+        first = finished = failure = None
+        # The job is over once the bot shows the keyboard again
+        while True:
+            method, params, timestamp = await self.expect_reply()
+            if method in ('sendPhoto', 'sendMediaGroup', 'editMessageMedia'):
+                first = first or timestamp
+                finished = timestamp
+            elif method == 'sendMessage' and 'keyboard' in params.get('reply_markup', ''):
+                break
+            elif method == 'sendMessage' and params.get('text') in self.failure_texts:
+                failure = params['text']
+        if failure is not None or finished is None:
+            self.failures.append(failure)
+        else:
+            self.latencies.append(finished - started)
+            self.first_latencies.append(first - started)
+
+    async def run(self, rounds):
+        await self.send_text('/start')
+        for _ in range(rounds):
+            await self.run_round()
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list"""
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(q / 100 * len(values) + 0.5) - 1))]
+
+
+def summarize(users, elapsed):
+    latencies = [latency for user in users for latency in user.latencies]
+    summary = {'jobs': len(latencies), 'failures': sum(len(user.failures) for user in users),
+               'throughput_per_s': len(latencies) / elapsed if elapsed else 0.0}
+    if latencies:
+        latencies_ms = [latency * 1000 for latency in latencies]
+        first_ms = [latency * 1000 for user in users for latency in user.first_latencies]
+        summary.update({
+            'mean_ms': statistics.mean(latencies_ms),
+            'p50_ms': percentile(latencies_ms, 50),
+            'p95_ms': percentile(latencies_ms, 95),
+            'p99_ms': percentile(latencies_ms, 99),
+            'max_ms': max(latencies_ms),
+            'first_result_p50_ms': percentile(first_ms, 50),
+            'first_result_p95_ms': percentile(first_ms, 95)
+        })
+    return summary
+
+
+async def run_load(app, server, users, rounds):
+    loop = asyncio.get_running_loop()
+    by_chat = {user.user_id: user for user in users}
+    server.on_event = lambda chat_id, method, params, timestamp: loop.call_soon_threadsafe(
+        by_chat[chat_id].events.put_nowait, (method, params, timestamp))
+
+    async with app:
+        await app.start()
+        await app.updater.start_polling(poll_interval=0, timeout=5)
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(user.run(rounds) for user in users))
+        finally:
+            elapsed = time.perf_counter() - started
+            await app.updater.stop()
+            await app.stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2, help="concurrent users per mode")
+    parser.add_argument('--rounds', type=int, default=2, help="style transfers per user")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--config', help="JSON file with bot config keys to override")
+    parser.add_argument('--content', default=CONTENT_IMAGE)
+    parser.add_argument('--style', default=STYLE_IMAGE)
+    parser.add_argument('--random-weights', action='store_true', help="use random weights instead of model_weights/")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    content = read_file(os.path.join(REPO_ROOT, args.content))
+    style = read_file(os.path.join(REPO_ROOT, args.style))
+    overrides = {}
+    if args.config:
+        with open(args.config) as f:
+            overrides = json.load(f)
+
+    workspace = tempfile.TemporaryDirectory(prefix='bench_e2e_')
+    os.chdir(workspace.name)
+    os.symlink(os.path.join(REPO_ROOT, 'test_images'), 'test_images')
+    if args.random_weights:
+        weights_dir = os.path.join(workspace.name, 'model_weights')
+        write_random_weights(weights_dir)
+    else:
+        weights_dir = os.path.join(REPO_ROOT, 'model_weights')
+
+    # Imported here, so that the bot's relative paths resolve in the workspace
+    sys.path.insert(0, REPO_ROOT)
+    import bot
+
+    server = FakeTelegramServer(on_event=None)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    photos = {'content': server.add_photo('content', content), 'style': server.add_photo('style', style)}
+
+    config = {
+        'telegram_token': TOKEN,
+        'telegram_base_url': f"{server.url}/bot",
+        'telegram_base_file_url': f"{server.url}/file/bot",
+        'weights_dir': weights_dir,
+        **overrides
+    }
+    app = bot.build_application(config)
+    user_ids = itertools.count(1000)
+    steps = mode_steps(bot)
+    failure_texts = {bot.get_message(key, 'en') for key in ('busy', 'error', 'image_too_large')}
+    users = [SimulatedUser(next(user_ids), mode, steps[mode], server, photos, failure_texts)
+             for mode in args.modes for _ in range(args.users)]
+
+    try:
+        elapsed = asyncio.run(run_load(app, server, users, args.rounds))
+    finally:
+        bot.shutdown_application(app)
+        server.shutdown()
+        os.chdir(REPO_ROOT)
+        workspace.cleanup()
+
+    modes = {mode: summarize([user for user in users if user.mode == mode], elapsed) for mode in args.modes}
+    overall = summarize(users, elapsed)
+    print(f"{'mode':>17} {'jobs':>5} {'fail':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'first p50':>10}")
+    for mode, summary in list(modes.items()) + [('all', overall)]:
+        print(f"{mode:>17} {summary['jobs']:>5} {summary['failures']:>5} {summary.get('p50_ms', 0):>9.0f} "
+              f"{summary.get('p95_ms', 0):>9.0f} {summary.get('p99_ms', 0):>9.0f} "
+              f"{summary.get('first_result_p50_ms', 0):>10.0f}")
+    # Forked helpers inherit the parent's peak, so only worker processes are worth reporting
+    children_rss = None
+    if config.get('inference_processes'):
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"Throughput: {overall['throughput_per_s']:.2f} jobs/s, peak RSS: {peak_rss_mb():.0f} MB"
+          + (f" (worker processes {children_rss:.0f} MB)" if children_rss else ""))
+
+    if output:
+        report = {
+            'benchmark': 'e2e', 'commit': git_commit(), 'users_per_mode': args.users, 'rounds': args.rounds,
+            'random_weights': args.random_weights,
+            'config': {key: value for key, value in config.items() if not key.startswith('telegram_')},
+            'elapsed_s': elapsed, 'peak_rss_mb': peak_rss_mb(), 'peak_worker_rss_mb': children_rss,
+            'overall': overall, 'modes': modes
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
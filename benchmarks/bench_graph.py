@@ -0,0 +1,37 @@
+"""
+Compare the latency of the training Net modules with the lean inference graph.
+
+Usage:
+    python -m benchmarks.bench_graph --size 512 [--random-weights]
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import load_nets, measure
+from utils.functional import build_inference_net
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--random-weights', action='store_true', help="run without model_weights/")
+    args = parser.parse_args()
+
+    net = load_nets(args.random_weights)[0]
+    lean = build_inference_net(net)
+    device = next(net.parameters()).device
+    image = torch.rand(1, 3, args.size, args.size, device=device)
+
+    print(f"{'graph':>8} {'encoder ms':>11} {'decoder ms':>11}")
+    with torch.no_grad():
+        feat = net.encode(image)
+        for name, model in (('net', net), ('lean', lean)):
+            encode = measure(lambda: model.encode(image), repeat=args.repeat)
+            decode = measure(lambda: model.decoder(feat), repeat=args.repeat)
+            print(f"{name:>8} {encode['mean_ms']:>11.1f} {decode['mean_ms']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
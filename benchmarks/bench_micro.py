@@ -0,0 +1,75 @@
+"""
+Time the stages of a style transfer on their own: image decoding, CORAL,
+AdaIN, the encoder, every decoder and JPEG encoding.
+
+Usage:
+    python -m benchmarks.bench_micro [--random-weights] [--sizes 512 1024] [--output micro.json]
+"""
+import argparse
+import json
+
+import torch
+from torchvision.transforms.functional import to_pil_image
+
+from benchmarks.common import (CONTENT_IMAGE, STYLE_IMAGE, git_commit, load_nets, measure, peak_rss_mb,
+                               read_file)
+from model.adain_utils import adaptive_instance_normalization, coral
+from utils.functional import NET_NAMES
+from utils.image_io import load_image
+from utils.jobs import encode_jpeg
+
+
+def benchmarks(nets, content_bytes, style_bytes, size):
+    """Return (name, fn) pairs for one input size"""
+    net = nets[0]
+    content = load_image(content_bytes, size)
+    style = load_image(style_bytes, size)
+    with torch.no_grad():
+        content_feat = net.encode(content.unsqueeze(0))
+        style_feat = net.encode(style.unsqueeze(0))
+        output = net.decoder(content_feat).squeeze(0).clamp(0, 1)
+    image = to_pil_image(output)
+
+    cases = [
+        ('load_image', lambda: load_image(content_bytes, size)),
+        ('coral', lambda: coral(style, content)),
+        ('adain', lambda: adaptive_instance_normalization(content_feat, style_feat)),
+        ('encoder', lambda: net.encode(content.unsqueeze(0))),
+    ]
+    for name, decoder_net in zip(NET_NAMES, nets):
+        cases.append((f'decoder_{name}', lambda decoder=decoder_net.decoder: decoder(content_feat)))
+    cases.append(('encode_jpeg', lambda: encode_jpeg(image)))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--random-weights', action='store_true', help="use random weights instead of model_weights/")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    nets = load_nets(args.random_weights)
+    content_bytes = read_file(CONTENT_IMAGE)
+    style_bytes = read_file(STYLE_IMAGE)
+
+    results = []
+    print(f"{'size':>6} {'stage':>20} {'mean ms':>9} {'min ms':>9} {'max ms':>9}")
+    for size in args.sizes:
+        for name, fn in benchmarks(nets, content_bytes, style_bytes, size):
+            with torch.no_grad():
+                stats = measure(fn, repeat=args.repeat)
+            results.append({'size': size, 'stage': name, **stats})
+            print(f"{size:>6} {name:>20} {stats['mean_ms']:>9.2f} {stats['min_ms']:>9.2f} {stats['max_ms']:>9.2f}")
+    print(f"Peak RSS: {peak_rss_mb():.0f} MB")
+
+    if args.output:
+        report = {'benchmark': 'micro', 'commit': git_commit(), 'threads': torch.get_num_threads(),
+                  'random_weights': args.random_weights, 'peak_rss_mb': peak_rss_mb(), 'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
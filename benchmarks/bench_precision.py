@@ -0,0 +1,77 @@
+"""
+Quality and throughput of the precision modes against fp32.
+
+Every mode is applied to the encoder and the decoder of the base network.
+Quality is PSNR/SSIM of the stylized test images against the fp32 result.
+
+Usage:
+    python -m benchmarks.bench_precision --size 512 [--random-weights]
+"""
+import argparse
+import glob
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks.common import load_nets, measure, read_file
+from model.adain_utils import prepare_inputs, stylize_features
+from utils.functional import build_inference_net
+from utils.precision import PRECISION_MODES, apply_precision
+from torchvision.transforms.functional import to_tensor
+
+
+def psnr(a, b):
+    mse = F.mse_loss(a, b).item()
+    return float('inf') if mse == 0 else 10 * torch.log10(torch.tensor(1 / mse)).item()
+
+
+def ssim(a, b, window_size=11, sigma=1.5):
+    """Mean SSIM of two (3, H, W) images in [0, 1] with a Gaussian window"""
+    coords = torch.arange(window_size, dtype=torch.float32) - window_size // 2
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    window = (g[:, None] * g[None, :]).expand(3, 1, window_size, window_size)
+
+    def filt(x):
+        return F.conv2d(x.unsqueeze(0), window, groups=3)
+
+    mu_a, mu_b = filt(a), filt(b)
+    var_a = filt(a * a) - mu_a ** 2
+    var_b = filt(b * b) - mu_b ** 2
+    cov = filt(a * b) - mu_a * mu_b
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    score = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return score.mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--random-weights', action='store_true', help="run without model_weights/")
+    args = parser.parse_args()
+
+    net = build_inference_net(load_nets(args.random_weights)[0])
+    contents = [read_file(path) for path in sorted(glob.glob("test_images/content/*.jpg"))]
+    styles = [read_file(path) for path in sorted(glob.glob("test_images/style/*.jpg"))]
+    jobs = [prepare_inputs(net, content, style, image_size=args.size) for content in contents for style in styles]
+
+    def run(model):
+        return [to_tensor(stylize_features(model, model.encode(content.unsqueeze(0)), stats, 1.0))
+                for content, stats in jobs]
+
+    with torch.no_grad():
+        reference = run(net)
+        print(f"{'mode':>6} {'PSNR dB':>8} {'SSIM':>6} {'images/s':>9}")
+        for mode in PRECISION_MODES:
+            model = apply_precision({'net': net}, {'encoder': mode, 'net': mode})['net']
+            outputs = run(model)
+            quality_psnr = sum(psnr(o, r) for o, r in zip(outputs, reference)) / len(outputs)
+            quality_ssim = sum(ssim(o, r) for o, r in zip(outputs, reference)) / len(outputs)
+            latency = measure(lambda: run(model), repeat=args.repeat)
+            throughput = len(jobs) / (latency['mean_ms'] / 1000)
+            print(f"{mode:>6} {quality_psnr:>8.2f} {quality_ssim:>6.3f} {throughput:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
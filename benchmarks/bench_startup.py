@@ -0,0 +1,111 @@
+"""
+Compare model startup time and memory of the loading strategies.
+
+  pickle       the previous init_model(): every checkpoint read and copied
+  mmap         init_model() with memory-mapped checkpoints
+  safetensors  init_model() with converted .safetensors checkpoints
+  lazy         ModelRegistry with only the general decoder loaded
+
+Every variant runs in a fresh process, so memory is measured per variant.
+Private memory is what each bot process pays for on its own; mapped
+checkpoint pages live in the page cache and are shared between processes.
+
+Usage:
+    python -m benchmarks.bench_startup [--random-weights]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import peak_rss_mb, run_isolated, write_random_weights
+from model.adain_net import Decoder, VGG, Net
+from utils.functional import DECODER_WEIGHTS, ENCODER_WEIGHTS, NET_NAMES, WEIGHTS_DIR, init_model
+from utils.model_registry import ModelRegistry
+from utils.weights import convert_to_safetensors
+
+VARIANTS = ('pickle', 'mmap', 'safetensors', 'lazy')
+
+
+def pickle_init_model(weights_dir):
+    """init_model() as it was before memory-mapped loading"""
+    vgg = VGG()
+    vgg.model.load_state_dict(torch.load(os.path.join(weights_dir, ENCODER_WEIGHTS), map_location='cpu'))
+    vgg = nn.Sequential(*list(vgg.model.children())[:31])
+    nets = []
+    for name in NET_NAMES:
+        decoder = Decoder()
+        state_dict = torch.load(os.path.join(weights_dir, DECODER_WEIGHTS[name]), map_location='cpu')
+        if name == 'net':
+            decoder.model.load_state_dict(state_dict)
+        else:
+            decoder.load_state_dict(state_dict)
+        nets.append(Net(vgg, decoder).eval())
+    return nets
+
+
+def current_rss_mb():
+    """Resident set size of this process, split into (anonymous, file-backed) MB"""
+    with open('/proc/self/status') as f:
+        fields = dict(line.split(':', 1) for line in f)
+    return tuple(int(fields[key].split()[0]) / 1024 for key in ('RssAnon', 'RssFile'))
+
+
+def run_variant(variant, weights_dir):
+    anon_before, file_before = current_rss_mb()
+    start = time.perf_counter()
+    if variant == 'pickle':
+        pickle_init_model(weights_dir)
+    elif variant == 'lazy':
+        ModelRegistry(optimize=True, pinned=('net',), weights_dir=weights_dir)
+    else:
+        init_model(optimize=True, weights_dir=weights_dir)
+    elapsed = time.perf_counter() - start
+    anon, file = current_rss_mb()
+    return {'variant': variant, 'startup_s': elapsed, 'anon_mb': anon - anon_before, 'file_mb': file - file_before,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def prepare_weights_dir(source, variant, root):
+    """Copy of the checkpoints with .safetensors files only for the safetensors variant"""
+    target = os.path.join(root, variant)
+    os.makedirs(target)
+    for path in [ENCODER_WEIGHTS] + list(DECODER_WEIGHTS.values()):
+        shutil.copy(os.path.join(source, path), target)
+        if variant == 'safetensors':
+            convert_to_safetensors(os.path.join(target, path))
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--random-weights', action='store_true', help="run without model_weights/")
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--weights-dir', default=WEIGHTS_DIR, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(run_variant(args.variant, args.weights_dir)))
+        return
+
+    with tempfile.TemporaryDirectory() as root:
+        source = args.weights_dir
+        if args.random_weights:
+            source = os.path.join(root, 'random')
+            write_random_weights(source)
+
+        print(f"{'variant':>12} {'startup s':>10} {'private MB':>11} {'mapped MB':>10} {'peak RSS MB':>12}")
+        for variant in VARIANTS:
+            weights_dir = prepare_weights_dir(source, variant, root)
+            result = run_isolated('benchmarks.bench_startup', ['--variant', variant, '--weights-dir', weights_dir])
+            print(f"{variant:>12} {result['startup_s']:>10.2f} {result['anon_mb']:>11.0f} {result['file_mb']:>10.0f} "
+                  f"{result['peak_rss_mb']:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Compare latency and peak RSS of tiled and untiled inference.
+
+Usage:
+    python -m benchmarks.bench_tiling --sizes 512 1080 --tile-size 512 [--random-weights]
+"""
+import argparse
+import json
+
+import torch
+
+from benchmarks.common import (CONTENT_IMAGE, STYLE_IMAGE, load_nets, measure, peak_rss_mb,
+                               read_file, run_isolated)
+from model.adain_utils import process_images
+
+
+def run_variant(args):
+    torch.set_num_threads(args.threads)
+    net = load_nets(args.random_weights)[0]
+    content_bytes = read_file(CONTENT_IMAGE)
+    style_bytes = read_file(STYLE_IMAGE)
+    tile_size = args.tile_size if args.variant == 'tiled' else None
+
+    stats = measure(lambda: process_images(net, content_bytes, style_bytes, image_size=args.size,
+                                           tile_size=tile_size, tile_overlap=args.overlap),
+                    repeat=args.repeat)
+    stats.update(variant=args.variant, size=args.size, peak_rss_mb=peak_rss_mb())
+    print(json.dumps(stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1080])
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--overlap', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--random-weights', action='store_true', help="run without model_weights/")
+    parser.add_argument('--variant', choices=['untiled', 'tiled'], help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args)
+        return
+
+    common = ['--tile-size', str(args.tile_size), '--overlap', str(args.overlap),
+              '--repeat', str(args.repeat), '--threads', str(args.threads)]
+    if args.random_weights:
+        common.append('--random-weights')
+    print(f"{'size':>6} {'variant':>8} {'mean ms':>10} {'peak RSS MB':>12}")
+    for size in args.sizes:
+        for variant in ('untiled', 'tiled'):
+            result = run_isolated('benchmarks.bench_tiling', common + ['--variant', variant, '--size', str(size)])
+            print(f"{size:>6} {variant:>8} {result['mean_ms']:>10.1f} {result['peak_rss_mb']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
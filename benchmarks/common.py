@@ -0,0 +1,89 @@
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+from model.adain_net import Decoder, VGG, Net
+from utils.functional import DECODER_WEIGHTS, ENCODER_WEIGHTS, NET_NAMES, init_model
+
+CONTENT_IMAGE = "test_images/content/dancing.jpg"
+STYLE_IMAGE = "test_images/style/van_gogh.jpg"
+
+
+def random_nets():
+    """Randomly initialized networks with the layout of init_model(), for runs without weights"""
+    torch.manual_seed(0)
+    vgg = nn.Sequential(*list(VGG().model.children())[:31]).eval()
+    decoders = [Decoder() for _ in range(4)]
+    # Variance-preserving init so that outputs are not all clamped to black
+    for module in list(vgg.modules()) + [m for decoder in decoders for m in decoder.modules()]:
+        if isinstance(module, nn.Conv2d):
+            nn.init.kaiming_normal_(module.weight, nonlinearity='relu')
+            nn.init.zeros_(module.bias)
+    for decoder in decoders:
+        decoder.model[-1].weight.data.mul_(0.1)
+        nn.init.constant_(decoder.model[-1].bias, 0.5)
+    return tuple(Net(vgg, decoder).eval() for decoder in decoders)
+
+
+def write_random_weights(weights_dir):
+    """Save random_nets() in the layout of model_weights/, for loading benchmarks without weights"""
+    os.makedirs(weights_dir, exist_ok=True)
+    nets = random_nets()
+    vgg = VGG()
+    # The checkpoint holds the full VGG, of which only the layers up to relu4_1 are used
+    net = nets[0]
+    encoder = nn.Sequential(*net.enc_1, *net.enc_2, *net.enc_3, *net.enc_4)
+    vgg.model[:31].load_state_dict(encoder.state_dict())
+    torch.save(vgg.model.state_dict(), os.path.join(weights_dir, ENCODER_WEIGHTS))
+    for name, net in zip(NET_NAMES, nets):
+        state_dict = net.decoder.model.state_dict() if name == 'net' else net.decoder.state_dict()
+        torch.save(state_dict, os.path.join(weights_dir, DECODER_WEIGHTS[name]))
+
+
+def load_nets(random_weights=False):
+    """Return (net, net_picasso, net_van_gogh, net_monet)"""
+    return random_nets() if random_weights else init_model()
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def measure(fn, repeat=5, warmup=1):
+    """Run fn repeatedly and return latency statistics in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': statistics.mean(times), 'min_ms': min(times), 'max_ms': max(times)}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (Linux reports kilobytes)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_isolated(module, args):
+    """
+    Run `python -m module args` and parse the JSON it prints last, so that
+    peak memory is measured per variant rather than for the whole benchmark.
+    """
+    result = subprocess.run([sys.executable, '-m', module] + args, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    """Commit of the working tree, recorded in JSON reports so runs can be compared"""
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True)
+    return result.stdout.strip() or None
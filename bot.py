@@ -1,29 +1,51 @@
-from io import BytesIO
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Update, ReplyKeyboardMarkup, InputMediaPhoto
+from telegram.error import TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
+import asyncio
+import functools
 import json
+import os
+import time
+from io import BytesIO
 
 from utils.messages import get_message
-from model.adain_utils import process_images
-from utils.functional import init_model
-from utils.user_storage import (load_user_data, update_user_settings,
-                                get_user_settings, save_user_images)
-
-# Preload user data and models
-user_data_store = load_user_data()
+from model.adain_utils import prepare_inputs
+from model.style_bank import StyleBank
+from utils.functional import NET_NAMES, WEIGHTS_DIR
+from utils.model_registry import ModelRegistry
+from utils.image_io import IMAGE_SIZE, ImageTooLargeError, select_photo_size
+from utils.inference import InferenceExecutor, QueueFullError
+from utils.jobs import run_gallery, run_preview, run_style_transfer, run_style_transfer_batch
+from utils.process_pool import ProcessInferenceExecutor
+from utils.batching import MicroBatcher
+from utils.metrics import JobTrace, Metrics, collect_stages, start_metrics_server
+from utils.profiling import Profiler, profile_job
+from utils.qos import ResolutionPolicy
+from utils.feature_cache import StyleFeatureCache, SessionFeatureStore
+from utils.result_cache import ResultCache
+from utils.retention import RetentionManager
+from utils.updates import PerUserUpdateProcessor
+from utils.user_storage import (ArtifactWriter, load_user_data, update_user_settings,
+                                get_user_settings)
+
+# User settings store, opened in main()
+user_data_store = None
 
 # Constants
 KEYBOARD_OPTIONS = {
     'en': [["Style Transfer", "Color-Preserving", "Select a Style"],
-           ["Set alpha", "Language"]],
+           ["Set alpha", "Language"],
+           ["Re-style last photo", "Alpha preview"]],
     'ru': [["Перенос стиля", "Сохранение цветов", "Выбрать готовый стиль"],
-           ["Установить alpha", "Язык"]]
+           ["Установить alpha", "Язык"],
+           ["Повторить с последним фото", "Сравнить alpha"]]
 }
 
 PRE_SAVED_STYLES = {
@@ -32,6 +54,25 @@ PRE_SAVED_STYLES = {
     "Picasso": "test_images/style/picasso.jpg"
 }
 
+# Fine-tuned model used for each pre-saved style
+PRE_SAVED_STYLE_NETS = {
+    "Van Gogh": "net_van_gogh",
+    "Monet": "net_monet",
+    "Picasso": "net_picasso"
+}
+
+# Preset style statistics, kept next to the weights they were computed with
+STYLE_STATS_CACHE = "style_stats.pt"
+
+# Alpha values rendered in the alpha preview mode
+ALPHA_PREVIEW_VALUES = (0.25, 0.5, 0.75, 1.0)
+
+# Styles keyboard option that applies every pre-saved style at once
+GALLERY_OPTION = {
+    'en': "All presets",
+    'ru': "Все стили"
+}
+
 
 # --- Keyboard Helpers ---
 
@@ -41,7 +82,7 @@ def get_language_keyboard():
 
 
 def get_styles_keyboard(lang='en'):
-    styles = list(PRE_SAVED_STYLES.keys())
+    styles = list(PRE_SAVED_STYLES.keys()) + [GALLERY_OPTION.get(lang, GALLERY_OPTION['en'])]
     keyboard = [styles[i:i+2] for i in range(0, len(styles), 2)]
     return ReplyKeyboardMarkup(keyboard, one_time_keyboard=True,
                                resize_keyboard=True)
@@ -78,6 +119,44 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+def profiled(handler):
+    """Run a handler under the Python sampling profiler for the configured share of updates"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        profiler = context.bot_data['profiler']
+        if not profiler.sample_python():
+            return await handler(update, context)
+        # All threads are sampled, so concurrent updates show up in the trace as well
+        with profiler.python_trace(handler.__name__):
+            return await handler(update, context)
+    return wrapper
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles /profile [torch|python <rate> | off], which changes the profiling sample rates (admins only)"""
+    if update.effective_user.id not in context.bot_data['admin_ids']:
+        return
+    profiler = context.bot_data['profiler']
+    args = context.args
+    try:
+        if args == ['off']:
+            profiler.torch_sample_rate = profiler.python_sample_rate = 0.0
+        elif len(args) == 2 and args[0] in ('torch', 'python'):
+            rate = float(args[1])
+            if not (0 <= rate <= 1):
+                raise ValueError
+            setattr(profiler, f'{args[0]}_sample_rate', rate)
+        elif args:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [torch <rate> | python <rate> | off], rates from 0 to 1")
+        return
+    await update.message.reply_text(
+        f"Profiled share of inference jobs: {profiler.torch_sample_rate}, of updates: {profiler.python_sample_rate}\n"
+        f"{len(profiler.traces())} traces in {os.path.abspath(profiler.trace_dir)}"
+    )
+
+
 # --- Message Handlers ---
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -131,15 +210,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(get_message("choose_style_prompt", lang),
                                         reply_markup=get_styles_keyboard(lang))
     elif text in PRE_SAVED_STYLES:  # Pre-saved style selected
-        user_data['selected_style_path'] = PRE_SAVED_STYLES[text]
+        user_data['selected_style'] = text
         user_data['mode'] = 'selected_style'
         await update.message.reply_text(get_message("style_selected", lang).format(style=text), parse_mode="Markdown")
+    elif text in GALLERY_OPTION.values():  # All pre-saved styles
+        user_data['mode'] = 'gallery'
+        await update.message.reply_text(get_message("gallery_selected", lang))
     elif text == keyboard[1][0]:  # Set alpha
         user_data["awaiting_alpha"] = True
         await update.message.reply_text(get_message("alpha_prompt", lang))
     elif text == keyboard[1][1]:  # Change language
         user_data["awaiting_language"] = True
         await update.message.reply_text(get_message("language_prompt", lang), reply_markup=get_language_keyboard())
+    elif text == keyboard[2][0]:  # Re-style last photo
+        await restyle_last_photo(update, context)
+    elif text == keyboard[2][1]:  # Alpha preview for the next transfer
+        user_data['alpha_preview'] = True
+        await update.message.reply_text(get_message("alpha_preview_on", lang))
     else:
         await update.message.reply_text(get_message("invalid_option", lang))
 
@@ -155,111 +242,561 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(get_message("mode_not_selected", lang))
         return
 
-    photo = await update.message.photo[-1].get_file()
-    byte_img = await photo.download_as_bytearray()
+    # Timing starts with the photo that completes a job
+    trace = JobTrace(context.bot_data['metrics'], user_id)
+
+    # Download the smallest version that covers the resolution it is used at:
+    # the content at the output size, the style at the network input size
+    target_size = context.bot_data['image_size'] if 'content_image' not in user_data else IMAGE_SIZE
+    with trace.stage('download'):
+        photo = await select_photo_size(update.message.photo, target_size).get_file()
+        byte_img = bytes(await photo.download_as_bytearray())
+    context.bot_data['metrics'].observe('photo_download_seconds', trace.stages['download'],
+                                        help="Time to download one photo from Telegram")
 
     if 'content_image' not in user_data:
         user_data['content_image'] = byte_img
         user_data['media_group_id'] = update.message.media_group_id
 
-        if user_data.get('mode') == 'selected_style':
-            try:
-                with open(user_data['selected_style_path'], 'rb') as f:
-                    user_data['style_image'] = f.read()
-                await update.message.reply_text(get_message("processing", lang))
-                await perform_style_transfer(update, context)
-                await update.message.reply_text(get_message("choose_option", lang), reply_markup=get_keyboard(lang))
-            except Exception as e:
-                print(f"Error reading style file: {e}")
+        if user_data.get('mode') in ('selected_style', 'gallery'):
+            style_bank = context.bot_data['style_bank']
+            if user_data['mode'] == 'selected_style' and user_data.get('selected_style') not in style_bank:
+                user_data.pop('content_image', None)
                 await update.message.reply_text(get_message("style_not_selected", lang))
+                return
+            await update.message.reply_text(get_message("processing", lang))
+            await perform_style_transfer(update, context, trace)
+            await update.message.reply_text(get_message("choose_option", lang), reply_markup=get_keyboard(lang))
         elif not update.message.media_group_id:
             await update.message.reply_text(get_message("content_received", lang))
     else:
         user_data['style_image'] = byte_img
         await update.message.reply_text(get_message("processing", lang))
-        await perform_style_transfer(update, context)
+        await perform_style_transfer(update, context, trace)
         await update.message.reply_text(get_message("choose_option", lang), reply_markup=get_keyboard(lang))
 
 
+async def restyle_last_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Re-runs style transfer on the user's last photo with the current mode and alpha"""
+    user_data = context.user_data
+    user_id = str(update.effective_user.id)
+    lang = user_data['lang']
+
+    session = context.bot_data['sessions'].get(user_id)
+    if session is None:
+        await update.message.reply_text(get_message("no_last_photo", lang))
+        return
+    if 'mode' not in user_data:
+        await update.message.reply_text(get_message("mode_not_selected", lang))
+        return
+    if user_data['mode'] == 'selected_style' and user_data.get('selected_style') not in context.bot_data['style_bank']:
+        await update.message.reply_text(get_message("style_not_selected", lang))
+        return
+
+    user_data['content_image'] = session['content_bytes']
+    if user_data['mode'] not in ('selected_style', 'gallery'):
+        if session['style_bytes'] is None:
+            # Last photo was styled with a preset, so wait for a style image
+            await update.message.reply_text(get_message("content_received", lang))
+            return
+        user_data['style_image'] = session['style_bytes']
+
+    await update.message.reply_text(get_message("processing", lang))
+    await perform_style_transfer(update, context)
+    await update.message.reply_text(get_message("choose_option", lang), reply_markup=get_keyboard(lang))
+
+
 # --- Style Transfer Core ---
 
-async def perform_style_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def load_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reads the user's settings into memory on a thread before the other handlers use them"""
+    if update.effective_user is not None:
+        await asyncio.to_thread(get_user_settings, user_data_store, update.effective_user.id)
+
+
+async def get_net(context, name, trace):
+    """Return a style transfer network, loading a cold one on the worker pool"""
+    models = context.bot_data['models']
+    if models.is_loaded(name):
+        return models.get(name)
+    with trace.stage('load_model'):
+        return await context.bot_data['executor'].run(models.get, name)
+
+
+async def replace_photo(message, photo, caption):
+    """Replace the photo of a sent message; returns False if Telegram refused the edit"""
+    try:
+        await message.edit_media(InputMediaPhoto(photo, caption=caption))
+        return True
+    except TelegramError as e:
+        print(f"Could not replace photo message: {e}")
+        photo.seek(0)
+        return False
+
+
+async def send_preview(message, photo, caption, trace):
+    """Reply with a preview photo; returns the sent message or None if Telegram refused it"""
+    try:
+        with trace.stage('preview_upload'):
+            preview = await message.reply_photo(photo=photo, caption=caption)
+    except TelegramError as e:
+        print(f"Could not send preview: {e}")
+        return None
+    trace.result_sent()
+    return preview
+
+
+async def perform_style_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE, trace=None):
     """Executes style transfer using the selected mode"""
     user_data = context.user_data
     user_id = str(update.effective_user.id)
     lang = user_data.get('lang') or get_user_settings(user_data_store, user_id).get('lang', 'en')
     user_data['lang'] = lang
+    trace = trace or JobTrace(context.bot_data['metrics'], user_id)
+    status = 'ok'
+    preview_upload = None
+    result_cache = context.bot_data.get('result_cache')
+    claimed_key = None
 
     try:
-        preserve_colors = (user_data.get('mode') == 'color_preserving')
+        mode = user_data.get('mode')
+        trace.mode = mode
+        preserve_colors = (mode == 'color_preserving')
         alpha = get_user_settings(user_data_store, user_id).get("alpha", 1.0)
-
-        # Default to general style net
-        style_net = context.bot_data['net']
-
-        # If user selected a predefined style, use the corresponding model
-        if user_data.get('mode') == 'selected_style':
-            selected_path = user_data.get('selected_style_path', '').lower()
-            if 'picasso' in selected_path:
-                style_net = context.bot_data.get('net_picasso', style_net)
-            elif 'van_gogh' in selected_path:
-                style_net = context.bot_data.get('net_van_gogh', style_net)
-            elif 'monet' in selected_path:
-                style_net = context.bot_data.get('net_monet', style_net)
-
-        result_image = process_images(
-            net=style_net,
-            content_bytes=user_data['content_image'],
-            style_bytes=user_data['style_image'],
-            preserve_colors=preserve_colors,
-            alpha=alpha
-        )
-
-        img_bytes = BytesIO()
-        result_image.save(img_bytes, format='JPEG')
-        img_bytes.seek(0)
-        # Save user images
-        save_user_images(
+        style_bank = context.bot_data['style_bank']
+        executor = context.bot_data['executor']
+        image_size = context.bot_data['image_size']
+        tiling = context.bot_data.get('tiling')
+
+        # Under load, trade resolution for latency
+        policy = context.bot_data.get('resolution_policy')
+        if policy is not None:
+            image_size = policy.choose(executor.pending)
+            print(f"Style transfer for user {user_id} runs at {image_size}px")
+
+        if result_cache is not None:
+            # Render the quantized alpha, so a cached result is exactly what was asked for
+            alpha = result_cache.quantize(alpha)
+        # The alpha preview applies to this job only; the gallery ignores it
+        alphas = (alpha,)
+        if user_data.pop('alpha_preview', False) and mode != 'gallery':
+            alphas = ALPHA_PREVIEW_VALUES
+
+        # The decoder and the style that determine the result: the general style net by
+        # default, the fine-tuned model of a predefined style if the user selected one
+        if mode == 'gallery':
+            net_key, style_id = 'presets', None
+        elif mode == 'selected_style':
+            style_id = user_data['selected_style']
+            net_key = PRE_SAVED_STYLE_NETS[style_id]
+            user_data['style_image'] = style_bank.image(style_id)
+        else:
+            net_key, style_id = 'net', user_data['style_image']
+        trace.decoder = net_key
+
+        # Identical inputs are served from the cache, or from a running identical job
+        cached = None
+        if result_cache is not None:
+            result_key = result_cache.make_key(user_data['content_image'], style_id, mode, alphas, net_key,
+                                               image_size, tiling)
+            with trace.stage('result_cache'):
+                cached = await result_cache.claim(result_key)
+            if cached is None:
+                claimed_key = result_key
+
+        profiler = context.bot_data['profiler']
+
+        async def run_job(fn, *args, **kwargs):
+            if profiler.sample_torch():
+                # The worker writes the trace next to the job's result
+                args = (profiler.trace_path(f"{mode}_{fn.__name__}"), fn) + args
+                fn = profile_job
+            started = time.perf_counter()
+            if policy is not None and plain_job and not executor.remote:
+                result, stages = await executor.run(policy.timed, image_size, collect_stages, fn, *args, **kwargs)
+            else:
+                result, stages = await executor.run(collect_stages, fn, *args, **kwargs)
+                if policy is not None:
+                    # A worker process cannot update the policy, so time the job here;
+                    # this includes the queueing delay, which errs on the safe side
+                    policy.record(image_size, time.perf_counter() - started if plain_job else None)
+            trace.add_worker_stages(stages, time.perf_counter() - started)
+            return result
+
+        # Reuse the encoded content features if this is the user's last photo,
+        # encoded at the size this job runs at
+        sessions = context.bot_data['sessions']
+        session = sessions.get(user_id) if cached is None else None
+        content_feat = None
+        if (session is not None and session['content_feat'] is not None
+                and session['content_bytes'] == user_data['content_image'] and session['image_size'] == image_size):
+            content_feat = session['content_feat']
+            context.bot_data['metrics'].inc('content_feature_reuse_total',
+                                            help="Jobs that reused the encoded content of the user's last photo")
+        # Only jobs with one encode and one decode are a sample of the per-pixel cost
+        plain_job = mode != 'gallery' and len(alphas) == 1 and content_feat is None
+
+        if mode == 'gallery':
+            captions = list(PRE_SAVED_STYLES)
+            labels = [name.lower().replace(' ', '_') for name in captions]
+        else:
+            captions = [f"alpha = {alpha}" for alpha in alphas]
+            labels = [f"alpha_{alpha}" for alpha in alphas]
+
+        # Run inference on the worker pool so other updates keep being served
+        if cached is not None:
+            outputs = [BytesIO(data) for data in cached]
+        elif mode == 'gallery':
+            # Every fine-tuned model with its own style over one content encode
+            presets = [(await get_net(context, PRE_SAVED_STYLE_NETS[name], trace), style_bank.get(name))
+                       for name in captions]
+            outputs, content_feat = await run_job(
+                run_gallery,
+                presets,
+                user_data['content_image'],
+                alpha,
+                content_feat,
+                image_size,
+                tiling
+            )
+        else:
+            style_stats = None
+
+            # A predefined style comes with the precomputed statistics of its style image
+            if mode == 'selected_style':
+                style_stats = style_bank.get(style_id)
+            style_net = await get_net(context, net_key, trace)
+            style_bytes = None if style_stats is not None else user_data['style_image']
+
+            # Progressive delivery: a quick low-resolution result first, then
+            # the full one; preset style statistics serve both
+            preview_size = context.bot_data.get('preview_size')
+            if preview_size and preview_size < image_size and len(alphas) == 1 and content_feat is None:
+                started = time.perf_counter()
+                preview_jpeg, stages = await executor.run(
+                    collect_stages,
+                    run_preview,
+                    style_net,
+                    user_data['content_image'],
+                    style_bytes,
+                    alpha,
+                    preserve_colors,
+                    style_stats,
+                    context.bot_data['style_cache'],
+                    preview_size
+                )
+                trace.add_worker_stages(stages, time.perf_counter() - started, prefix='preview_')
+                # Uploaded while the full job runs
+                preview_upload = asyncio.create_task(
+                    send_preview(update.message, preview_jpeg, get_message("preview", lang), trace)
+                )
+
+            batcher = context.bot_data.get('batcher')
+            if batcher is not None and tiling is None and len(alphas) == 1:
+                # Style statistics per job, then one batched pass with
+                # other users' jobs of the same model and input size
+                started = time.perf_counter()
+                (content, style_stats), stages = await executor.run(
+                    collect_stages,
+                    prepare_inputs,
+                    style_net,
+                    user_data['content_image'],
+                    style_bytes,
+                    preserve_colors=preserve_colors,
+                    style_stats=style_stats,
+                    style_cache=context.bot_data['style_cache'],
+                    load_content=content_feat is None,
+                    image_size=image_size
+                )
+                trace.add_worker_stages(stages, time.perf_counter() - started)
+                if content_feat is None:
+                    batch_key = (net_key, 'image', tuple(content.shape))
+                else:
+                    batch_key = (net_key, 'feat', tuple(content_feat.shape))
+                item = {'content': content, 'content_feat': content_feat, 'style_stats': style_stats, 'alpha': alpha}
+                with trace.stage('batch'):
+                    output, content_feat = await batcher.submit(batch_key, style_net, item)
+                outputs = [output]
+                if policy is not None:
+                    # Includes the batching delay, which errs on the safe side
+                    policy.record(image_size, time.perf_counter() - started if plain_job else None)
+            else:
+                outputs, content_feat = await run_job(
+                    run_style_transfer,
+                    style_net,
+                    user_data['content_image'],
+                    style_bytes,
+                    alphas,
+                    preserve_colors,
+                    style_stats,
+                    context.bot_data['style_cache'],
+                    content_feat,
+                    image_size,
+                    tiling
+                )
+
+        if claimed_key is not None:
+            # Hand the result to identical jobs waiting for it before uploading
+            result_data = [output.getvalue() for output in outputs]
+            result_cache.put(claimed_key, result_data)
+            result_cache.release(claimed_key, result_data)
+
+        # Remember this photo for re-styling; without features (cached or tiled
+        # results), the next re-style encodes it again
+        sessions.put(user_id, user_data['content_image'], content_feat,
+                     user_data['style_image'] if mode in ('standard', 'color_preserving') else None,
+                     image_size)
+
+        # Save user images in the background; the writer records the time it takes
+        context.bot_data['artifact_writer'].submit(
             user_id=user_id,
             content=user_data['content_image'],
-            style=user_data['style_image'],
-            output=img_bytes
-        )
-        img_bytes.seek(0)
-        await update.message.reply_photo(
-            photo=img_bytes,
-            caption=get_message("success", lang)
+            style=user_data.get('style_image'),
+            output=outputs[-1],
+            extra_outputs=dict(zip(labels[:-1], outputs[:-1]))
         )
+
+        preview = await preview_upload if preview_upload is not None else None
+        with trace.stage('upload'):
+            if len(outputs) == 1:
+                # Replace the preview with the full result, or send it as a new message
+                if preview is None or not await replace_photo(preview, outputs[0], get_message("success", lang)):
+                    await update.message.reply_photo(
+                        photo=outputs[0],
+                        caption=get_message("success", lang)
+                    )
+            else:
+                await update.message.reply_media_group(
+                    media=[InputMediaPhoto(output, caption=caption)
+                           for caption, output in zip(captions, outputs)]
+                )
+        trace.result_sent()
+        if len(outputs) > 1 and mode != 'gallery':
+            await update.message.reply_text(get_message("alpha_preview_done", lang))
+    except QueueFullError:
+        status = 'busy'
+        await update.message.reply_text(get_message("busy", lang))
+    except ImageTooLargeError as e:
+        status = 'too_large'
+        print(f"Rejected image of user {user_id}: {e}")
+        await update.message.reply_text(get_message("image_too_large", lang))
     except Exception as e:
+        status = 'error'
         print(f"Error: {e}")
         await update.message.reply_text(get_message("error", lang))
     finally:
+        if claimed_key is not None:
+            # No-op unless the job failed; waiting jobs then compute it themselves
+            result_cache.release(claimed_key)
+        if preview_upload is not None and status != 'ok':
+            # The preview no longer promises a full result
+            preview = await preview_upload
+            if preview is not None:
+                try:
+                    await preview.edit_caption(get_message("preview_failed", lang))
+                except TelegramError as e:
+                    print(f"Could not update preview caption: {e}")
         user_data.pop('content_image', None)
         user_data.pop('style_image', None)
+        trace.finish(status)
 
 
 # --- Entry Point ---
 
-def main():
-    """Starts the Telegram bot"""
+def build_application(config):
+    """Create the bot application with its models, worker pool and stores from a config dict"""
+    global user_data_store
+    user_data_store = load_user_data(flush_interval=config.get('settings_flush_interval', 1.0))
+
     print("Initializing style transfer models...")
-    net, net_picasso, net_van_gogh, net_monet = init_model()
+    backend = config.get('backend', 'eager')
+    processes = config.get('inference_processes', False)
+    if processes and (backend != 'eager' or 'int8' in (config.get('precision') or {}).values()):
+        raise ValueError("inference_processes requires the eager backend and no int8 models")
+    # Exported artifacts are fp32 graphs, which would silently replace converted modules
+    if backend in ('torchscript', 'onnx') and set((config.get('precision') or {}).values()) - {'fp32'}:
+        raise ValueError(f"The {backend} backend runs fp32 exports and cannot be combined with bf16 or int8 precision")
+    weights_dir = config.get('weights_dir', WEIGHTS_DIR)
+    # Preloaded models run once per resolution bucket before the first user does,
+    # and so do decoders loaded later when the backend compiles them
+    models = ModelRegistry(
+        optimize=config.get('optimize_graph', True),
+        precision=config.get('precision'),
+        backend=backend,
+        max_loaded=config.get('max_loaded_decoders'),
+        # Worker processes attach to the weights loaded here, so load them all
+        pinned=NET_NAMES if processes else config.get('preload_models', ['net']),
+        weights_dir=weights_dir,
+        warmup_sizes=config.get('warmup_sizes', [config.get('output_size', IMAGE_SIZE)])
+    )
+    # Preset statistics always come from the fp32 encoder
+    style_bank = StyleBank.build(models.style_net(), PRE_SAVED_STYLES,
+                                 cache_path=os.path.join(weights_dir, STYLE_STATS_CACHE),
+                                 encoder_version=models.encoder_fingerprint())
+
+    builder = ApplicationBuilder().token(config['telegram_token'])
+    # A self-hosted Bot API server (or a local stand-in for benchmarks)
+    if config.get('telegram_base_url'):
+        builder = builder.base_url(config['telegram_base_url']).base_file_url(config['telegram_base_file_url'])
+    # Different users are served concurrently while inference runs on the worker pool;
+    # the updates of one user are handled in order
+    app = builder.concurrent_updates(PerUserUpdateProcessor(config.get('max_concurrent_updates', 256))).build()
+    metrics = app.bot_data['metrics'] = Metrics(log_json=config.get('log_json', False))
+    app.bot_data['models'] = models
+    app.bot_data['style_bank'] = style_bank
+    app.bot_data['style_cache'] = StyleFeatureCache(
+        max_bytes=config.get('style_cache_mb', 64) * 1024 * 1024
+    )
+    if processes:
+        shared = {name: models.get(name) for name in NET_NAMES}
+        shared['style_cache'] = app.bot_data['style_cache']
+        app.bot_data['executor'] = ProcessInferenceExecutor(
+            shared,
+            max_workers=config.get('inference_workers', 1),
+            max_queue=config.get('inference_queue_size', 8),
+            threads_per_worker=config.get('threads_per_worker')
+        )
+    else:
+        app.bot_data['executor'] = InferenceExecutor(
+            max_workers=config.get('inference_workers', 1),
+            max_queue=config.get('inference_queue_size', 8)
+        )
+    app.bot_data['image_size'] = config.get('output_size', IMAGE_SIZE)
+    app.bot_data['preview_size'] = config.get('preview_size')
+    if config.get('qos_latency_target'):
+        app.bot_data['resolution_policy'] = ResolutionPolicy(
+            min_size=config.get('qos_min_size', 256),
+            max_size=app.bot_data['image_size'],
+            latency_target=config['qos_latency_target'],
+            workers=app.bot_data['executor'].max_workers
+        )
+    if config.get('tile_size'):
+        app.bot_data['tiling'] = (config['tile_size'], config.get('tile_overlap', 64))
+    if config.get('batch_max_size', 1) > 1:
+        app.bot_data['batcher'] = MicroBatcher(
+            app.bot_data['executor'],
+            run_style_transfer_batch,
+            max_batch_size=config['batch_max_size'],
+            max_wait_ms=config.get('batch_max_wait_ms', 10)
+        )
+    app.bot_data['artifact_writer'] = ArtifactWriter(max_queue=config.get('save_queue_size', 64), metrics=metrics)
+    app.bot_data['sessions'] = SessionFeatureStore(
+        ttl=config.get('session_ttl', 600),
+        max_entries=config.get('session_max_users', 32)
+    )
+    if config.get('result_cache_mb', 32) > 0:
+        app.bot_data['result_cache'] = ResultCache(
+            max_bytes=config.get('result_cache_mb', 32) * 1024 * 1024,
+            disk_dir=config.get('result_cache_dir'),
+            disk_max_bytes=config.get('result_cache_disk_mb', 1024) * 1024 * 1024,
+            alpha_step=config.get('result_cache_alpha_step', 0.05),
+            model_version=models.fingerprint()
+        )
 
-    with open('config.json') as f:
-        config = json.load(f)
+    if config.get('retention'):
+        policies = dict(config['retention'])
+        interval = policies.pop('interval_minutes', 60) * 60
+        app.bot_data['retention'] = RetentionManager(blob_store=app.bot_data['artifact_writer'].blob_store,
+                                                     **policies)
+        app.bot_data['retention'].start(interval)
+
+    register_metrics(app)
+    app.bot_data['profiler'] = Profiler(**config.get('profiling', {}))
+    app.bot_data['admin_ids'] = set(config.get('admin_ids', []))
+    if config.get('metrics_port'):
+        app.bot_data['metrics_server'] = start_metrics_server(metrics, config['metrics_port'],
+                                                              config.get('metrics_host', '127.0.0.1'))
+
+    # Runs first for every update, so that settings lookups never hit the database on the event loop
+    app.add_handler(TypeHandler(Update, load_settings), group=-1)
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, profiled(handle_message)))
+    app.add_handler(MessageHandler(filters.PHOTO, profiled(handle_image)))
+    return app
+
+
+def register_metrics(app):
+    """Expose the state of the worker pool, caches and stores as metrics"""
+    bot_data = app.bot_data
+    metrics = bot_data['metrics']
+    executor = bot_data['executor']
+    style_cache = bot_data['style_cache']
+    writer = bot_data['artifact_writer']
+
+    def hit_ratio():
+        lookups = style_cache.hits + style_cache.misses
+        return style_cache.hits / lookups if lookups else 0.0
+
+    metrics.gauge('inference_jobs_pending', lambda: executor.pending, help="Inference jobs running or queued")
+    metrics.gauge('inference_jobs_queued', lambda: executor.queued, help="Inference jobs waiting for a worker")
+    # Worker processes keep caches of their own, which the parent cannot see
+    if not executor.remote:
+        metrics.gauge('style_cache_hits_total', lambda: style_cache.hits, kind='counter',
+                      help="Lookups of user style statistics served from the cache")
+        metrics.gauge('style_cache_misses_total', lambda: style_cache.misses, kind='counter',
+                      help="Lookups of user style statistics that had to encode the style")
+        metrics.gauge('style_cache_hit_ratio', hit_ratio,
+                      help="Share of style statistics lookups served from the cache")
+        metrics.gauge('style_cache_bytes', lambda: style_cache.nbytes, help="Memory used by cached style statistics")
+    metrics.gauge('sessions', lambda: len(bot_data['sessions']), help="Users whose last photo is kept for re-styling")
+    metrics.gauge('models_loaded', lambda: len(bot_data['models'].loaded()), help="Style transfer models in memory")
+    metrics.gauge('artifact_queue_depth', lambda: writer.pending, help="Results waiting to be saved")
+    metrics.gauge('artifacts_dropped_total', lambda: writer.dropped, kind='counter',
+                  help="Results not saved because the writer queue was full")
+    if 'result_cache' in bot_data:
+        result_cache = bot_data['result_cache']
+        metrics.gauge('result_cache_hits_total', lambda: result_cache.hits + result_cache.disk_hits, kind='counter',
+                      help="Jobs served from the cache of finished results")
+        metrics.gauge('result_cache_disk_hits_total', lambda: result_cache.disk_hits, kind='counter',
+                      help="Jobs served from the on-disk tier of the result cache")
+        metrics.gauge('result_cache_misses_total', lambda: result_cache.misses, kind='counter',
+                      help="Jobs whose result was not cached")
+        metrics.gauge('result_cache_shared_total', lambda: result_cache.shared, kind='counter',
+                      help="Jobs that waited for an identical running job instead of computing the result")
+        metrics.gauge('result_cache_bytes', lambda: result_cache.nbytes, help="Memory used by cached results")
+        metrics.gauge('result_cache_disk_bytes', lambda: result_cache.disk_nbytes,
+                      help="Disk space used by cached results")
+    if 'batcher' in bot_data:
+        batcher = bot_data['batcher']
+        metrics.gauge('inference_batches_total', lambda: batcher.batches, kind='counter',
+                      help="Batches run by the micro-batcher")
+        metrics.gauge('inference_batched_jobs_total', lambda: batcher.jobs, kind='counter',
+                      help="Jobs run in batches by the micro-batcher")
+        metrics.gauge('inference_batch_size_mean', lambda: batcher.metrics()['mean_batch_size'],
+                      help="Mean number of jobs per batch")
+        metrics.gauge('inference_batch_fill_rate', lambda: batcher.metrics()['fill_rate'],
+                      help="Mean batch size as a share of batch_max_size")
+    if 'resolution_policy' in bot_data:
+        metrics.gauge('degraded_jobs_total', lambda: bot_data['resolution_policy'].usage()['degraded'],
+                      kind='counter', help="Jobs run below the output size to keep up with the queue")
+
+
+def shutdown_application(app):
+    """Stop the worker pool and background jobs and flush pending writes"""
+    if 'metrics_server' in app.bot_data:
+        app.bot_data['metrics_server'].shutdown()
+        app.bot_data['metrics_server'].server_close()
+    app.bot_data['executor'].shutdown()
+    app.bot_data['artifact_writer'].close()
+    if 'result_cache' in app.bot_data:
+        app.bot_data['result_cache'].close()
+    if 'retention' in app.bot_data:
+        app.bot_data['retention'].close()
+    user_data_store.close()
 
-    app = ApplicationBuilder().token(config['telegram_token']).build()
-    app.bot_data['net'] = net
-    app.bot_data['net_picasso'] = net_picasso
-    app.bot_data['net_van_gogh'] = net_van_gogh
-    app.bot_data['net_monet'] = net_monet
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_image))
+def main():
+    """Starts the Telegram bot"""
+    with open('config.json') as f:
+        config = json.load(f)
+    app = build_application(config)
 
     print("Bot is running...")
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        shutdown_application(app)
 
 
 if __name__ == '__main__':
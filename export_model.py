@@ -0,0 +1,37 @@
+"""
+Export the encoder and decoders for the torchscript or onnx inference backend.
+
+The artifacts are written to model_weights/exported/ and picked up by the
+bot when "backend" is set accordingly in config.json.
+
+Usage:
+    python export_model.py --backend onnx
+"""
+import argparse
+
+import torch
+
+from model.adain_utils import get_device
+from utils.backends import EXPORT_DIR, export_module
+from utils.functional import NET_NAMES, init_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['torchscript', 'onnx'], nargs='+', default=['torchscript', 'onnx'])
+    parser.add_argument('--export-dir', default=EXPORT_DIR)
+    args = parser.parse_args()
+
+    nets = init_model(optimize=True)
+    image = torch.rand(1, 3, 256, 256)
+    with torch.no_grad():
+        feat = nets[0].encode(image.to(get_device(nets[0])))
+
+    for backend in args.backend:
+        print(export_module(nets[0].encoder, 'encoder', backend, image, args.export_dir))
+        for name, net in zip(NET_NAMES, nets):
+            print(export_module(net.decoder, name, backend, feat, args.export_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,23 @@
+import math
+
 import torch
-from utils.image_io import load_image
+from utils.image_io import IMAGE_SIZE, load_image
+from utils.metrics import stage
 from torchvision import transforms
 
+# Pixels per image the CORAL color statistics are estimated on
+CORAL_SAMPLES = 65536
+
+
+def get_device(net):
+    """
+    Device of a network's weights. Fully quantized networks keep their
+    weights outside of parameters() and always run on the CPU.
+    """
+    for tensor in net.parameters():
+        return tensor.device
+    return torch.device('cpu')
+
 
 def calc_mean_std(feat, eps=1e-5):
     """
@@ -17,10 +33,10 @@ def calc_mean_std(feat, eps=1e-5):
     size = feat.size()
     assert (len(size) == 4)
     N, C = size[:2]
-    feat_var = feat.view(N, C, -1).var(dim=2) + eps
-    feat_std = feat_var.sqrt().view(N, C, 1, 1)
-    feat_mean = feat.view(N, C, -1).mean(dim=2).view(N, C, 1, 1)
-    return feat_mean, feat_std
+    # One pass over the features for both moments
+    feat_var, feat_mean = torch.var_mean(feat.view(N, C, -1), dim=2)
+    feat_std = (feat_var + eps).sqrt().view(N, C, 1, 1)
+    return feat_mean.view(N, C, 1, 1), feat_std
 
 
 def adaptive_instance_normalization(content_feat, style_feat):
@@ -35,13 +51,43 @@ def adaptive_instance_normalization(content_feat, style_feat):
         Tensor: Stylized feature tensor of the same shape as content_feat.
     """
     assert (content_feat.size()[:2] == style_feat.size()[:2])
-    size = content_feat.size()
     style_mean, style_std = calc_mean_std(style_feat)
-    content_mean, content_std = calc_mean_std(content_feat)
+    return adaptive_instance_normalization_with_stats(content_feat, style_mean, style_std)
+
+
+def adaptive_instance_normalization_with_stats(content_feat, style_mean, style_std, content_stats=None):
+    """
+    Apply Adaptive Instance Normalization using precomputed style statistics.
+
+    Args:
+        content_feat (Tensor): Content features
+        style_mean (Tensor): Channel-wise style mean of shape (N, C, 1, 1)
+        style_std (Tensor): Channel-wise style std of shape (N, C, 1, 1)
+        content_stats (tuple): Optional content (mean, std) to normalize with
+            instead of the statistics of content_feat (e.g. for image tiles)
+
+    Returns:
+        Tensor: Stylized feature tensor of the same shape as content_feat.
+    """
+    assert (content_feat.size()[:2] == style_mean.size()[:2] == style_std.size()[:2])
+    return blend_features(content_feat, (style_mean, style_std), 1.0, content_stats)
 
-    normalized_feat = (content_feat - content_mean.expand(
-        size)) / content_std.expand(size)
-    return normalized_feat * style_std.expand(size) + style_mean.expand(size)
+
+def adain_affine(content_stats, style_stats, alpha):
+    """
+    Per-channel (scale, shift) such that content_feat * scale + shift equals
+    AdaIN blended with the content features by alpha:
+
+        alpha * ((x - c_mean) / c_std * s_std + s_mean) + (1 - alpha) * x
+
+    alpha is a float or a tensor broadcastable to (N, 1, 1, 1).
+    """
+    content_mean, content_std = content_stats
+    style_mean, style_std = style_stats
+    ratio = style_std / content_std
+    scale = ratio * alpha + (1 - alpha)
+    shift = (style_mean - content_mean * ratio) * alpha
+    return scale, shift
 
 
 def _calc_feat_flatten_mean_std(feat):
@@ -64,9 +110,12 @@ def _mat_sqrt(x):
     return torch.mm(torch.mm(U, D.pow(0.5).diag()), V.t())
 
 
-def coral(source, target):
+def coral_svd(source, target):
     """
     Perform CORAL (Correlation Alignment) to match the color distribution of the source to the target.
+
+    Reference implementation on all pixels with SVD matrix square roots;
+    coral() is the faster equivalent used for inference.
     """
 
     source_f, source_f_mean, source_f_std = _calc_feat_flatten_mean_std(source)
@@ -94,42 +143,278 @@ def coral(source, target):
     return source_f_transfer.view(source.size())
 
 
-def style_transfer(vgg, decoder, content, style, alpha):
+def color_stats(images, max_samples=CORAL_SAMPLES):
+    """
+    Color statistics of a (B, 3, H, W) batch for CORAL.
+
+    Channel mean and std and the 3x3 covariance are estimated on a strided
+    subsample of at most max_samples pixels per image. The square root and
+    inverse square root of the covariance come from one symmetric
+    eigendecomposition.
+
+    Returns:
+        (mean, std, cov_sqrt, cov_inv_sqrt) of shapes (B, 3, 1), (B, 3, 1),
+        (B, 3, 3) and (B, 3, 3).
+    """
+    assert images.dim() == 4 and images.size(1) == 3
+    batch = images.size(0)
+    flat = images.reshape(batch, 3, -1)
+    count = flat.size(-1)
+    sample = flat[:, :, ::max(1, math.ceil(count / max_samples))].double()
+    mean = sample.mean(dim=-1, keepdim=True)
+    std = sample.std(dim=-1, keepdim=True)
+    norm = (sample - mean) / std
+    # Like coral_svd, sum over all pixels (not average) before adding the identity
+    cov = norm @ norm.transpose(1, 2) * ((count - 1) / (sample.size(-1) - 1))
+    cov = cov + torch.eye(3, dtype=cov.dtype, device=cov.device)
+    eigvals, eigvecs = torch.linalg.eigh(cov)
+    cov_sqrt = eigvecs @ torch.diag_embed(eigvals.sqrt()) @ eigvecs.transpose(1, 2)
+    cov_inv_sqrt = eigvecs @ torch.diag_embed(eigvals.rsqrt()) @ eigvecs.transpose(1, 2)
+    return mean, std, cov_sqrt, cov_inv_sqrt
+
+
+def coral_batch(source, target, source_stats=None, target_stats=None, max_samples=CORAL_SAMPLES):
+    """
+    CORAL for batches: match the colors of every (3, H, W) image in source
+    to the corresponding image in target.
+
+    Precomputed color_stats of either side (e.g. cached for a style image)
+    skip its statistics. Whitening, coloring and both normalizations are
+    folded into one 3x3 affine map per image, applied in a single pass.
+    """
+    source_mean, source_std, _, source_inv_sqrt = source_stats or color_stats(source, max_samples)
+    target_mean, target_std, target_sqrt, _ = target_stats or color_stats(target, max_samples)
+
+    weight = target_std * (target_sqrt @ source_inv_sqrt) / source_std.transpose(1, 2)
+    bias = target_mean - weight @ source_mean
+    batch = source.size(0)
+    output = torch.baddbmm(bias.to(source.dtype), weight.to(source.dtype), source.reshape(batch, 3, -1))
+    return output.view(source.size())
+
+
+def coral(source, target, source_stats=None, target_stats=None):
+    """
+    Perform CORAL (Correlation Alignment) to match the color distribution of
+    a (3, H, W) source image to a (3, H, W) target image.
+    """
+    return coral_batch(source.unsqueeze(0), target.unsqueeze(0), source_stats, target_stats)[0]
+
+
+def blend_features(content_f, style_stats, alpha, content_stats=None, inplace=False):
+    """
+    AdaIN with precomputed style statistics, interpolated with the content
+    features by alpha.
+
+    Normalization, scale-shift and blend are applied as one affine transform
+    per channel. With inplace=True content_f is overwritten instead of
+    allocating the result.
+    """
+    if content_stats is None:
+        content_stats = calc_mean_std(content_f)
+    scale, shift = adain_affine(content_stats, style_stats, alpha)
+    if inplace:
+        return content_f.mul_(scale).add_(shift)
+    return torch.addcmul(shift, content_f, scale)
+
+
+def style_transfer(vgg, decoder, content, style, alpha, style_stats=None):
     """
     Perform neural style transfer using AdaIN.
+
+    If style_stats (mean, std) is given, the style image is not encoded.
     """
     assert (0.0 <= alpha <= 1.0)
     content_f = vgg(content)
-    style_f = vgg(style)
-    feat = adaptive_instance_normalization(content_f, style_f)
-    feat = feat * alpha + content_f * (1 - alpha)
-    return decoder(feat)
-
-
-def process_images(net, content_bytes, style_bytes, alpha, preserve_colors=False):
-    """Perform style transfer on image bytes"""
-    content = load_image(content_bytes)
-    style = load_image(style_bytes)
-
-    # Apply color preservation if needed
-    if preserve_colors:
-        style = coral(style, content)
-
-    # Move to device and add batch dimension
-    device = next(net.parameters()).device
-    content = content.to(device).unsqueeze(0)
-    style = style.to(device).unsqueeze(0)
-
-    # Perform style transfer
-    with torch.no_grad():
-        output = style_transfer(
-            net.encode,
-            net.decoder,
-            content,
-            style,
-            alpha=alpha
+    if style_stats is None:
+        style_stats = calc_mean_std(vgg(style))
+    return decoder(blend_features(content_f, style_stats, alpha, inplace=True))
+
+
+def encode_style_stats(net, style_bytes, content=None, style_cache=None, style_size=IMAGE_SIZE):
+    """
+    Encode a style image, resized to style_size, and return its relu4_1 (mean, std).
+
+    If the content image tensor is given, the style colors are first matched
+    to it with CORAL (color-preserving mode). The color statistics of the
+    style are then kept in style_cache, if given, for use with other contents.
+    """
+    with stage('load_image'):
+        style = load_image(style_bytes, style_size)
+    if content is not None:
+        with stage('coral'):
+            style_color_stats = None
+            if style_cache is not None:
+                # The statistics depend on the pixel count, hence on the size
+                key = 'coral:' + style_cache.make_key(style_bytes, size=style_size)
+                style_color_stats = style_cache.get(key)
+                if style_color_stats is None:
+                    style_color_stats = color_stats(style.unsqueeze(0))
+                    style_cache.put(key, style_color_stats)
+            style = coral(style, content, source_stats=style_color_stats)
+    device = get_device(net)
+    with torch.no_grad(), stage('encode'):
+        return calc_mean_std(net.encode(style.to(device).unsqueeze(0)))
+
+
+def prepare_inputs(net, content_bytes, style_bytes=None, preserve_colors=False, style_stats=None,
+                   style_cache=None, load_content=True, image_size=IMAGE_SIZE, style_size=IMAGE_SIZE):
+    """
+    Load the content image and compute the style (mean, std) of a job.
+
+    Precomputed style_stats are used as is, otherwise they are looked up in
+    style_cache or encoded. The content image tensor (C, H, W), resized to
+    image_size, is returned on the CPU, or None if it was neither requested
+    nor needed for CORAL. The style statistics are returned on the network
+    device; the style image itself is encoded at style_size.
+    """
+    assert style_bytes is not None or style_stats is not None
+    assert not (preserve_colors and style_bytes is None)
+    device = get_device(net)
+    content = None
+    if load_content:
+        with stage('load_image'):
+            content = load_image(content_bytes, image_size)
+
+    if style_stats is None:
+        key = None
+        if style_cache is not None:
+            # CORAL matches the style to the content at its working resolution
+            size = (style_size, image_size) if preserve_colors else style_size
+            key = style_cache.make_key(style_bytes, preserve_colors, content_bytes, size=size)
+            style_stats = style_cache.get(key)
+        if style_stats is None:
+            if preserve_colors and content is None:
+                with stage('load_image'):
+                    content = load_image(content_bytes, image_size)
+            style_stats = encode_style_stats(net, style_bytes, content if preserve_colors else None, style_cache,
+                                             style_size)
+            if style_cache is not None:
+                style_cache.put(key, style_stats)
+    return content, tuple(stat.to(device) for stat in style_stats)
+
+
+def extract_features(net, content_bytes, style_bytes=None, preserve_colors=False, style_stats=None,
+                     style_cache=None, content_feat=None, image_size=IMAGE_SIZE):
+    """
+    Compute the relu4_1 content features and style (mean, std) of a job.
+
+    Precomputed content_feat or style_stats are reused instead of encoding
+    the images again. Both results are returned on the network device.
+    """
+    device = get_device(net)
+    content, style_stats = prepare_inputs(
+        net,
+        content_bytes,
+        style_bytes,
+        preserve_colors=preserve_colors,
+        style_stats=style_stats,
+        style_cache=style_cache,
+        load_content=content_feat is None,
+        image_size=image_size
+    )
+    if content_feat is None:
+        with torch.no_grad(), stage('encode'):
+            content_feat = net.encode(content.to(device).unsqueeze(0))
+    return content_feat.to(device), style_stats
+
+
+def stylize_features(net, content_feat, style_stats, alpha):
+    """Run AdaIN and the decoder on encoded features and return a PIL image"""
+    assert (0.0 <= alpha <= 1.0)
+    with torch.no_grad(), stage('decode'):
+        output = net.decoder(blend_features(content_feat, style_stats, alpha))
+
+        # Convert to PIL image
+        output = output.clamp(0, 1)
+        return transforms.ToPILImage()(output.squeeze(0).cpu())
+
+
+def stylize_alpha_sweep(net, content_feat, style_stats, alphas):
+    """
+    Stylize encoded features with several alpha values at once.
+
+    AdaIN is computed once and the blends for all alphas are decoded as a
+    single batch. Returns one PIL image per alpha.
+    """
+    assert all(0.0 <= alpha <= 1.0 for alpha in alphas)
+    assert content_feat.size(0) == 1
+    with torch.no_grad(), stage('decode'):
+        alpha = torch.tensor(alphas, dtype=content_feat.dtype, device=content_feat.device).view(-1, 1, 1, 1)
+        # Broadcasting the (1, C, H, W) features over the alphas yields the batch
+        output = net.decoder(blend_features(content_feat, style_stats, alpha))
+
+        output = output.clamp(0, 1).cpu()
+        return [transforms.ToPILImage()(image) for image in output]
+
+
+def stylize_batch(net, style_stats, alphas, contents=None, content_feats=None):
+    """
+    Stylize several independent jobs with one encoder and decoder pass.
+
+    Args:
+        net: style transfer network shared by all jobs
+        style_stats: list of (mean, std) pairs, one per job
+        alphas: list of alpha values, one per job
+        contents: list of content image tensors (C, H, W) of equal size
+        content_feats: list of encoded content features (1, C, H, W), used
+            instead of contents when the images were already encoded
+
+    Returns:
+        List of (PIL image, content features) pairs in job order.
+    """
+    assert (contents is None) != (content_feats is None)
+    assert all(0.0 <= alpha <= 1.0 for alpha in alphas)
+    device = get_device(net)
+    with torch.no_grad(), stage('encode'):
+        if content_feats is None:
+            content_f = net.encode(torch.stack(contents).to(device))
+        else:
+            content_f = torch.cat([feat.to(device) for feat in content_feats])
+    with torch.no_grad(), stage('decode'):
+        style_mean = torch.cat([mean for mean, _ in style_stats])
+        style_std = torch.cat([std for _, std in style_stats])
+        alpha = torch.tensor(alphas, dtype=content_f.dtype, device=content_f.device).view(-1, 1, 1, 1)
+        output = net.decoder(blend_features(content_f, (style_mean, style_std), alpha))
+
+        output = output.clamp(0, 1).cpu()
+        # Copies, so that a job's kept features do not hold the whole batch in memory
+        return [(transforms.ToPILImage()(image), content_f[i:i + 1].clone()) for i, image in enumerate(output)]
+
+
+def process_images(net, content_bytes, style_bytes=None, alpha=1.0, preserve_colors=False, style_stats=None,
+                   style_cache=None, image_size=IMAGE_SIZE, tile_size=None, tile_overlap=64):
+    """
+    Perform style transfer on image bytes.
+
+    Either style_bytes or precomputed relu4_1 style_stats (mean, std) must be
+    given. Color preservation needs the style image itself. With a
+    style_cache, statistics of already seen style images are reused.
+    The content is resized to image_size; if tile_size is set, it is
+    processed in overlapping tiles of that size to bound peak memory.
+    """
+    if tile_size is not None:
+        from .tiling import stylize_tiled
+
+        content, style_stats = prepare_inputs(
+            net,
+            content_bytes,
+            style_bytes,
+            preserve_colors=preserve_colors,
+            style_stats=style_stats,
+            style_cache=style_cache,
+            image_size=image_size
         )
+        # Every tile is encoded and decoded in turn, so both count as one stage
+        with stage('tiles'):
+            return stylize_tiled(net, content, style_stats, alpha, tile_size, tile_overlap)
 
-    # Convert to PIL image
-    output = output.clamp(0, 1)
-    return transforms.ToPILImage()(output.squeeze(0).cpu())
+    content_feat, style_stats = extract_features(
+        net,
+        content_bytes,
+        style_bytes,
+        preserve_colors=preserve_colors,
+        style_stats=style_stats,
+        style_cache=style_cache,
+        image_size=image_size
+    )
+    return stylize_features(net, content_feat, style_stats, alpha)
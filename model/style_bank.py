@@ -0,0 +1,76 @@
+import hashlib
+import os
+
+import torch
+
+from utils.image_io import load_image
+from .adain_utils import calc_mean_std, get_device
+
+
+class StyleBank:
+    """
+    Relu4_1 channel mean/std of the pre-saved style images.
+
+    AdaIN only needs these statistics from the style image, so they are
+    computed once at startup instead of encoding the style on every request.
+    The raw image bytes are kept as well, for saving alongside user results.
+    """
+    def __init__(self, stats, images):
+        self.stats = stats
+        self.images = images
+
+    def __contains__(self, name):
+        return name in self.stats
+
+    def get(self, name):
+        """Return the (mean, std) pair of a pre-saved style."""
+        return self.stats[name]
+
+    def image(self, name):
+        """Return the raw bytes of a pre-saved style image."""
+        return self.images[name]
+
+    @classmethod
+    def build(cls, net, style_paths, cache_path=None, encoder_version=''):
+        """
+        Compute the statistics of every style in style_paths ({name: path}).
+
+        If cache_path is given, statistics are loaded from it when the style
+        files and encoder_version (a digest of the encoder weights, see
+        ModelRegistry.encoder_fingerprint) are unchanged, and written back
+        after recomputation.
+        """
+        device = get_device(net)
+        images = {}
+        for name, path in style_paths.items():
+            with open(path, 'rb') as f:
+                images[name] = f.read()
+        digests = {name: hashlib.sha256(data).hexdigest() for name, data in images.items()}
+
+        cached = {}
+        if cache_path and os.path.exists(cache_path):
+            try:
+                cached = torch.load(cache_path, map_location=device)
+            except Exception as e:
+                print(f"Ignoring unreadable style cache {cache_path}: {e}")
+
+        stats = {}
+        updated = False
+        for name, data in images.items():
+            entry = cached.get(name)
+            if (entry is None or entry['sha256'] != digests[name]
+                    or entry.get('encoder_version') != encoder_version):
+                style = load_image(data).to(device).unsqueeze(0)
+                with torch.no_grad():
+                    mean, std = calc_mean_std(net.encode(style))
+                entry = {'mean': mean, 'std': std}
+                updated = True
+            stats[name] = (entry['mean'].to(device), entry['std'].to(device))
+
+        if cache_path and updated:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            torch.save({name: {'sha256': digests[name], 'encoder_version': encoder_version,
+                               'mean': mean.cpu(), 'std': std.cpu()}
+                        for name, (mean, std) in stats.items()}, cache_path)
+
+        return cls(stats, images)
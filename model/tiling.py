@@ -0,0 +1,148 @@
+import torch
+from torchvision import transforms
+
+from .adain_utils import blend_features, get_device
+
+
+def _round8(value):
+    """Round up to a multiple of 8, the stride of a relu4_1 feature cell"""
+    return -(-value // 8) * 8
+
+
+def _tile_starts(length, tile, stride):
+    """
+    Start offsets of tiles of size `tile` covering [0, length). With tile and
+    stride multiples of 8, all offsets are too; the last tile may then be
+    cut short by the image border.
+    """
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    last = _round8(length - tile)
+    if last != starts[-1]:
+        starts.append(last)
+    return starts
+
+
+def _tiles(content, tile_size, overlap):
+    """Yield (top, left, tile) crops of a (3, H, W) image"""
+    _, height, width = content.shape
+    stride = tile_size - overlap
+    for top in _tile_starts(height, tile_size, stride):
+        for left in _tile_starts(width, tile_size, stride):
+            yield top, left, content[:, top:top + tile_size, left:left + tile_size]
+
+
+def _blend_window(height, width, top, left, full_height, full_width, overlap):
+    """
+    Weights of a tile for seam blending: a linear ramp over the overlap on
+    every side that touches another tile, 1 elsewhere.
+    """
+    def ramp(length, touches_start, touches_end):
+        weights = torch.ones(length)
+        size = min(overlap, length)
+        if size > 0:
+            edge = torch.linspace(1 / (size + 1), size / (size + 1), size)
+            if touches_start:
+                weights[:size] = torch.minimum(weights[:size], edge)
+            if touches_end:
+                weights[-size:] = torch.minimum(weights[-size:], edge.flip(0))
+        return weights
+
+    rows = ramp(height, top > 0, top + height < full_height)
+    cols = ramp(width, left > 0, left + width < full_width)
+    return rows[:, None] * cols[None, :]
+
+
+def encode_tiles(net, content, tile_size=512, overlap=64, eps=1e-5):
+    """
+    Encode a large (3, H, W) image tile by tile; tile_size and overlap are
+    rounded up to multiples of 8.
+
+    Returns the relu4_1 features of every tile as (top, left, features)
+    on the CPU, and the channel-wise mean/std of the features over the whole
+    image. Only the part of every tile that no earlier tile covered is
+    counted, so overlapping regions are not counted twice.
+    """
+    tile_size, overlap = _round8(tile_size), _round8(overlap)
+    assert 0 <= overlap < tile_size
+    device = get_device(net)
+    _, height, width = content.shape
+    covered = torch.zeros(height, width, dtype=torch.bool)
+    tiles = []
+    total = total_sq = None
+    count = 0
+    with torch.no_grad():
+        for top, left, tile in _tiles(content, tile_size, overlap):
+            feat = net.encode(tile.to(device).unsqueeze(0))
+            tiles.append((top, left, feat.cpu()))
+            feat = feat[0].double()
+            mask = ~covered[top:top + tile.shape[1], left:left + tile.shape[2]]
+            covered[top:top + tile.shape[1], left:left + tile.shape[2]] = True
+            # Each feature cell covers an 8x8 block of input pixels; tiles start on that grid
+            mask = mask[::8, ::8][:feat.shape[1], :feat.shape[2]].to(device)
+            values = feat[:, mask]
+            total = values.sum(1) if total is None else total + values.sum(1)
+            total_sq = (values ** 2).sum(1) if total_sq is None else total_sq + (values ** 2).sum(1)
+            count += values.shape[1]
+    mean = total / count
+    var = (total_sq - count * mean ** 2) / max(count - 1, 1) + eps
+    return tiles, (mean.float().view(1, -1, 1, 1), var.sqrt().float().view(1, -1, 1, 1))
+
+
+def decode_tiles(net, tiles, content_stats, style_stats, alpha, size, tile_size=512, overlap=64, consume=False):
+    """
+    Decode the tiles of an image of the given (height, width), encoded by
+    encode_tiles with the same tile_size and overlap, with one style and
+    alpha. Any decoder of the shared encoder can be used, so the tiles are
+    encoded once for several alphas or styles. With consume=True, the
+    tile features are overwritten, so it must be their last decode.
+    Returns a PIL image.
+    """
+    assert (0.0 <= alpha <= 1.0)
+    tile_size, overlap = _round8(tile_size), _round8(overlap)
+    device = get_device(net)
+    height, width = size
+    output = torch.zeros(3, height, width)
+    weights = torch.zeros(height, width)
+    with torch.no_grad():
+        for top, left, content_f in tiles:
+            tile_h, tile_w = min(tile_size, height - top), min(tile_size, width - left)
+            blended = blend_features(content_f.to(device), style_stats, alpha, content_stats, inplace=consume)
+            decoded = net.decoder(blended)
+            # The decoder output is rounded up to a multiple of 8
+            decoded = decoded[0, :, :tile_h, :tile_w].cpu()
+            window = _blend_window(tile_h, tile_w, top, left, height, width, overlap)
+            output[:, top:top + tile_h, left:left + tile_w] += decoded * window
+            weights[top:top + tile_h, left:left + tile_w] += window
+
+    output = (output / weights).clamp(0, 1)
+    return transforms.ToPILImage()(output)
+
+
+def stylize_tiled(net, content, style_stats, alpha, tile_size=512, overlap=64):
+    """
+    Stylize a large (3, H, W) content image tile by tile with bounded memory.
+
+    The content statistics are computed over the whole image first, so every
+    tile is normalized the same way; tiles overlap by `overlap` pixels and
+    are blended with linear ramps to hide seams. Tile size and overlap are
+    rounded up to multiples of 8. Peak activation memory depends on
+    tile_size only; the relu4_1 features of all tiles are kept between the
+    two passes, so every tile is encoded once. Returns a PIL image.
+    """
+    return stylize_tiled_many(content, [(net, style_stats, alpha)], tile_size, overlap)[0]
+
+
+def stylize_tiled_many(content, renders, tile_size=512, overlap=64):
+    """
+    Like stylize_tiled, for several (net, style_stats, alpha) renders of one
+    content image, e.g. an alpha sweep or a gallery of decoders. The tiles
+    are encoded once, by the first network, and decoded once per render, so
+    peak memory stays that of a single tile pass. Returns a PIL image per
+    render.
+    """
+    tiles, content_stats = encode_tiles(renders[0][0], content, tile_size, overlap)
+    return [decode_tiles(net, tiles, content_stats, style_stats, alpha, content.shape[1:], tile_size, overlap,
+                         consume=i == len(renders) - 1)
+            for i, (net, style_stats, alpha) in enumerate(renders)]
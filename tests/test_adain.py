@@ -0,0 +1,278 @@
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision.transforms.functional import to_tensor
+
+from model.adain_net import Decoder, VGG, Net
+from model.adain_utils import (adaptive_instance_normalization, blend_features, calc_mean_std, color_stats, coral,
+                               coral_batch, coral_svd, extract_features, prepare_inputs, process_images,
+                               stylize_alpha_sweep, stylize_batch, stylize_features)
+from model.style_bank import StyleBank
+from utils.feature_cache import SessionFeatureStore, StyleFeatureCache
+from utils.image_io import IMAGE_SIZE, load_image
+from utils.jobs import run_gallery, run_preview, run_style_transfer
+from utils.process_pool import ProcessInferenceExecutor
+
+STYLE_PATHS = {"Picasso": "test_images/style/picasso.jpg"}
+
+
+def make_net():
+    """Randomly initialized network with the same layout as init_model()"""
+    torch.manual_seed(0)
+    vgg = nn.Sequential(*list(VGG().model.children())[:31])
+    decoder = Decoder()
+    # Variance-preserving init so that outputs are not all clamped to black
+    for module in list(vgg.modules()) + list(decoder.modules()):
+        if isinstance(module, nn.Conv2d):
+            nn.init.kaiming_normal_(module.weight, nonlinearity='relu')
+            nn.init.zeros_(module.bias)
+    decoder.model[-1].weight.data.mul_(0.1)
+    nn.init.constant_(decoder.model[-1].bias, 0.5)
+    return Net(vgg, decoder).eval()
+
+
+def read_image(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_style_stats_match_style_encode(tmp_path):
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    cache_path = str(tmp_path / "style_stats.pt")
+    bank = StyleBank.build(net, STYLE_PATHS, cache_path=cache_path, encoder_version='v1')
+
+    expected = process_images(net, content_bytes, bank.image("Picasso"), alpha=0.7)
+    result = process_images(net, content_bytes, alpha=0.7, style_stats=bank.get("Picasso"))
+    assert result.tobytes() == expected.tobytes()
+
+    encode = net.encode
+    calls = []
+    net.encode = lambda x: calls.append(x.shape) or encode(x)
+    cached_bank = StyleBank.build(net, STYLE_PATHS, cache_path=cache_path, encoder_version='v1')
+    for cached, fresh in zip(cached_bank.get("Picasso"), bank.get("Picasso")):
+        assert torch.equal(cached, fresh)
+    assert not calls
+    # Other encoder weights invalidate the cached statistics
+    StyleBank.build(net, STYLE_PATHS, cache_path=cache_path, encoder_version='v2')
+    assert len(calls) == 1
+
+
+def test_style_cache_reuses_encoded_style():
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    style_bytes = read_image("test_images/style/monet.jpg")
+    cache = StyleFeatureCache()
+
+    expected = process_images(net, content_bytes, style_bytes, alpha=1.0)
+    first = process_images(net, content_bytes, style_bytes, alpha=1.0, style_cache=cache)
+    second = process_images(net, content_bytes, style_bytes, alpha=1.0, style_cache=cache)
+    assert first.tobytes() == expected.tobytes() == second.tobytes()
+    assert cache.usage()['hits'] == 1 and cache.usage()['misses'] == 1
+
+    # Color-preserving statistics depend on the content image as well,
+    # the color statistics of the style are cached separately
+    process_images(net, content_bytes, style_bytes, alpha=1.0, preserve_colors=True, style_cache=cache)
+    assert len(cache) == 3
+
+
+def test_style_cache_evicts_least_recently_used():
+    stats = (torch.zeros(1, 512, 1, 1), torch.ones(1, 512, 1, 1))
+    cache = StyleFeatureCache(max_bytes=2 * 2 * 512 * 4)
+    cache.put("a", stats)
+    cache.put("b", stats)
+    cache.get("a")
+    cache.put("c", stats)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.usage()['bytes'] <= cache.max_bytes
+
+
+def test_session_features_restyle_without_encoding(monkeypatch):
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    style_bytes = read_image("test_images/style/monet.jpg")
+    sessions = SessionFeatureStore(ttl=60)
+
+    content_feat, style_stats = extract_features(net, content_bytes, style_bytes)
+    sessions.put("1", content_bytes, content_feat, style_bytes)
+    expected = process_images(net, content_bytes, style_bytes, alpha=0.5)
+
+    # The cached features must be enough: encoding again would fail
+    session = sessions.get("1")
+    assert session['image_size'] == IMAGE_SIZE
+    monkeypatch.setattr(net, "encode", None)
+    feat, stats = extract_features(net, content_bytes, style_stats=style_stats, content_feat=session['content_feat'])
+    assert stylize_features(net, feat, stats, alpha=0.5).tobytes() == expected.tobytes()
+
+    # A newer photo without features (e.g. a cached result) replaces the session
+    sessions.put("1", style_bytes, None)
+    assert sessions.get("1")['content_bytes'] == style_bytes and sessions.get("1")['content_feat'] is None
+
+    sessions.ttl = 0
+    sessions.put("1", content_bytes, content_feat)
+    assert sessions.get("1") is None
+
+
+def test_preview_keeps_full_size_style_stats_apart():
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    style_bytes = read_image("test_images/style/monet.jpg")
+    cache = StyleFeatureCache()
+
+    preview = run_preview(net, content_bytes, style_bytes, 1.0, True, style_cache=cache, image_size=128)
+    assert min(Image.open(preview).size) == 128
+
+    # The preview statistics are encoded at its own size and do not stand in for the full ones
+    expected = process_images(net, content_bytes, style_bytes, alpha=1.0, preserve_colors=True)
+    full = process_images(net, content_bytes, style_bytes, alpha=1.0, preserve_colors=True, style_cache=cache)
+    assert full.tobytes() == expected.tobytes()
+    assert cache.usage()['hits'] == 0
+
+
+def test_alpha_sweep_matches_single_alpha_runs():
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    style_bytes = read_image("test_images/style/monet.jpg")
+    alphas = (0.25, 1.0)
+    content_feat, style_stats = extract_features(net, content_bytes, style_bytes)
+
+    previews = stylize_alpha_sweep(net, content_feat, style_stats, alphas)
+    assert len(previews) == len(alphas)
+    for alpha, preview in zip(alphas, previews):
+        expected = stylize_features(net, content_feat, style_stats, alpha)
+        diff = (to_tensor(preview) - to_tensor(expected)).abs().max().item()
+        assert diff <= 1 / 255 + 1e-6
+
+
+def test_batched_jobs_match_single_runs():
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    styles = [read_image("test_images/style/monet.jpg"), read_image("test_images/style/picasso.jpg")]
+    alphas = [1.0, 0.5]
+
+    jobs = [prepare_inputs(net, content_bytes, style_bytes) for style_bytes in styles]
+    results = stylize_batch(net, [stats for _, stats in jobs], alphas, contents=[content for content, _ in jobs])
+    for (image, _), style_bytes, alpha in zip(results, styles, alphas):
+        expected = process_images(net, content_bytes, style_bytes, alpha=alpha)
+        diff = (to_tensor(image) - to_tensor(expected)).abs().max().item()
+        assert diff <= 1 / 255 + 1e-6
+    feat = results[0][1]
+    assert feat.shape[0] == 1 and feat.untyped_storage().nbytes() == feat.nelement() * feat.element_size()
+
+
+def test_tiled_inference_matches_untiled():
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    style_bytes = read_image("test_images/style/monet.jpg")
+    expected = to_tensor(process_images(net, content_bytes, style_bytes, image_size=256))
+
+    # A single tile covering the image is the untiled computation
+    single = to_tensor(process_images(net, content_bytes, style_bytes, image_size=256, tile_size=512))
+    assert (single - expected).abs().max().item() <= 1 / 255 + 1e-6
+
+    tiled = to_tensor(process_images(net, content_bytes, style_bytes, image_size=256, tile_size=128, tile_overlap=32))
+    assert tiled.shape == expected.shape
+    assert (tiled - expected).abs().mean().item() < 0.02
+
+    # Sizes off the 8 pixel grid are rounded up; every tile is encoded once
+    encode = net.encode
+    calls = []
+    net.encode = lambda x: calls.append(x.shape) or encode(x)
+    odd = to_tensor(process_images(net, content_bytes, style_bytes, image_size=256, tile_size=125, tile_overlap=30))
+    assert odd.shape == expected.shape
+    assert (odd - expected).abs().mean().item() < 0.02
+    # 256x256 in 128px tiles with a stride of 96: 3 x 3 tiles, plus the style image
+    assert len(calls) == 10
+
+
+def test_sweep_and_gallery_jobs_use_tiles():
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    style_bytes = read_image("test_images/style/monet.jpg")
+    style_stats = extract_features(net, content_bytes, style_bytes, image_size=256)[1]
+    expected, _ = run_style_transfer(net, content_bytes, None, (0.5, 1.0), False, style_stats, image_size=256)
+    encode = net.encode
+    calls = []
+    net.encode = lambda x: calls.append(x.shape[-2:]) or encode(x)
+
+    # Both alphas are decoded from one encode of the 3 x 3 tiles
+    outputs, content_feat = run_style_transfer(net, content_bytes, None, (0.5, 1.0), False, style_stats,
+                                               image_size=256, tiling=(128, 32))
+    assert content_feat is None and len(calls) == 9 and all(max(shape) <= 128 for shape in calls)
+    for output, reference in zip(outputs, expected):
+        diff = to_tensor(Image.open(output)) - to_tensor(Image.open(reference))
+        assert diff.abs().mean().item() < 0.02
+
+    calls.clear()
+    outputs, content_feat = run_gallery([(net, style_stats), (net, style_stats)], content_bytes, 1.0,
+                                        image_size=256, tiling=(128, 32))
+    assert content_feat is None and len(calls) == 9 and all(max(shape) <= 128 for shape in calls)
+    assert outputs[0].getvalue() == outputs[1].getvalue()
+    diff = to_tensor(Image.open(outputs[0])) - to_tensor(Image.open(expected[1]))
+    assert diff.abs().mean().item() < 0.02
+
+
+def test_process_executor_matches_in_process_job():
+    net = make_net()
+    content_bytes = read_image("test_images/content/dancing.jpg")
+    style_bytes = read_image("test_images/style/monet.jpg")
+    expected, expected_feat = run_style_transfer(net, content_bytes, style_bytes, (0.5, 1.0), False,
+                                                 image_size=128)
+
+    executor = ProcessInferenceExecutor({'net': net, 'style_cache': StyleFeatureCache()}, max_workers=1,
+                                        threads_per_worker=1)
+    try:
+        assert all(param.is_shared() for param in net.parameters())
+        outputs, content_feat = executor.submit(run_style_transfer, net, content_bytes, style_bytes, (0.5, 1.0),
+                                                False, style_cache=StyleFeatureCache(), image_size=128).result()
+    finally:
+        executor.shutdown()
+    assert [output.getvalue() for output in outputs] == [output.getvalue() for output in expected]
+    torch.testing.assert_close(content_feat, expected_feat)
+
+
+def test_coral_matches_svd_reference():
+    style = load_image(read_image("test_images/style/van_gogh.jpg"))
+    contents = [load_image(read_image("test_images/content/dancing.jpg"), size) for size in (512, 384)]
+    for content in contents:
+        expected = coral_svd(style, content)
+        result = coral(style, content)
+        assert (result - expected).abs().max() < 0.02
+        assert (result - expected).abs().mean() < 0.002
+
+    # Batched with cached style statistics, each image as on its own
+    styles = torch.stack([style, style.flip(-1)])
+    targets = torch.stack([contents[1], contents[1].flip(-2)])
+    batched = coral_batch(styles, targets, source_stats=color_stats(styles))
+    for i in range(2):
+        torch.testing.assert_close(batched[i], coral(styles[i], targets[i]), rtol=1e-4, atol=1e-4)
+
+
+def test_fused_adain_matches_reference():
+    torch.manual_seed(0)
+    content = torch.rand(3, 512, 12, 16) * 4
+    style = torch.rand(3, 512, 10, 10) * 2 + 1
+
+    # Batched statistics, as two separate passes
+    mean, std = calc_mean_std(content)
+    flat = content.view(3, 512, -1)
+    torch.testing.assert_close(mean, flat.mean(dim=2).view(3, 512, 1, 1))
+    torch.testing.assert_close(std, (flat.var(dim=2) + 1e-5).sqrt().view(3, 512, 1, 1))
+
+    style_stats = calc_mean_std(style)
+    normalized = (content - mean.expand_as(content)) / std.expand_as(content)
+    adain = normalized * style_stats[1].expand_as(content) + style_stats[0].expand_as(content)
+    torch.testing.assert_close(adaptive_instance_normalization(content, style), adain, rtol=1e-4, atol=1e-4)
+
+    alpha = torch.tensor([0.0, 0.3, 1.0]).view(-1, 1, 1, 1)
+    expected = adain * alpha + content * (1 - alpha)
+    torch.testing.assert_close(blend_features(content, style_stats, alpha), expected, rtol=1e-4, atol=1e-4)
+    expected = adain * 0.6 + content * 0.4
+    blended = blend_features(content.clone(), style_stats, 0.6)
+    torch.testing.assert_close(blended, expected, rtol=1e-4, atol=1e-4)
+
+    # In place, the content features are reused for the result
+    result = blend_features(content, style_stats, 0.6, inplace=True)
+    assert result.data_ptr() == content.data_ptr()
+    torch.testing.assert_close(result, blended)
@@ -0,0 +1,167 @@
+import threading
+
+import pytest
+import torch
+import torch.nn as nn
+
+from benchmarks.common import write_random_weights
+from model.adain_net import Decoder, VGG, Net
+from model.adain_utils import get_device
+from utils.functional import (NET_NAMES, build_inference_decoder, build_inference_encoder, build_inference_net,
+                              init_model, load_decoder)
+from utils.model_registry import ModelRegistry
+from utils.backends import apply_backend, export_module, warm_up
+from utils.precision import apply_precision
+from utils.weights import convert_to_safetensors
+
+
+def make_modules():
+    torch.manual_seed(0)
+    vgg = VGG()
+    decoder = Decoder()
+    # Non-trivial biases, so that folding them is tested as well
+    for module in list(vgg.modules()) + list(decoder.modules()):
+        if isinstance(module, nn.Conv2d):
+            nn.init.normal_(module.bias, std=0.1)
+    return vgg, decoder
+
+
+def test_inference_encoder_matches_vgg():
+    vgg, _ = make_modules()
+    encoder = build_inference_encoder(vgg)
+    reference = nn.Sequential(*list(vgg.model.children())[:31]).eval()
+
+    assert sum(isinstance(layer, nn.ReflectionPad2d) for layer in encoder) == 0
+    assert len([layer for layer in encoder if isinstance(layer, nn.Conv2d)]) == 9
+
+    x = torch.rand(2, 3, 72, 88)
+    with torch.no_grad():
+        torch.testing.assert_close(encoder(x), reference(x), rtol=1e-4, atol=1e-4)
+
+
+def test_inference_net_matches_net():
+    vgg, decoder = make_modules()
+    net = Net(nn.Sequential(*list(vgg.model.children())[:31]), decoder).eval()
+    lean = build_inference_net(net)
+    assert not hasattr(lean, 'mse_loss')
+
+    x = torch.rand(1, 3, 64, 96)
+    feat = torch.rand(1, 512, 8, 12)
+    with torch.no_grad():
+        torch.testing.assert_close(lean.encode(x), net.encode(x), rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(lean.decoder(feat), net.decoder(feat), rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(build_inference_decoder(decoder)(feat), decoder(feat), rtol=1e-4, atol=1e-4)
+
+
+def test_precision_modes_stay_close_to_fp32():
+    vgg, decoder = make_modules()
+    lean = build_inference_net(Net(nn.Sequential(*list(vgg.model.children())[:31]), decoder).eval())
+    calibration = [torch.rand(1, 3, 64, 64) for _ in range(4)]
+    nets = apply_precision({'net': lean, 'net_bf16': lean},
+                           {'encoder': 'int8', 'net': 'int8', 'net_bf16': 'bf16'},
+                           calibration_images=calibration)
+
+    x = torch.rand(1, 3, 64, 64)
+    with torch.no_grad():
+        feat = lean.encode(x)
+        expected = lean.decoder(feat)
+        assert nets['net'].encode(x).shape == feat.shape
+        assert (nets['net'].encode(x) - feat).abs().mean() < 0.1 * feat.abs().mean()
+        for name in ('net', 'net_bf16'):
+            output = nets[name].decoder(feat)
+            assert output.dtype == torch.float32
+            assert (output - expected).abs().mean() < 0.1 * expected.abs().mean()
+    assert get_device(nets['net']).type == 'cpu'
+
+
+def test_torchscript_backend_matches_eager(tmp_path):
+    vgg, decoder = make_modules()
+    lean = build_inference_net(Net(nn.Sequential(*list(vgg.model.children())[:31]), decoder).eval())
+    export_module(lean.encoder, 'encoder', 'torchscript', torch.rand(1, 3, 32, 32), str(tmp_path))
+    export_module(lean.decoder, 'net', 'torchscript', torch.rand(1, 512, 4, 4), str(tmp_path))
+    scripted = apply_backend({'net': lean}, 'torchscript', str(tmp_path))['net']
+    warm_up([scripted], [32])
+
+    x = torch.rand(1, 3, 48, 64)
+    with torch.no_grad():
+        torch.testing.assert_close(scripted.encode(x), lean.encode(x))
+        feat = lean.encode(x)
+        torch.testing.assert_close(scripted.decoder(feat), lean.decoder(feat))
+
+
+def test_model_registry_loads_lazily(tmp_path):
+    write_random_weights(str(tmp_path))
+    eager = dict(zip(NET_NAMES, init_model(weights_dir=str(tmp_path))))
+    models = ModelRegistry(optimize=True, max_loaded=2, pinned=('net',), weights_dir=str(tmp_path))
+    assert models.loaded() == ['net']
+
+    x = torch.rand(1, 3, 64, 64)
+    with torch.no_grad():
+        feat = eager['net'].encode(x)
+        torch.testing.assert_close(models['net'].encode(x), feat, rtol=1e-4, atol=1e-4)
+        for name in ('net_monet', 'net_picasso'):
+            torch.testing.assert_close(models[name].decoder(feat), eager[name].decoder(feat), rtol=1e-4, atol=1e-4)
+    # The pinned network stays, the least recently used one is dropped
+    assert models.loaded() == ['net', 'net_picasso']
+
+    # Other settings or weights give another fingerprint
+    fingerprint = models.fingerprint()
+    assert ModelRegistry(optimize=False, weights_dir=str(tmp_path)).fingerprint() != fingerprint
+    write_random_weights(str(tmp_path))
+    assert models.fingerprint() != fingerprint
+
+
+def test_model_registry_loads_without_blocking_lookups(tmp_path):
+    write_random_weights(str(tmp_path))
+    models = ModelRegistry(pinned=('net',), weights_dir=str(tmp_path))
+    loading, release = threading.Event(), threading.Event()
+    load = models._load
+    loads = []
+
+    def slow_load(name):
+        loads.append(name)
+        loading.set()
+        release.wait(5)
+        return load(name)
+
+    models._load = slow_load
+    loaders = [threading.Thread(target=models.get, args=('net_monet',)) for _ in range(2)]
+    for thread in loaders:
+        thread.start()
+    assert loading.wait(5)
+    # Lookups and other networks do not wait for the load in progress
+    assert models.is_loaded('net') and not models.is_loaded('net_monet')
+    assert models.get('net') is not None
+    release.set()
+    for thread in loaders:
+        thread.join()
+    # The second request waited for the first load instead of loading again
+    assert loads == ['net_monet']
+    assert models.loaded() == ['net', 'net_monet']
+
+
+def test_model_registry_warms_up_compiled_decoders_on_load(tmp_path, monkeypatch):
+    write_random_weights(str(tmp_path))
+    warmed = []
+    monkeypatch.setattr('utils.model_registry.warm_up', lambda nets, sizes: warmed.append(sizes))
+    models = ModelRegistry(pinned=('net',), weights_dir=str(tmp_path), warmup_sizes=[32])
+    models.get('net_monet')
+    # Eager decoders loaded on demand are not warmed up, compiled ones are
+    assert len(warmed) == 1
+    models = ModelRegistry(backend='compile', pinned=(), weights_dir=str(tmp_path), warmup_sizes=[32])
+    models.get('net_monet')
+    assert warmed == [(32,), (32,)]
+
+
+def test_safetensors_weights_are_preferred(tmp_path):
+    save_file = pytest.importorskip('safetensors.torch').save_file
+    write_random_weights(str(tmp_path))
+    path = convert_to_safetensors(str(tmp_path / 'decoder_monet.pth'))
+    decoder = load_decoder('net_monet', weights_dir=str(tmp_path))
+    reference = torch.load(tmp_path / 'decoder_monet.pth', weights_only=True)
+    torch.testing.assert_close(decoder.state_dict(), reference)
+
+    # Different weights in the .safetensors file win over the .pth file
+    save_file({key: value + 1 for key, value in reference.items()}, path)
+    decoder = load_decoder('net_monet', weights_dir=str(tmp_path))
+    torch.testing.assert_close(decoder.model[1].weight, reference['model.1.weight'] + 1)
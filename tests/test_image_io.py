@@ -0,0 +1,42 @@
+from collections import namedtuple
+from io import BytesIO
+
+import pytest
+from PIL import Image
+from torchvision import transforms
+
+from utils.image_io import ImageTooLargeError, load_image, open_image, select_photo_size
+
+PhotoSize = namedtuple('PhotoSize', ['width', 'height'])
+
+
+def read_large_jpeg():
+    with open("test_images/content/dancing.jpg", "rb") as f:
+        image = Image.open(BytesIO(f.read())).convert("RGB").resize((2048, 1536))
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def test_draft_decode_matches_full_decode():
+    data = read_large_jpeg()
+    assert open_image(data, 512).size == (1024, 768)
+
+    full = transforms.Compose([transforms.Resize(512), transforms.ToTensor()])(Image.open(BytesIO(data)))
+    fast = load_image(data)
+    assert fast.shape == full.shape == (3, 512, 682)
+    assert (fast - full).abs().mean() < 0.01
+
+
+def test_oversized_images_are_rejected():
+    buffer = BytesIO()
+    Image.new('RGB', (300, 200)).save(buffer, format='PNG')
+    with pytest.raises(ImageTooLargeError):
+        open_image(buffer.getvalue(), max_pixels=300 * 200 - 1)
+
+
+def test_select_photo_size():
+    sizes = [PhotoSize(90, 67), PhotoSize(320, 240), PhotoSize(800, 600), PhotoSize(1280, 960)]
+    assert select_photo_size(sizes, 512) == PhotoSize(800, 600)
+    assert select_photo_size(sizes, 240) == PhotoSize(320, 240)
+    assert select_photo_size(sizes, 2048) == PhotoSize(1280, 960)
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils.batching import MicroBatcher
+from utils.inference import InferenceExecutor, QueueFullError
+from utils.updates import PerUserUpdateProcessor
+
+
+def test_executor_runs_jobs():
+    executor = InferenceExecutor(max_workers=2, max_queue=2)
+    result = asyncio.run(executor.run(sum, [1, 2, 3]))
+    assert result == 6
+    assert executor.pending == 0
+    executor.shutdown()
+
+
+def test_executor_rejects_when_full():
+    executor = InferenceExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    waiting = executor.submit(release.wait)
+    assert executor.queued == 1
+
+    with pytest.raises(QueueFullError):
+        executor.submit(release.wait)
+
+    release.set()
+    running.result()
+    waiting.result()
+    assert executor.pending == 0
+    executor.submit(sum, [1]).result()
+    executor.shutdown()
+
+
+def test_micro_batcher_groups_jobs_by_key():
+    calls = []
+
+    def batch_fn(net, items):
+        calls.append((net, items))
+        return [item * 10 for item in items]
+
+    async def main():
+        executor = InferenceExecutor(max_workers=1, max_queue=4)
+        batcher = MicroBatcher(executor, batch_fn, max_batch_size=2, max_wait_ms=20)
+        results = await asyncio.gather(
+            batcher.submit("a", "net_a", 1),
+            batcher.submit("b", "net_b", 2),
+            batcher.submit("a", "net_a", 3),
+        )
+        executor.shutdown()
+        return results, batcher.metrics()
+
+    results, metrics = asyncio.run(main())
+    assert results == [10, 20, 30]
+    assert sorted((net, items) for net, items in calls) == [("net_a", [1, 3]), ("net_b", [2])]
+    assert metrics['batches'] == 2 and metrics['jobs'] == 3
+    assert metrics['fill_rate'] == 0.75
+
+
+def test_updates_are_serialized_per_user():
+    class Update:
+        def __init__(self, user_id):
+            self.effective_user = type('User', (), {'id': user_id})()
+
+    events = []
+
+    async def handle(name, delay):
+        events.append(f"start {name}")
+        await asyncio.sleep(delay)
+        events.append(f"end {name}")
+
+    async def main():
+        processor = PerUserUpdateProcessor()
+        await asyncio.gather(
+            processor.process_update(Update(1), handle('1a', 0.05)),
+            processor.process_update(Update(1), handle('1b', 0)),
+            processor.process_update(Update(2), handle('2a', 0))
+        )
+        return processor
+
+    processor = asyncio.run(main())
+    # The second user is not held up by the first; the first user's updates keep their order
+    assert events == ['start 1a', 'start 2a', 'end 2a', 'end 1a', 'start 1b', 'end 1b']
+    assert not processor._users
@@ -0,0 +1,57 @@
+import urllib.request
+
+from PIL import Image
+
+from utils.inference import InferenceExecutor
+from utils.jobs import encode_jpeg
+from utils.metrics import JobTrace, Metrics, collect_stages, stage, start_metrics_server
+
+
+def test_stages_are_collected_from_worker_jobs():
+    def job():
+        with stage('load_image'):
+            pass
+        return encode_jpeg(Image.new('RGB', (64, 64)))
+
+    executor = InferenceExecutor()
+    buffer, stages = executor.submit(collect_stages, job).result()
+    executor.shutdown()
+    assert buffer.getvalue()[:2] == b'\xff\xd8'
+    assert set(stages) == {'load_image', 'jpeg'}
+
+    # Outside collect_stages the marks record nothing
+    with stage('load_image'):
+        pass
+
+
+def test_job_trace_feeds_histograms():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    trace = JobTrace(metrics, user_id='1', mode='standard', decoder='net')
+    trace.add('download', 0.05)
+    trace.add_worker_stages({'encode': 0.5, 'decode': 2.0}, elapsed=3.0)
+    trace.finish()
+
+    assert trace.stages['queue'] == 0.5
+    assert metrics.histogram('style_job_stage_seconds', stage='decode', mode='standard', decoder='net') == \
+        {'count': 1, 'sum': 2.0}
+    assert metrics.histogram('style_job_seconds', status='ok', mode='standard', decoder='net')['count'] == 1
+
+    text = metrics.render()
+    assert 'style_job_stage_seconds_bucket{decoder="net",mode="standard",stage="decode",le="1.0"} 0' in text
+    assert 'style_job_stage_seconds_bucket{decoder="net",mode="standard",stage="decode",le="+Inf"} 1' in text
+
+
+def test_metrics_endpoint_serves_gauges():
+    metrics = Metrics()
+    metrics.inc('jobs_total', help="Jobs run")
+    metrics.gauge('queue_depth', lambda: 3)
+    server = start_metrics_server(metrics, port=0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        text = urllib.request.urlopen(url, timeout=5).read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert '# HELP jobs_total Jobs run' in text
+    assert 'jobs_total 1' in text
+    assert 'queue_depth 3' in text
@@ -0,0 +1,44 @@
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from utils.profiling import Profiler, profile_job
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profile_job_writes_chrome_trace_and_rotates(tmp_path):
+    profiler = Profiler(trace_dir=str(tmp_path), max_traces=2)
+    conv = nn.Conv2d(3, 8, 3)
+    for _ in range(3):
+        output = profile_job(profiler.trace_path('conv'), conv, torch.rand(1, 3, 32, 32))
+    assert output.shape == (1, 8, 30, 30)
+
+    traces = profiler.traces()
+    assert len(traces) == 2
+    with open(traces[-1] + '.json') as f:
+        assert json.load(f)['traceEvents']
+    with open(traces[-1] + '.txt') as f:
+        assert 'convolution' in f.read()
+
+
+def test_python_sampler_records_handler_stacks(tmp_path):
+    profiler = Profiler(trace_dir=str(tmp_path), python_interval_ms=1)
+    with profiler.python_trace('handler') as sampler:
+        busy_loop(0.1)
+    assert sampler.samples
+
+    stem, = profiler.traces()
+    with open(stem + '.json') as f:
+        events = json.load(f)['traceEvents']
+    assert any(event['ph'] == 'X' and event['name'].startswith('busy_loop') for event in events)
+    with open(stem + '.folded') as f:
+        assert 'busy_loop (test_profiling.py' in f.read()
+    assert os.path.basename(stem).endswith('_handler')
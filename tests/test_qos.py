@@ -0,0 +1,25 @@
+from utils.qos import ResolutionPolicy
+
+
+def test_policy_uses_max_size_without_history():
+    policy = ResolutionPolicy(min_size=256, max_size=512, latency_target=4.0)
+    assert policy.choose(queue_depth=10) == 512
+
+
+def test_policy_degrades_with_queue_depth():
+    policy = ResolutionPolicy(min_size=256, max_size=512, latency_target=4.0, step=64)
+    policy.record(512, 2.0)
+
+    assert policy.choose(queue_depth=0) == 512
+    assert policy.choose(queue_depth=1) == 512
+    assert policy.choose(queue_depth=2) == 384
+    assert policy.choose(queue_depth=100) == 256
+
+    # Jobs that are not a cost sample are only counted
+    cost = policy.cost
+    policy.record(256)
+    assert policy.cost == cost
+
+    policy.timed(384, lambda: None)
+    usage = policy.usage()
+    assert usage['jobs'] == 3 and usage['degraded'] == 2
@@ -0,0 +1,49 @@
+import asyncio
+
+from utils.result_cache import ResultCache
+
+
+def test_result_cache_quantizes_alpha_and_evicts_lru(tmp_path):
+    cache = ResultCache(max_bytes=10, disk_dir=str(tmp_path), disk_max_bytes=100)
+    key = cache.make_key(b'content', b'style', 'standard', [0.51], 'net')
+    assert key == cache.make_key(b'content', b'style', 'standard', [0.5], 'net')
+    assert key != cache.make_key(b'content', 'Monet', 'selected_style', [0.5], 'net_monet')
+    assert key != ResultCache(model_version='int8').make_key(b'content', b'style', 'standard', [0.5], 'net')
+
+    cache.put(key, [b'aaaaaa'])
+    cache.put('other', [b'bbbbbb'])
+    cache.close()
+    assert len(cache) == 1
+    # Evicted from memory, but still on disk; a new instance finds it there too
+    assert cache.get(key) == [b'aaaaaa']
+    restarted = ResultCache(disk_dir=str(tmp_path))
+    assert asyncio.run(restarted.lookup('other')) == [b'bbbbbb']
+    restarted.close()
+    assert cache.usage()['disk_hits'] == 1
+
+
+def test_identical_requests_share_one_computation():
+    cache = ResultCache()
+    computed = []
+
+    async def request(fail=False):
+        outputs = await cache.claim('key')
+        if outputs is not None:
+            return outputs
+        await asyncio.sleep(0.01)
+        computed.append(fail)
+        if fail:
+            cache.release('key')
+            return None
+        outputs = [b'result']
+        cache.put('key', outputs)
+        cache.release('key', outputs)
+        return outputs
+
+    async def main():
+        # The first request fails, one waiter takes over and the other shares its result
+        return await asyncio.gather(request(fail=True), request(), request())
+
+    assert asyncio.run(main()) == [None, [b'result'], [b'result']]
+    assert computed == [True, False]
+    assert cache.shared == 1
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from PIL import Image
+
+from utils.retention import RetentionManager
+from utils.user_storage import BlobStore, save_user_images
+
+NOW = datetime(2025, 6, 1, 12, 0, 0)
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_manifest(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def jpeg(color, size=(512, 384)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def save(store, user_id, days_ago, content, style=b"preset style"):
+    return save_user_images(user_id, content, style, jpeg((days_ago * 10 % 255, 0, 0)), blob_store=store,
+                            created=NOW - timedelta(days=days_ago))
+
+
+def test_policies_delete_old_results_and_unused_blobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = BlobStore()
+    for days_ago in (1, 2, 3, 40):
+        save(store, "1", days_ago, f"content {days_ago}".encode())
+    save(store, "2", 1, b"content 1")
+
+    manager = RetentionManager(blob_store=store, max_age_days=30, max_results_per_user=2)
+    result = manager.run(now=NOW.timestamp())
+    assert result['deleted'] == 2
+    assert len(os.listdir("user_data/1")) == 2
+
+    usage = manager.usage()
+    assert usage["1"]['results'] == 2 and usage["2"]['results'] == 1
+    # Contents of the deleted results are gone, the shared style is kept
+    assert not os.path.exists(store.path(digest(b"content 40")))
+    assert os.path.exists(store.path(digest(b"preset style")))
+    assert result['bytes'] == sum(os.path.getsize(os.path.join(root, name))
+                                  for root, _, names in os.walk(store.root) for name in names)
+    manager.close()
+
+
+def test_thumbnails_and_disk_budget(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = BlobStore()
+    old = save(store, "1", 10, b"old content")
+    save(store, "1", 0, b"new content")
+
+    manager = RetentionManager(blob_store=store, thumbnail_after_days=7)
+    before = manager.usage()["1"]['bytes']
+    assert manager.run(now=NOW.timestamp())['thumbnailed'] == 1
+    assert manager.usage()["1"]['bytes'] < before
+    thumbnail = Image.open(BytesIO(store.get(read_manifest(old)['output'])))
+    assert max(thumbnail.size) == 256
+
+    # A budget below the current usage drops the oldest result first
+    manager.max_total_mb = (manager.total_bytes() - 1) / (1024 * 1024)
+    manager.run(now=NOW.timestamp())
+    assert not os.path.exists(old)
+    assert manager.usage()["1"]['results'] == 1
+    manager.close()
@@ -0,0 +1,99 @@
+import json
+import threading
+from io import BytesIO
+
+from utils.user_storage import (ArtifactWriter, BlobStore, SQLiteBackend, UserStore, get_user_settings,
+                                load_user_data, migrate_json, update_user_settings)
+
+
+def test_json_settings_are_migrated_once(tmp_path):
+    json_path = tmp_path / "user_preferences.json"
+    json_path.write_text(json.dumps({"1": {"lang": "ru", "alpha": 0.5}, "2": {"lang": "en"}}), encoding="utf-8")
+    db_path = str(tmp_path / "user_preferences.db")
+
+    store = load_user_data(db_path, str(json_path), flush_interval=0)
+    assert get_user_settings(store, 1) == {"lang": "ru", "alpha": 0.5}
+    assert get_user_settings(store, "3") == {}
+    assert not json_path.exists() and (tmp_path / "user_preferences.json.migrated").exists()
+    store.close()
+
+    # A reappearing JSON file does not overwrite a populated store
+    json_path.write_text(json.dumps({"1": {"lang": "en"}}), encoding="utf-8")
+    backend = SQLiteBackend(db_path)
+    assert migrate_json(str(json_path), backend) == 0
+    assert backend.get("1") == {"lang": "ru", "alpha": 0.5}
+    backend.close()
+
+
+def test_updates_are_written_behind(tmp_path):
+    db_path = str(tmp_path / "user_preferences.db")
+    store = UserStore(SQLiteBackend(db_path), flush_interval=60)
+    update_user_settings(store, 1, {"lang": "en"})
+    update_user_settings(store, 1, {"alpha": 0.3})
+
+    # Served from memory before the flush
+    assert get_user_settings(store, 1) == {"lang": "en", "alpha": 0.3}
+    assert store.backend.get("1") is None
+    get_user_settings(store, 1)["alpha"] = 1.0
+    assert get_user_settings(store, 1)["alpha"] == 0.3
+
+    store.close()
+    reopened = UserStore(SQLiteBackend(db_path), flush_interval=0)
+    assert get_user_settings(reopened, 1) == {"lang": "en", "alpha": 0.3}
+    reopened.close()
+
+
+def test_cache_drops_only_clean_entries(tmp_path):
+    store = UserStore(SQLiteBackend(str(tmp_path / "user_preferences.db")), flush_interval=60, max_cached=2)
+    for uid in range(4):
+        update_user_settings(store, uid, {"alpha": uid / 10})
+    assert len(store._cache) == 4
+    store.flush()
+    assert len(store._cache) == 2
+    assert get_user_settings(store, 3) == {"alpha": 0.3}
+    store.close()
+
+
+def test_backend_reads_do_not_block_cached_users(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "user_preferences.db"))
+    backend.put_many({"1": {"lang": "ru"}})
+    store = UserStore(backend, flush_interval=60)
+    update_user_settings(store, 2, {"lang": "en"})
+
+    reading, release = threading.Event(), threading.Event()
+    backend_get = backend.get
+
+    def slow_get(uid):
+        reading.set()
+        release.wait(5)
+        return backend_get(uid)
+
+    backend.get = slow_get
+    reader = threading.Thread(target=get_user_settings, args=(store, 1))
+    reader.start()
+    assert reading.wait(5)
+    # While user 1 is read from the database, cached user 2 is served
+    assert get_user_settings(store, 2) == {"lang": "en"}
+    release.set()
+    reader.join()
+    assert get_user_settings(store, 1) == {"lang": "ru"}
+    store.close()
+
+
+def test_writer_dedupes_images_by_content(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    style = b"style image"
+    writer = ArtifactWriter(BlobStore(str(tmp_path / "blobs")))
+    for content in (b"first photo", b"second photo"):
+        assert writer.submit("7", content, style, BytesIO(b"output " + content),
+                             extra_outputs={"alpha_0.5": BytesIO(b"preview")})
+    writer.close()
+
+    manifests = sorted((tmp_path / "user_data" / "7").glob("result_*.json"))
+    assert len(manifests) == 2
+    first, second = [json.loads(path.read_text(encoding="utf-8")) for path in manifests]
+    assert first['style'] == second['style'] and first['content'] != second['content']
+    assert first['extra_outputs'] == second['extra_outputs']
+    assert writer.blob_store.get(second['output']) == b"output second photo"
+    # Two contents, two outputs, one style and one preview
+    assert len(list((tmp_path / "blobs").glob("*/*.jpg"))) == 6
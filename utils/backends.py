@@ -0,0 +1,108 @@
+import os
+
+import torch
+import torch.nn as nn
+
+from model.adain_utils import get_device
+from utils.functional import InferenceNet
+
+BACKENDS = ('eager', 'compile', 'torchscript', 'onnx')
+
+EXPORT_DIR = "model_weights/exported"
+
+
+class OnnxModule(nn.Module):
+    """Runs an exported ONNX graph with onnxruntime on the CPU."""
+    def __init__(self, path):
+        super(OnnxModule, self).__init__()
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx backend requires the onnxruntime package") from e
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        output = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+
+def artifact_path(name, backend, export_dir=EXPORT_DIR):
+    """Path of the exported `name` module (e.g. 'encoder', 'net_monet') for a backend"""
+    extension = {'torchscript': 'pt', 'onnx': 'onnx'}[backend]
+    return os.path.join(export_dir, f"{name}.{extension}")
+
+
+def export_module(module, name, backend, example_input, export_dir=EXPORT_DIR):
+    """
+    Export a module for the torchscript or onnx backend.
+
+    Batch size and spatial dimensions stay dynamic. Returns the artifact path.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    path = artifact_path(name, backend, export_dir)
+    module = module.cpu().eval()
+    example_input = example_input.cpu()
+    with torch.no_grad():
+        if backend == 'torchscript':
+            torch.jit.save(torch.jit.trace(module, example_input), path)
+        elif backend == 'onnx':
+            torch.onnx.export(module, (example_input,), path, input_names=['input'], output_names=['output'],
+                              dynamic_axes={'input': {0: 'batch', 2: 'height', 3: 'width'},
+                                            'output': {0: 'batch', 2: 'height', 3: 'width'}},
+                              dynamo=False)
+        else:
+            raise ValueError(f"Backend {backend!r} has no export step")
+    return path
+
+
+def load_backend_module(module, name, backend, export_dir=EXPORT_DIR):
+    """Return `module` wrapped or replaced by the given backend"""
+    if backend == 'eager':
+        return module
+    if backend == 'compile':
+        return torch.compile(module, dynamic=True)
+    path = artifact_path(name, backend, export_dir)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, run `python export_model.py --backend {backend}` first")
+    if backend == 'torchscript':
+        return torch.jit.load(path, map_location=get_device(module)).eval()
+    if backend == 'onnx':
+        return OnnxModule(path)
+    raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+
+
+def apply_backend(nets, backend, export_dir=EXPORT_DIR):
+    """
+    Run the encoder and decoders of InferenceNets on the given backend.
+
+    Args:
+        nets: dict of name -> InferenceNet, all sharing one encoder
+        backend: one of BACKENDS
+
+    Returns:
+        dict of name -> InferenceNet
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    if backend == 'eager':
+        return nets
+    encoder = load_backend_module(next(iter(nets.values())).encoder, 'encoder', backend, export_dir)
+    return {name: InferenceNet(encoder, load_backend_module(net.decoder, name, backend, export_dir)).eval()
+            for name, net in nets.items()}
+
+
+def warm_up(nets, sizes):
+    """
+    Run every network once per resolution bucket so that compilation and
+    allocator warm-up do not hit the first users. Both orientations of a
+    4:3 photo with the given shorter side are used.
+    """
+    for size in sizes:
+        for shape in ((size, size * 4 // 3), (size * 4 // 3, size)):
+            image = torch.zeros(1, 3, *shape)
+            with torch.no_grad():
+                for net in nets:
+                    image = image.to(get_device(net))
+                    net.decoder(net.encode(image))
@@ -0,0 +1,68 @@
+import asyncio
+
+
+class MicroBatcher:
+    """
+    Collects concurrent inference jobs and runs them as batches.
+
+    Jobs are grouped by a key (e.g. target network and input shape). A group
+    is sent to the executor as one call of batch_fn(net, items) as soon as it
+    holds max_batch_size jobs or its oldest job has waited max_wait_ms.
+    batch_fn must return one result per item, in order; each result is
+    delivered to the coroutine that submitted the item.
+    """
+    def __init__(self, executor, batch_fn, max_batch_size=4, max_wait_ms=10):
+        assert max_batch_size >= 1
+        self.executor = executor
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.jobs = 0
+        self._groups = {}
+        self._timers = {}
+        self._tasks = set()
+
+    async def submit(self, key, net, item):
+        """Queue an item for batched processing and await its result."""
+        future = asyncio.get_running_loop().create_future()
+        group = self._groups.setdefault(key, (net, []))[1]
+        group.append((item, future))
+        if len(group) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        net, group = self._groups.pop(key, (None, []))
+        while group:
+            batch, group = group[:self.max_batch_size], group[self.max_batch_size:]
+            task = asyncio.ensure_future(self._run(net, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, net, batch):
+        futures = [future for _, future in batch]
+        try:
+            results = await self.executor.run(self.batch_fn, net, [item for item, _ in batch])
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.jobs += len(batch)
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    def metrics(self):
+        """Return batch counters and the mean batch fill rate."""
+        fill_rate = self.jobs / (self.batches * self.max_batch_size) if self.batches else 0.0
+        return {'batches': self.batches, 'jobs': self.jobs,
+                'mean_batch_size': self.jobs / self.batches if self.batches else 0.0,
+                'fill_rate': fill_rate}
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from utils.image_io import IMAGE_SIZE
+
+
+def _tensors_nbytes(tensors):
+    return sum(t.element_size() * t.nelement() for t in tensors)
+
+
+class StyleFeatureCache:
+    """
+    LRU cache of relu4_1 style statistics keyed by the style image content.
+
+    Entries are evicted least recently used first once their total size
+    exceeds max_bytes. Hit and miss counters are kept for monitoring.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(style_bytes, preserve_colors=False, content_bytes=None, size=IMAGE_SIZE):
+        """
+        Build the cache key of a style image.
+
+        In color-preserving mode the style is CORAL-matched to the content
+        image before encoding, so the content bytes are part of the key.
+        """
+        digest = hashlib.sha256(style_bytes)
+        digest.update(f"|{size}|{int(preserve_colors)}".encode())
+        if preserve_colors:
+            digest.update(hashlib.sha256(content_bytes).digest())
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # A copy sent to a worker process starts as an empty cache of its own
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def get(self, key):
+        """Return the cached (mean, std) pair or None."""
+        with self._lock:
+            stats = self._entries.get(key)
+            if stats is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return stats
+
+    def put(self, key, stats):
+        """Store a (mean, std) pair, evicting old entries if needed."""
+        stats = tuple(stats)
+        nbytes = _tensors_nbytes(stats)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= _tensors_nbytes(old)
+            self._entries[key] = stats
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= _tensors_nbytes(evicted)
+
+    def usage(self):
+        """Return usage counters of the cache."""
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.nbytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class SessionFeatureStore:
+    """
+    Last encoded content image of every user, kept for `ttl` seconds.
+
+    Lets a user re-style the same photo with another alpha or style without
+    encoding it again. At most max_entries sessions are kept; the least
+    recently used one is dropped first.
+    """
+    def __init__(self, ttl=600, max_entries=32):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        expired = [uid for uid, (expires, _) in self._entries.items() if expires <= now]
+        for uid in expired:
+            del self._entries[uid]
+
+    def get(self, user_id):
+        """Return the session dict of a user or None if missing or expired."""
+        with self._lock:
+            self._purge(time.monotonic())
+            item = self._entries.get(str(user_id))
+            if item is None:
+                return None
+            self._entries.move_to_end(str(user_id))
+            return item[1]
+
+    def put(self, user_id, content_bytes, content_feat, style_bytes=None, image_size=IMAGE_SIZE):
+        """
+        Remember the encoded content image (features kept on the CPU) of a
+        user, along with the image size it was encoded at. content_feat may
+        be None, which keeps the photo for re-styling without features.
+        """
+        session = {
+            'content_bytes': bytes(content_bytes),
+            'content_feat': content_feat.detach().cpu() if content_feat is not None else None,
+            'style_bytes': bytes(style_bytes) if style_bytes is not None else None,
+            'image_size': image_size
+        }
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            self._entries.pop(str(user_id), None)
+            self._entries[str(user_id)] = (now + self.ttl, session)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,37 +1,179 @@
+import os
+
 import torch
 import torch.nn as nn
 from model.adain_net import Decoder, VGG, Net
 
+# Names of the networks returned by init_model(), in order
+NET_NAMES = ('net', 'net_picasso', 'net_van_gogh', 'net_monet')
 
-def init_model():
-    """Initialize and load style transfer model"""
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("Using GPU:", torch.cuda.is_available())
-    print("GPU name:", torch.cuda.get_device_name(0) if torch.cuda.is_available() else "None")
-    decoder = Decoder()
+WEIGHTS_DIR = 'model_weights'
+ENCODER_WEIGHTS = 'vgg_normalised.pth'
+DECODER_WEIGHTS = {
+    'net': 'decoder.pth',
+    'net_picasso': 'decoder_picasso.pth',
+    'net_van_gogh': 'decoder_van_gogh.pth',
+    'net_monet': 'decoder_monet.pth'
+}
+
+
+class InferenceNet(nn.Module):
+    """
+    Inference-only counterpart of Net: a lean encoder up to relu4_1 and a
+    decoder, without the training losses. Provides the encode/decoder
+    interface used by model.adain_utils.
+    """
+    def __init__(self, encoder, decoder):
+        super(InferenceNet, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def encode(self, input):
+        return self.encoder(input)
+
+
+def _fold_pointwise_conv(pointwise, conv):
+    """
+    Fold a 1x1 convolution into the following convolution.
+
+    A 1x1 convolution acts on every pixel independently, so it commutes
+    with the reflection padding in between and can be merged into the
+    weights and bias of the next convolution.
+    """
+    assert pointwise.kernel_size == (1, 1) and pointwise.stride == (1, 1)
+    w1 = pointwise.weight[:, :, 0, 0]
+    folded = nn.Conv2d(pointwise.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                       conv.padding, padding_mode=conv.padding_mode)
+    with torch.no_grad():
+        folded.weight.copy_(torch.einsum('omhw,mi->oihw', conv.weight, w1))
+        folded.bias.copy_(conv.bias + torch.einsum('omhw,m->o', conv.weight, pointwise.bias))
+    return folded
+
+
+def _fuse_layers(layers):
+    """
+    Merge ReflectionPad2d + Conv2d pairs into one Conv2d with reflect
+    padding, fold a leading 1x1 convolution into the next convolution and
+    make the ReLUs in-place.
+    """
+    fused = []
+    for layer in layers:
+        if isinstance(layer, nn.Conv2d) and fused and isinstance(fused[-1], nn.ReflectionPad2d):
+            pad = fused.pop().padding
+            assert len(set(pad)) == 1 and layer.padding == (0, 0)
+            conv = nn.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size, layer.stride,
+                             padding=pad[0], padding_mode='reflect', device='meta')
+            # Share the loaded weights instead of copying them
+            conv.weight = layer.weight
+            conv.bias = layer.bias
+            layer = conv
+        if (isinstance(layer, nn.Conv2d) and fused and isinstance(fused[-1], nn.Conv2d)
+                and fused[-1].kernel_size == (1, 1)):
+            layer = _fold_pointwise_conv(fused.pop(), layer)
+        if isinstance(layer, nn.ReLU):
+            layer = nn.ReLU(inplace=True)
+        fused.append(layer)
+    return nn.Sequential(*fused)
+
+
+def _flatten(module):
+    """Leaf layers of (possibly nested) Sequential containers"""
+    for child in module.children():
+        if isinstance(child, nn.Sequential):
+            yield from _flatten(child)
+        else:
+            yield child
+
+
+def build_inference_encoder(vgg):
+    """
+    Build a lean VGG encoder that maps an image to relu4_1.
+
+    Args:
+        vgg: VGG module or a (nested) Sequential of its layers, at least up to relu4_1
+    """
+    layers = list(_flatten(vgg.model if isinstance(vgg, VGG) else vgg))[:31]
+    return _fuse_layers(layers).eval()
+
+
+def build_inference_decoder(decoder):
+    """Build a lean copy of a Decoder with the padding fused into the convolutions."""
+    return _fuse_layers(list(decoder.model.children())).eval()
+
+
+def build_inference_net(net, encoder=None):
+    """
+    Build an InferenceNet from a Net. Pass an already built encoder to share
+    it between networks that use the same VGG weights.
+    """
+    if encoder is None:
+        encoder = build_inference_encoder(nn.Sequential(net.enc_1, net.enc_2, net.enc_3, net.enc_4))
+    device = next(net.parameters()).device
+    return InferenceNet(encoder, build_inference_decoder(net.decoder)).to(device).eval()
+
+
+def get_default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def load_weights(path, device):
+    """
+    Load a state dict without reading the whole file up front.
+
+    A .safetensors file next to `path` (see utils/weights.py) is preferred;
+    otherwise the .pth file is memory-mapped, falling back to a plain load
+    for files in the legacy serialization format.
+    """
+    safetensors_path = os.path.splitext(path)[0] + '.safetensors'
+    if os.path.exists(safetensors_path):
+        try:
+            from safetensors.torch import load_file
+            return load_file(safetensors_path, device=str(device))
+        except ImportError:
+            pass
+    try:
+        return torch.load(path, map_location=device, mmap=True, weights_only=True)
+    except RuntimeError:
+        return torch.load(path, map_location=device)
+
+
+def load_encoder(device=None, weights_dir=WEIGHTS_DIR):
+    """Load the VGG encoder layers up to relu4_1"""
+    device = device or get_default_device()
     vgg = VGG()
+    # assign=True keeps the (memory-mapped) loaded tensors instead of copying them
+    vgg.model.load_state_dict(load_weights(os.path.join(weights_dir, ENCODER_WEIGHTS), device), assign=True)
+    return nn.Sequential(*list(vgg.model.children())[:31]).to(device).eval()
 
-    # Load weights
-    decoder.model.load_state_dict(torch.load('model_weights/decoder.pth', map_location=device))
-    vgg.model.load_state_dict(torch.load('model_weights/vgg_normalised.pth', map_location=device))
 
-    # Configure models
-    vgg = nn.Sequential(*list(vgg.model.children())[:31])
-    vgg.to(device).eval()
-    decoder.to(device).eval()
+def load_decoder(name, device=None, weights_dir=WEIGHTS_DIR):
+    """Load the decoder of one of the NET_NAMES networks"""
+    device = device or get_default_device()
+    decoder = Decoder()
+    state_dict = load_weights(os.path.join(weights_dir, DECODER_WEIGHTS[name]), device)
+    # The base decoder was saved from Decoder.model, the fine-tuned ones from Decoder
+    if all(key.startswith('model.') for key in state_dict):
+        decoder.load_state_dict(state_dict, assign=True)
+    else:
+        decoder.model.load_state_dict(state_dict, assign=True)
+    return decoder.to(device).eval()
 
-    decoder_picasso = Decoder()
-    decoder_van_gogh = Decoder()
-    decoder_monet = Decoder()
 
-    # Load weights for fine-tuned models
-    decoder_picasso.load_state_dict(torch.load('model_weights/decoder_picasso.pth', map_location=device))
-    decoder_van_gogh.load_state_dict(torch.load('model_weights/decoder_van_gogh.pth', map_location=device))
-    decoder_monet.load_state_dict(torch.load('model_weights/decoder_monet.pth', map_location=device))
+def init_model(optimize=False, weights_dir=WEIGHTS_DIR):
+    """
+    Initialize and load style transfer model.
 
-    decoder_picasso.to(device).eval()
-    decoder_van_gogh.to(device).eval()
-    decoder_monet.to(device).eval()
+    With optimize=True, lean InferenceNet graphs sharing one encoder are
+    returned instead of the training Net modules.
+    """
+    device = get_default_device()
+    print("Using GPU:", torch.cuda.is_available())
+    print("GPU name:", torch.cuda.get_device_name(0) if torch.cuda.is_available() else "None")
 
-    return (Net(vgg, decoder).to(device).eval(), Net(vgg, decoder_picasso).to(device).eval(),
-            Net(vgg, decoder_van_gogh).to(device).eval(), Net(vgg, decoder_monet).to(device).eval())
+    # Configure models
+    vgg = load_encoder(device, weights_dir)
+    nets = tuple(Net(vgg, load_decoder(name, device, weights_dir)).to(device).eval() for name in NET_NAMES)
+    if optimize:
+        encoder = build_inference_encoder(vgg).to(device)
+        nets = tuple(build_inference_net(net, encoder) for net in nets)
+    return nets
@@ -1,13 +1,59 @@
+import math
+
 from PIL import Image
 from torchvision import transforms
 from io import BytesIO
 
+# Length of the shorter image side fed to the network
+IMAGE_SIZE = 512
+
+# Largest image accepted for decoding, to guard against decompression bombs
+MAX_IMAGE_PIXELS = 40_000_000
+
 transform = transforms.Compose([
-    transforms.Resize(512),
+    transforms.Resize(IMAGE_SIZE),
     transforms.ToTensor()
 ])
 
 
-def load_image(image_bytes):
-    image = Image.open(BytesIO(image_bytes)).convert("RGB")
-    return transform(image)
+class ImageTooLargeError(ValueError):
+    """Raised for images with more than MAX_IMAGE_PIXELS pixels."""
+
+
+def open_image(image_bytes, size=None, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Decode image bytes to an RGB PIL image.
+
+    The size is checked from the header before any pixel is decoded. With
+    `size`, JPEGs are decoded in draft mode: the decoder downscales by a
+    power of two while its shorter side stays at least `size`, which saves
+    most of the decode time and memory for large photos.
+    """
+    image = Image.open(BytesIO(image_bytes))
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLargeError(f"{width}x{height} image exceeds {max_pixels} pixels")
+    if size is not None:
+        scale = size / min(width, height)
+        image.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+    return image.convert("RGB")
+
+
+def load_image(image_bytes, size=IMAGE_SIZE):
+    """Decode image bytes to a (3, H, W) tensor whose shorter side is `size`"""
+    image = open_image(image_bytes, size)
+    if size == IMAGE_SIZE:
+        return transform(image)
+    return transforms.Compose([transforms.Resize(size), transforms.ToTensor()])(image)
+
+
+def select_photo_size(photo_sizes, size=IMAGE_SIZE):
+    """
+    Pick the smallest of the sizes Telegram offers for a photo whose shorter
+    side still covers `size`, or the largest one if none does.
+    """
+    photo_sizes = sorted(photo_sizes, key=lambda photo: photo.width * photo.height)
+    for photo in photo_sizes:
+        if min(photo.width, photo.height) >= size:
+            return photo
+    return photo_sizes[-1]
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot accept another job."""
+
+
+class InferenceExecutor:
+    """
+    Bounded worker pool for blocking inference jobs.
+
+    At most `max_workers` jobs run at the same time and at most `max_queue`
+    further jobs wait for a free worker. Submitting beyond that raises
+    QueueFullError so the caller can tell the user to retry later.
+    """
+    # Jobs run in this process and may update objects passed to them
+    remote = False
+
+    def __init__(self, max_workers=1, max_queue=8):
+        assert max_workers >= 1 and max_queue >= 0
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """Number of submitted jobs that have not finished yet."""
+        return self._pending
+
+    @property
+    def queued(self):
+        """Number of jobs waiting for a free worker."""
+        return max(0, self._pending - self.max_workers)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def _call(self, fn, args, kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._release()
+
+    def _release_cancelled(self, future):
+        # Cancelled jobs never reach _call, so free their slot here
+        if future.cancelled():
+            self._release()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) on the pool.
+
+        Returns:
+            concurrent.futures.Future with the job result.
+        """
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise QueueFullError(f"{self._pending} inference jobs already pending")
+            self._pending += 1
+        try:
+            future = self._pool.submit(self._call, fn, args, kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release_cancelled)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Submit a job and await its result without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
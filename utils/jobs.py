@@ -0,0 +1,156 @@
+"""
+Blocking inference jobs run by the bot on its worker pool.
+
+They live outside bot.py so that worker processes (see utils.process_pool)
+can look them up by module name.
+"""
+from io import BytesIO
+
+import torch
+
+from model.adain_utils import (extract_features, get_device, prepare_inputs, stylize_features, stylize_alpha_sweep,
+                               stylize_batch)
+from model.tiling import stylize_tiled_many
+from utils.image_io import IMAGE_SIZE, load_image
+from utils.metrics import stage
+
+# Shorter side of the quick preview sent before the full result
+PREVIEW_SIZE = 256
+
+
+def run_style_transfer(net, content_bytes, style_bytes, alphas, preserve_colors, style_stats=None,
+                       style_cache=None, content_feat=None, image_size=IMAGE_SIZE, tiling=None):
+    """
+    Blocking inference job: stylizes the images with every alpha in alphas
+    and encodes the results as JPEG.
+
+    With tiling=(tile_size, overlap), the results are rendered tile by
+    tile, one alpha per pass over the tiles; no content features are kept
+    in that case.
+    Returns the JPEG buffers and the content features, which are kept for re-styling.
+    """
+    if tiling is not None:
+        content, style_stats = prepare_inputs(
+            net,
+            content_bytes,
+            style_bytes,
+            preserve_colors=preserve_colors,
+            style_stats=style_stats,
+            style_cache=style_cache,
+            image_size=image_size
+        )
+        result_images = render_tiled(content, [(net, style_stats, alpha) for alpha in alphas], tiling)
+        return [encode_jpeg(result_image) for result_image in result_images], None
+
+    content_feat, style_stats = extract_features(
+        net,
+        content_bytes,
+        style_bytes,
+        preserve_colors=preserve_colors,
+        style_stats=style_stats,
+        style_cache=style_cache,
+        content_feat=content_feat,
+        image_size=image_size
+    )
+    if len(alphas) == 1:
+        result_images = [stylize_features(net, content_feat, style_stats, alphas[0])]
+    else:
+        # One batched decoder pass for all alpha values
+        result_images = stylize_alpha_sweep(net, content_feat, style_stats, alphas)
+
+    return [encode_jpeg(result_image) for result_image in result_images], content_feat
+
+
+def run_preview(net, content_bytes, style_bytes, alpha, preserve_colors, style_stats=None, style_cache=None,
+                image_size=PREVIEW_SIZE):
+    """
+    Blocking inference job: a quick low-resolution result, sent while the
+    full one is rendered, as a JPEG buffer.
+
+    Precomputed style_stats are used as they are. Otherwise the style is
+    encoded at the preview size too: an approximation, but encoding it at
+    full size would cost more than the rest of the preview.
+    """
+    content, style_stats = prepare_inputs(
+        net,
+        content_bytes,
+        style_bytes,
+        preserve_colors=preserve_colors,
+        style_stats=style_stats,
+        style_cache=style_cache,
+        image_size=image_size,
+        style_size=image_size
+    )
+    with torch.no_grad(), stage('encode'):
+        content_feat = net.encode(content.to(get_device(net)).unsqueeze(0))
+    return encode_jpeg(stylize_features(net, content_feat, style_stats, alpha))
+
+
+def run_gallery(presets, content_bytes, alpha, content_feat=None, image_size=IMAGE_SIZE, tiling=None):
+    """
+    Blocking inference job: stylizes one content image with several
+    (net, style_stats) presets and encodes the results as JPEG.
+
+    All networks share the VGG encoder, so the content is encoded only once;
+    with tiling=(tile_size, overlap), tile by tile, and no content features
+    are kept. Returns the JPEG buffers and the content features.
+    """
+    if tiling is not None:
+        with stage('load_image'):
+            content = load_image(content_bytes, image_size)
+        renders = [(net, tuple(stat.to(get_device(net)) for stat in style_stats), alpha)
+                   for net, style_stats in presets]
+        return [encode_jpeg(result_image) for result_image in render_tiled(content, renders, tiling)], None
+
+    buffers = []
+    for net, style_stats in presets:
+        content_feat, style_stats = extract_features(
+            net,
+            content_bytes,
+            style_stats=style_stats,
+            content_feat=content_feat,
+            image_size=image_size
+        )
+        buffers.append(encode_jpeg(stylize_features(net, content_feat, style_stats, alpha)))
+    return buffers, content_feat
+
+
+def run_style_transfer_batch(net, items):
+    """
+    Blocking inference job for the MicroBatcher: stylizes jobs of equal input
+    shape in one batch. Items are dicts with 'content' or 'content_feat',
+    'style_stats' and 'alpha'.
+
+    Returns a (JPEG buffer, content features) pair per item.
+    """
+    kwargs = {}
+    if items[0]['content_feat'] is None:
+        kwargs['contents'] = [item['content'] for item in items]
+    else:
+        kwargs['content_feats'] = [item['content_feat'] for item in items]
+    results = stylize_batch(
+        net,
+        [item['style_stats'] for item in items],
+        [item['alpha'] for item in items],
+        **kwargs
+    )
+    return [(encode_jpeg(image), content_feat) for image, content_feat in results]
+
+
+def render_tiled(content, renders, tiling):
+    """
+    Render (net, style_stats, alpha) renders of a content image tensor in
+    tiles of tiling=(tile_size, overlap), encoding the tiles once.
+    """
+    # Every tile is encoded and decoded in turn, so both count as one stage
+    with stage('tiles'):
+        return stylize_tiled_many(content, renders, *tiling)
+
+
+def encode_jpeg(image):
+    """Encode a PIL image as JPEG into a rewound buffer"""
+    with stage('jpeg'):
+        img_bytes = BytesIO()
+        image.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+        return img_bytes
@@ -17,6 +17,9 @@ Select a famous painting style (Van Gogh, Monet, Picasso) and apply it to your p
 ⚙️ You can also adjust the strength of the style transfer using the **"Set alpha"** command.
 Choose a value between 0 and 1 — higher values mean stronger stylization.
 
+🔁 Use **"Re-style last photo"** to apply a new alpha or style to your last photo.
+🔍 **"Alpha preview"** shows your next result with several alpha values side by side.
+
 🌐 To change the bot's language, use the **"Language"** command and select your preferred language.
 """,
         "standard_instructions": """
@@ -31,7 +34,11 @@ Choose a value between 0 and 1 — higher values mean stronger stylization.
         "style_received": "✅ Style image received! Starting style transfer...",
         "processing": "🔄 Performing style transfer...",
         "success": "🎨 Style transfer complete!",
+        "preview": "⚡ Quick preview. The full-resolution result is on its way...",
+        "preview_failed": "⚡ Quick preview. The full-resolution result could not be made.",
         "error": "⚠️ An error occurred during processing. Please try again.",
+        "busy": "⏳ The bot is busy right now. Please send your images again in a minute.",
+        "image_too_large": "⚠️ This image is too large. Please send a smaller one.",
         "mode_not_selected": "❌ Please first select a style transfer mode from the menu.",
         "invalid_option": "❌ Please choose one of the available options.",
         "alpha_prompt": "🔧 Please enter a value for alpha (between 0 and 1):",
@@ -42,7 +49,12 @@ Choose a value between 0 and 1 — higher values mean stronger stylization.
         "language_invalid": "❌ Invalid choice, please select a language from the keyboard.",
         "choose_style_prompt": "🖼️ Please select a style from the list below:",
         "style_selected": "🎨 Style {style} selected! Now please send the content image.",
-        "choose_option": "📋 Please select an option from the menu."
+        "style_not_selected": "❌ Please select a style from the list first.",
+        "choose_option": "📋 Please select an option from the menu.",
+        "no_last_photo": "❌ There is no recent photo to re-style. Please send a new one.",
+        "alpha_preview_on": "🔍 Your next style transfer will be shown with several alpha values.",
+        "alpha_preview_done": "👆 Pick the alpha you like and apply it with \"Set alpha\".",
+        "gallery_selected": "🖼️ All styles selected! Send a photo to see it in every style."
     },
 
     "ru": {
@@ -63,6 +75,9 @@ Choose a value between 0 and 1 — higher values mean stronger stylization.
 ⚙️ Вы также можете настроить силу переноса стиля с помощью команды **"Установить alpha"**.
 Укажите значение от 0 до 1 — чем больше значение, тем сильнее эффект стилизации.
 
+🔁 Команда **"Повторить с последним фото"** применит новый alpha или стиль к вашему последнему фото.
+🔍 **"Сравнить alpha"** покажет следующий результат сразу с несколькими значениями alpha.
+
 🌐 Чтобы изменить язык бота, используйте команду **"Язык"** и выберите предпочитаемый язык.
 """,
         "standard_instructions": """
@@ -77,7 +92,11 @@ Choose a value between 0 and 1 — higher values mean stronger stylization.
         "style_received": "✅ Стилевое изображение получено! Начинаю перенос стиля...",
         "processing": "🔄 Выполняю перенос стиля...",
         "success": "🎨 Готово! Перенос стиля выполнен.",
+        "preview": "⚡ Быстрый предпросмотр. Результат в полном разрешении уже в пути...",
+        "preview_failed": "⚡ Быстрый предпросмотр. Результат в полном разрешении получить не удалось.",
         "error": "⚠️ Произошла ошибка при обработке. Пожалуйста, попробуйте ещё раз.",
+        "busy": "⏳ Бот сейчас загружен. Пожалуйста, отправьте изображения ещё раз через минуту.",
+        "image_too_large": "⚠️ Изображение слишком большое. Пожалуйста, отправьте изображение поменьше.",
         "mode_not_selected": "❌ Сначала выберите режим переноса стиля.",
         "invalid_option": "❌ Пожалуйста, выберите один из доступных вариантов.",
         "alpha_prompt": "🔧 Пожалуйста, введите значение alpha (от 0 до 1):",
@@ -88,7 +107,12 @@ Choose a value between 0 and 1 — higher values mean stronger stylization.
         "language_invalid": "❌ Неверный выбор, пожалуйста, выберите язык с клавиатуры.",
         "choose_style_prompt": "🖼️ Пожалуйста, выберите стиль из списка ниже:",
         "style_selected": "🎨 Стиль {style} выбран! Теперь отправьте фото для переноса стиля.",
-        "choose_option": "📋 Выберите опцию из списка."
+        "style_not_selected": "❌ Сначала выберите стиль из списка.",
+        "choose_option": "📋 Выберите опцию из списка.",
+        "no_last_photo": "❌ Нет недавнего фото для повторной стилизации. Пожалуйста, отправьте новое.",
+        "alpha_preview_on": "🔍 Следующий перенос стиля будет показан с несколькими значениями alpha.",
+        "alpha_preview_done": "👆 Выберите понравившееся значение и установите его командой \"Установить alpha\".",
+        "gallery_selected": "🖼️ Выбраны все стили! Отправьте фото, чтобы увидеть его в каждом стиле."
     }
 }
 
@@ -0,0 +1,232 @@
+"""
+Per-job stage timing and a metrics endpoint in the Prometheus text format.
+
+Blocking code marks its stages with `stage(name)`. The marks cost next to
+nothing unless the code runs under `collect_stages`, which returns the
+stage durations along with the result, also from a worker process. The bot
+adds them to a `JobTrace` together with its own stages (download, upload,
+...) and the trace feeds the histograms of a `Metrics` registry.
+"""
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from torch.profiler import record_function
+
+# Upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the enclosed block as `name` if running under collect_stages. The
+    block is labelled in torch.profiler traces as well.
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        with record_function(name):
+            yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def collect_stages(fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) and return (result, {stage: seconds}) of the stages it passed"""
+    timings = _local.timings = {}
+    try:
+        return fn(*args, **kwargs), timings
+    finally:
+        _local.timings = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, histograms and gauges.
+
+    Counters and histograms are updated by name with keyword labels.
+    Gauges are callbacks evaluated on every render, returning a number or a
+    dict mapping label tuples ((name, value), ...) to numbers. `render()`
+    returns all of them in the Prometheus text exposition format.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, log_json=False):
+        self.buckets = tuple(buckets)
+        self.log_json = log_json
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, help=None, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if help:
+                self._help.setdefault(name, help)
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, help=None, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if help:
+                self._help.setdefault(name, help)
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                # Per-bucket counts (the last one above all bounds), the sum and the total count
+                counts = series[key] = [0] * (len(self.buckets) + 3)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def gauge(self, name, fn, help=None, kind='gauge'):
+        """Register a callback read on every render; kind='counter' for running totals"""
+        with self._lock:
+            if help:
+                self._help.setdefault(name, help)
+            self._gauges[name] = (fn, kind)
+
+    def histogram(self, name, **labels):
+        """Return {'count', 'sum'} of one histogram series, for tests and reports"""
+        with self._lock:
+            counts = self._histograms.get(name, {}).get(tuple(sorted(labels.items())))
+            return {'count': counts[-1], 'sum': counts[-2]} if counts else {'count': 0, 'sum': 0.0}
+
+    def render(self):
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            gauges = dict(self._gauges)
+            for name, series in self._counters.items():
+                header(name, 'counter')
+                lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in series.items())
+            for name, series in self._histograms.items():
+                header(name, 'histogram')
+                for key, counts in series.items():
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), counts[:-2]):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {counts[-2]}")
+                    lines.append(f"{name}_count{_format_labels(key)} {counts[-1]}")
+
+        # Callbacks run outside the lock, they may take locks of their own
+        for name, (fn, kind) in gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"Failed to read metric {name}: {e}")
+                continue
+            header(name, kind)
+            series = value if isinstance(value, dict) else {(): value}
+            lines.extend(f"{name}{_format_labels(key)} {number}" for key, number in series.items())
+        return '\n'.join(lines) + '\n'
+
+
+class JobTrace:
+    """
+    Stage timings of one style transfer job.
+
+    `finish()` records the stages and the total time in the histograms
+    style_job_stage_seconds and style_job_seconds, labelled by mode and
+    decoder, and prints the trace as a JSON line if metrics.log_json is set.
+    """
+    def __init__(self, metrics, user_id, mode=None, decoder=None):
+        self.metrics = metrics
+        self.user_id = user_id
+        self.mode = mode
+        self.decoder = decoder
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.first_result = None
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add_worker_stages(self, stages, elapsed, prefix=''):
+        """
+        Add the stages collected from a worker pool job that took `elapsed`
+        seconds to await; the unaccounted rest is the time spent queued.
+        """
+        for name, seconds in stages.items():
+            self.add(prefix + name, seconds)
+        self.add(prefix + 'queue', max(0.0, elapsed - sum(stages.values())))
+
+    def result_sent(self):
+        """Mark that the user received a result; the first mark is the time to first result"""
+        if self.first_result is None:
+            self.first_result = time.perf_counter() - self.started
+
+    def finish(self, status='ok'):
+        total = time.perf_counter() - self.started
+        labels = {'mode': self.mode or 'none', 'decoder': self.decoder or 'none'}
+        for name, seconds in self.stages.items():
+            self.metrics.observe('style_job_stage_seconds', seconds, stage=name,
+                                 help="Time spent in each stage of a style transfer job", **labels)
+        self.metrics.observe('style_job_seconds', total, status=status,
+                             help="Time from the last photo to the reply", **labels)
+        if self.first_result is not None:
+            self.metrics.observe('style_job_first_result_seconds', self.first_result,
+                                 help="Time from the last photo to the first result (preview or final)", **labels)
+        if self.metrics.log_json:
+            first_result = None if self.first_result is None else round(self.first_result * 1000, 1)
+            print(json.dumps({'event': 'style_job', 'user_id': self.user_id, 'status': status, **labels,
+                              'total_ms': round(total * 1000, 1), 'first_result_ms': first_result,
+                              'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}}))
+        return total
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(metrics, port, host='127.0.0.1'):
+    """Serve metrics.render() at http://host:port/metrics on a daemon thread; call .shutdown() to stop"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
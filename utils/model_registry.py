@@ -0,0 +1,192 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from model.adain_net import Net
+from utils.backends import BACKENDS, artifact_path, load_backend_module, warm_up, EXPORT_DIR
+from utils.functional import (DECODER_WEIGHTS, ENCODER_WEIGHTS, NET_NAMES, WEIGHTS_DIR, InferenceNet,
+                              build_inference_decoder, build_inference_encoder, get_default_device, load_decoder,
+                              load_encoder)
+from utils.precision import PRECISION_MODES, convert_module, decoder_calibration_inputs, load_calibration_images
+
+
+class ModelRegistry:
+    """
+    Style transfer networks by name (see NET_NAMES), loaded on first use.
+
+    The shared encoder is loaded up front. Decoders are loaded when first
+    requested and at most `max_loaded` of them are kept; the least recently
+    used one is dropped when another has to be loaded. Pinned networks are
+    loaded at startup and never dropped.
+
+    Precision modes and the inference backend are applied per network as it
+    is loaded (see utils.precision and utils.backends); both require the lean
+    inference graphs, so they imply optimize=True.
+
+    Pinned networks are warmed up at every size in warmup_sizes. With a
+    non-eager backend, decoders loaded on first use are warmed up as they
+    load too, so that compilation is part of the load rather than of the
+    first job.
+
+    Loading happens outside the registry lock: requests for other networks,
+    and is_loaded()/loaded(), never wait for a load in progress; concurrent
+    requests for the network being loaded wait for that load.
+    """
+    def __init__(self, optimize=False, precision=None, backend='eager', max_loaded=None, pinned=('net',),
+                 weights_dir=WEIGHTS_DIR, export_dir=EXPORT_DIR, device=None, warmup_sizes=()):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+        self.precision = dict(precision or {})
+        for name, mode in self.precision.items():
+            if mode not in PRECISION_MODES:
+                raise ValueError(f"Unknown precision mode {mode!r} for {name}, expected one of {PRECISION_MODES}")
+        self.optimize = optimize or bool(self.precision) or backend != 'eager'
+        self.backend = backend
+        self.max_loaded = max_loaded
+        self.pinned = tuple(pinned)
+        self.weights_dir = weights_dir
+        self.export_dir = export_dir
+        self.device = device or get_default_device()
+        self.warmup_sizes = tuple(warmup_sizes)
+        self._nets = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._calibration_lock = threading.Lock()
+        self._calibration_images = None
+        self._decoder_inputs = None
+
+        self._vgg = load_encoder(self.device, weights_dir)
+        if self.optimize:
+            self.float_encoder = build_inference_encoder(self._vgg).to(self.device)
+            encoder = convert_module(self.float_encoder, self.precision.get('encoder', 'fp32'),
+                                     self._calibration())
+            self.encoder = load_backend_module(encoder, 'encoder', backend, export_dir)
+        else:
+            self.float_encoder = self.encoder = self._vgg
+
+        for name in self.pinned:
+            self.get(name)
+
+    def __contains__(self, name):
+        return name in NET_NAMES
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def _calibration(self):
+        if self._calibration_images is None and 'int8' in self.precision.values():
+            self._calibration_images = load_calibration_images()
+        return self._calibration_images
+
+    def _load(self, name):
+        decoder = load_decoder(name, self.device, self.weights_dir)
+        if not self.optimize:
+            return Net(self._vgg, decoder).to(self.device).eval()
+
+        decoder = build_inference_decoder(decoder).to(self.device)
+        mode = self.precision.get(name, 'fp32')
+        if mode == 'int8':
+            # Shared by all int8 decoders, which may be loading at the same time
+            with self._calibration_lock:
+                if self._decoder_inputs is None:
+                    self._decoder_inputs = decoder_calibration_inputs(self.float_encoder, self._calibration())
+        decoder = convert_module(decoder, mode, self._decoder_inputs)
+        decoder = load_backend_module(decoder, name, self.backend, self.export_dir)
+        return InferenceNet(self.encoder, decoder).eval()
+
+    def get(self, name):
+        """Return the network `name`, loading it if needed"""
+        if name not in NET_NAMES:
+            raise KeyError(name)
+        with self._lock:
+            if name in self._nets:
+                self._nets.move_to_end(name)
+                return self._nets[name]
+            loading = self._loading.get(name)
+            if loading is None:
+                loading = self._loading[name] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Another thread is loading it
+            return loading.result()
+
+        try:
+            print(f"Loading {name}")
+            net = self._load(name)
+            if self.warmup_sizes and (name in self.pinned or self.backend != 'eager'):
+                print(f"Warming up {name} for sizes {list(self.warmup_sizes)}")
+                warm_up([net], self.warmup_sizes)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[name]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            self._nets[name] = net
+            self._evict()
+            del self._loading[name]
+        loading.set_result(net)
+        return net
+
+    def _evict(self):
+        if self.max_loaded is None:
+            return
+        for name in list(self._nets):
+            if len(self._nets) <= self.max_loaded:
+                break
+            if name not in self.pinned:
+                del self._nets[name]
+                print(f"Unloaded {name}")
+
+    # Lock-free: both are single operations under the GIL, and the event loop calls them
+
+    def is_loaded(self, name):
+        return name in self._nets
+
+    def loaded(self):
+        """Names of the networks currently in memory"""
+        return list(self._nets)
+
+    def fingerprint(self):
+        """
+        Short digest of everything that determines the networks' outputs:
+        graph, precision and backend settings, the device, and the size and
+        modification time of the weight files (and of exported artifacts).
+        """
+        digest = hashlib.sha256(
+            f"{self.optimize}|{sorted(self.precision.items())}|{self.backend}|{self.device}".encode()
+        )
+        paths = [os.path.join(self.weights_dir, ENCODER_WEIGHTS)]
+        paths += [os.path.join(self.weights_dir, DECODER_WEIGHTS[name]) for name in NET_NAMES]
+        paths += [os.path.splitext(path)[0] + '.safetensors' for path in paths]
+        if self.backend in ('torchscript', 'onnx'):
+            paths += [artifact_path(name, self.backend, self.export_dir) for name in ('encoder',) + NET_NAMES]
+        for path in paths:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update(f"|{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()[:16]
+
+    def encoder_fingerprint(self):
+        """
+        Short digest of the size and modification time of the encoder weight
+        files, which alone determine the statistics of style_net().
+        """
+        digest = hashlib.sha256()
+        path = os.path.join(self.weights_dir, ENCODER_WEIGHTS)
+        for path in (path, os.path.splitext(path)[0] + '.safetensors'):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update(f"|{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()[:16]
+
+    def style_net(self):
+        """
+        Full precision eager network for computing style statistics (e.g.
+        for StyleBank), independent of the precision and backend settings.
+        """
+        return InferenceNet(self.float_encoder, None)
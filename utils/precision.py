@@ -0,0 +1,120 @@
+import glob
+import warnings
+
+import torch
+import torch.nn as nn
+
+from model.adain_utils import adaptive_instance_normalization, get_device
+from utils.functional import InferenceNet
+from utils.image_io import load_image
+
+PRECISION_MODES = ('fp32', 'bf16', 'int8')
+
+CALIBRATION_IMAGES = "test_images/*/*.jpg"
+
+
+class Bf16Module(nn.Module):
+    """Runs the wrapped module under bfloat16 autocast and returns float32."""
+    def __init__(self, module):
+        super(Bf16Module, self).__init__()
+        self.module = module
+
+    def forward(self, x):
+        with torch.autocast(x.device.type, dtype=torch.bfloat16):
+            return self.module(x).float()
+
+
+def _conv_relu_pairs(sequential, prefix):
+    layers = list(sequential.children())
+    return [[f"{prefix}{i}", f"{prefix}{i + 1}"] for i in range(len(layers) - 1)
+            if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.ReLU)]
+
+
+def quantize_int8(module, calibration_inputs):
+    """
+    Post-training static int8 quantization of a lean Sequential graph
+    (see utils.functional.build_inference_encoder/decoder) for the CPU.
+
+    Conv+ReLU pairs are fused, activation ranges are observed on the
+    calibration inputs and the graph is converted to quantized kernels.
+    Inputs and outputs stay float32.
+    """
+    import torch.ao.quantization as tq
+
+    assert isinstance(module, nn.Sequential)
+    with warnings.catch_warnings():
+        # Eager mode quantization is deprecated in favour of torchao
+        warnings.simplefilter("ignore")
+        engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+        torch.backends.quantized.engine = engine
+        wrapped = nn.Sequential(tq.QuantStub(), module, tq.DeQuantStub()).cpu().eval()
+        wrapped.qconfig = tq.get_default_qconfig(engine)
+        wrapped = tq.fuse_modules(wrapped, _conv_relu_pairs(module, '1.'))
+        tq.prepare(wrapped, inplace=True)
+        with torch.no_grad():
+            for x in calibration_inputs:
+                wrapped(x.cpu())
+        tq.convert(wrapped, inplace=True)
+    return wrapped
+
+
+def load_calibration_images(pattern=CALIBRATION_IMAGES, size=256):
+    """Calibration batch of the sample images, each as a (1, 3, H, W) tensor"""
+    images = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'rb') as f:
+            images.append(load_image(f.read(), size).unsqueeze(0))
+    return images
+
+
+def decoder_calibration_inputs(encoder, images):
+    """AdaIN features of every ordered pair of calibration images"""
+    with torch.no_grad():
+        feats = [encoder(image) for image in images]
+    return [adaptive_instance_normalization(content, style) for content in feats for style in feats]
+
+
+def convert_module(module, mode, calibration_inputs=None):
+    """Convert a lean encoder or decoder graph to one of PRECISION_MODES"""
+    if mode not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision mode {mode!r}, expected one of {PRECISION_MODES}")
+    if mode == 'bf16':
+        return Bf16Module(module)
+    if mode == 'int8':
+        if get_device(module).type != 'cpu':
+            raise ValueError("int8 precision is only supported on the CPU")
+        return quantize_int8(module, calibration_inputs)
+    return module
+
+
+def apply_precision(nets, modes, calibration_images=None):
+    """
+    Convert InferenceNets to the configured precision modes.
+
+    Args:
+        nets: dict of name -> InferenceNet, all sharing one encoder
+        modes: dict with an optional 'encoder' entry and optional per-network
+            entries (e.g. 'net_monet'), each one of PRECISION_MODES
+        calibration_images: inputs for int8 calibration, loaded from
+            test_images by default
+
+    Returns:
+        dict of name -> InferenceNet with converted encoder and decoders.
+    """
+    for name, mode in modes.items():
+        if mode not in PRECISION_MODES:
+            raise ValueError(f"Unknown precision mode {mode!r} for {name}, expected one of {PRECISION_MODES}")
+    if 'int8' in modes.values():
+        if any(get_device(net).type != 'cpu' for net in nets.values()):
+            raise ValueError("int8 precision is only supported on the CPU")
+        if calibration_images is None:
+            calibration_images = load_calibration_images()
+
+    encoder = next(iter(nets.values())).encoder
+    decoder_inputs = None
+    if any(modes.get(name) == 'int8' for name in nets):
+        decoder_inputs = decoder_calibration_inputs(encoder, calibration_images)
+
+    encoder = convert_module(encoder, modes.get('encoder', 'fp32'), calibration_images)
+    return {name: InferenceNet(encoder, convert_module(net.decoder, modes.get(name, 'fp32'), decoder_inputs)).eval()
+            for name, net in nets.items()}
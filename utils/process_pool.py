@@ -0,0 +1,196 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import shared_memory
+
+import torch
+import torch.nn as nn
+
+from utils.inference import InferenceExecutor, QueueFullError
+
+# Bytes arguments from this size on are passed through shared memory
+SHARED_BYTES_MIN = 16 * 1024
+
+# Objects the worker process received at startup, by name
+_worker_objects = {}
+
+
+class _Ref:
+    """Stands for an object every worker received at startup"""
+    def __init__(self, name):
+        self.name = name
+
+
+class _SharedBytes:
+    """Bytes in a shared memory block, passed by name instead of being pickled"""
+    def __init__(self, data):
+        self.size = len(data)
+        self.block = shared_memory.SharedMemory(create=True, size=max(self.size, 1))
+        self.block.buf[:self.size] = data
+        self.name = self.block.name
+
+    def __getstate__(self):
+        return {'name': self.name, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.size = state['size']
+        self.block = None
+
+    def read(self):
+        block = shared_memory.SharedMemory(name=self.name)
+        try:
+            return bytes(block.buf[:self.size])
+        finally:
+            block.close()
+
+    def release(self):
+        """Free the block; called by the parent once it is no longer needed"""
+        block = self.block or shared_memory.SharedMemory(name=self.name)
+        block.close()
+        block.unlink()
+
+
+def _map(value, fn):
+    """Apply fn to value and, recursively, to the items of lists, tuples and dicts"""
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map(item, fn) for item in value)
+    if isinstance(value, dict):
+        return {key: _map(item, fn) for key, item in value.items()}
+    return fn(value)
+
+
+def _init_worker(objects, num_threads):
+    torch.set_num_threads(num_threads)
+    _worker_objects.update(objects)
+
+
+def _run_in_worker(fn, args, kwargs):
+    def resolve(value):
+        if isinstance(value, _Ref):
+            return _worker_objects[value.name]
+        if isinstance(value, _SharedBytes):
+            return value.read()
+        return value
+
+    def share(value):
+        # JPEG results go back through shared memory as well
+        if isinstance(value, BytesIO):
+            shared = _SharedBytes(value.getbuffer())
+            shared.block.close()
+            return shared
+        return value
+
+    result = fn(*_map(args, resolve), **_map(kwargs, resolve))
+    return _map(result, share)
+
+
+class ProcessInferenceExecutor(InferenceExecutor):
+    """
+    InferenceExecutor that runs jobs in worker processes, so pre- and
+    post-processing do not contend for the GIL.
+
+    `objects` (name -> object, e.g. the networks and the style cache) are
+    sent to every worker once at startup. Module weights are moved to shared
+    memory first, so the workers attach to the parent's copy instead of
+    loading their own; other objects are copied (a StyleFeatureCache
+    becomes an empty cache per worker). Job arguments that are one of these
+    objects are passed by name, bytes through shared memory blocks, and
+    tensors through torch's shared memory; JPEG buffers in the results come
+    back through shared memory too.
+
+    Each worker runs `threads_per_worker` intra-op threads, by default the
+    CPU count divided by the number of workers, so that the workers do not
+    oversubscribe the cores.
+    """
+    remote = True
+
+    def __init__(self, objects, max_workers=2, max_queue=8, threads_per_worker=None, start_method='spawn'):
+        assert max_workers >= 1 and max_queue >= 0
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // max_workers)
+        self._refs = {id(obj): _Ref(name) for name, obj in objects.items()}
+        for obj in objects.values():
+            if isinstance(obj, nn.Module):
+                obj.share_memory()
+        self._objects = objects
+        self._pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_worker,
+            initargs=(objects, self.threads_per_worker)
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _to_worker(self, value, shared):
+        ref = self._refs.get(id(value))
+        if ref is not None:
+            return ref
+        if isinstance(value, bytes) and len(value) >= SHARED_BYTES_MIN:
+            block = _SharedBytes(value)
+            shared.append(block)
+            return block
+        return value
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) in a worker process. fn must be
+        importable by the workers, i.e. defined at module level.
+
+        Returns:
+            concurrent.futures.Future with the job result.
+        """
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise QueueFullError(f"{self._pending} inference jobs already pending")
+            self._pending += 1
+        shared = []
+        result = Future()
+        try:
+            args = _map(args, lambda value: self._to_worker(value, shared))
+            kwargs = _map(kwargs, lambda value: self._to_worker(value, shared))
+            future = self._pool.submit(_run_in_worker, fn, args, kwargs)
+        except BaseException:
+            self._release()
+            for block in shared:
+                block.release()
+            raise
+
+        def done(future):
+            self._release()
+            for block in shared:
+                block.release()
+            if future.cancelled():
+                result.cancel()
+                return
+            if not result.set_running_or_notify_cancel():
+                # Nobody reads the result, so free its shared memory here
+                if future.exception() is None:
+                    _map(future.result(), self._discard)
+                return
+            try:
+                result.set_result(_map(future.result(), self._from_worker))
+            except BaseException as e:
+                result.set_exception(e)
+
+        future.add_done_callback(done)
+        result.add_done_callback(lambda r: r.cancelled() and future.cancel())
+        return result
+
+    @staticmethod
+    def _discard(value):
+        if isinstance(value, _SharedBytes):
+            value.release()
+        return value
+
+    @staticmethod
+    def _from_worker(value):
+        if isinstance(value, _SharedBytes):
+            data = value.read()
+            value.release()
+            return BytesIO(data)
+        return value
@@ -0,0 +1,172 @@
+"""
+Opt-in profiling of sampled requests.
+
+A configurable share of inference jobs runs under torch.profiler, which
+writes a chrome trace and a per-operator table (by input shape, so the
+VGG and decoder layers can be told apart). A share of handler calls can
+run under a Python sampling profiler that records the stacks of all
+threads. Both kinds of traces go to one directory, of which only the
+newest `max_traces` are kept.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from torch.profiler import ProfilerActivity, profile
+
+# Directory of the written traces
+TRACE_DIR = "profiles"
+
+
+def profile_job(path, fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) under torch.profiler and write `path`.json
+    (chrome trace) and `path`.txt (operators by self CPU time).
+
+    Defined at module level, so worker processes can run it as well.
+    """
+    with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as prof:
+        result = fn(*args, **kwargs)
+    prof.export_chrome_trace(path + '.json')
+    table = prof.key_averages(group_by_input_shape=True).table(sort_by='self_cpu_time_total', row_limit=40)
+    with open(path + '.txt', 'w') as f:
+        f.write(table)
+    return result
+
+
+def _frame_stack(frame):
+    """Function names of a frame and its callers, outermost first"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return stack[::-1]
+
+
+class PythonSampler:
+    """
+    Records the Python stacks of all other threads every `interval` seconds
+    on a background thread, from start() to stop().
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="python-sampler", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            timestamp = time.perf_counter() - self.started
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.samples.append((timestamp, ident, _frame_stack(frame)))
+
+    def folded(self):
+        """Sample counts per stack in the collapsed format of flame graph tools"""
+        return Counter(';'.join(stack) for _, _, stack in self.samples)
+
+    def chrome_trace(self):
+        """
+        Samples as chrome trace events: consecutive samples that share a
+        frame become one span, per thread.
+        """
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ident, 'args': {'name': name}}
+                  for ident, name in self.thread_names.items()]
+        open_frames = {}
+        last = 0.0
+
+        def close(ident, depth, end):
+            frames = open_frames[ident]
+            while len(frames) > depth:
+                name, start = frames.pop()
+                events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': ident,
+                               'ts': start * 1e6, 'dur': (end - start) * 1e6})
+
+        for timestamp, ident, stack in self.samples:
+            frames = open_frames.setdefault(ident, [])
+            common = 0
+            while common < min(len(frames), len(stack)) and frames[common][0] == stack[common]:
+                common += 1
+            close(ident, common, timestamp)
+            frames.extend((name, timestamp) for name in stack[common:])
+            last = timestamp
+        for ident in open_frames:
+            close(ident, 0, last + self.interval)
+        return {'traceEvents': events}
+
+
+class Profiler:
+    """
+    Decides which requests are profiled and where their traces go.
+
+    The sample rates (0 to 1) may be changed at runtime, e.g. by an admin
+    command; with both at 0, profiling costs one comparison per request.
+    """
+    def __init__(self, trace_dir=TRACE_DIR, torch_sample_rate=0.0, python_sample_rate=0.0, max_traces=20,
+                 python_interval_ms=5):
+        self.trace_dir = trace_dir
+        self.torch_sample_rate = torch_sample_rate
+        self.python_sample_rate = python_sample_rate
+        self.max_traces = max_traces
+        self.python_interval = python_interval_ms / 1000
+        self._lock = threading.Lock()
+
+    def sample_torch(self):
+        return self.torch_sample_rate > 0 and random.random() < self.torch_sample_rate
+
+    def sample_python(self):
+        return self.python_sample_rate > 0 and random.random() < self.python_sample_rate
+
+    def traces(self):
+        """Path stems of the kept traces, oldest first"""
+        if not os.path.isdir(self.trace_dir):
+            return []
+        return sorted({os.path.join(self.trace_dir, name.split('.')[0]) for name in os.listdir(self.trace_dir)})
+
+    def trace_path(self, label):
+        """
+        Return the path stem for a new trace, deleting the oldest traces so
+        that at most max_traces remain once it is written.
+        """
+        with self._lock:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            traces = self.traces()
+            for stem in traces[:max(0, len(traces) - self.max_traces + 1)]:
+                for suffix in ('.json', '.txt', '.folded'):
+                    if os.path.exists(stem + suffix):
+                        os.remove(stem + suffix)
+            return os.path.join(self.trace_dir, f"{datetime.now():%Y%m%d-%H%M%S-%f}_{label}")
+
+    @contextmanager
+    def python_trace(self, label):
+        """Run the enclosed block under the Python sampling profiler and write its trace"""
+        sampler = PythonSampler(self.python_interval)
+        sampler.start()
+        try:
+            yield sampler
+        finally:
+            sampler.stop()
+            path = self.trace_path(label)
+            with open(path + '.json', 'w') as f:
+                json.dump(sampler.chrome_trace(), f)
+            with open(path + '.folded', 'w') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in sampler.folded().most_common())
+            print(f"Wrote Python profile {path}.json ({len(sampler.samples)} samples)")
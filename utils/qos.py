@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import Counter
+
+
+class ResolutionPolicy:
+    """
+    Chooses the output resolution of each job from the current queue depth
+    and the recently observed processing time.
+
+    Processing time is assumed to grow with the number of pixels, so the
+    policy tracks an exponential moving average of seconds per squared
+    pixel of the shorter side. A job gets the largest size (in `step`
+    increments between min_size and max_size) whose predicted completion
+    time, including the jobs queued before it, stays within latency_target.
+    """
+    def __init__(self, min_size=256, max_size=512, latency_target=10.0, step=64, workers=1, smoothing=0.3):
+        assert 0 < min_size <= max_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.latency_target = latency_target
+        self.step = step
+        self.workers = workers
+        self.smoothing = smoothing
+        self.cost = None
+        self.sizes_used = Counter()
+        self._lock = threading.Lock()
+
+    def choose(self, queue_depth):
+        """Return the output size for a job submitted behind queue_depth other jobs."""
+        if self.cost is None:
+            return self.max_size
+        waves = queue_depth / self.workers + 1
+        size = self.max_size
+        while size > self.min_size and waves * self.cost * size ** 2 > self.latency_target:
+            size = max(self.min_size, size - self.step)
+        return size
+
+    def record(self, size, seconds=None):
+        """
+        Account a finished job that was processed at `size` in `seconds`.
+
+        Only plain jobs (one content encode and one decode) are a sample of
+        the cost; for others (galleries, alpha sweeps, re-styles of encoded
+        content) pass seconds=None to count the job only.
+        """
+        with self._lock:
+            if seconds is not None:
+                cost = seconds / size ** 2
+                self.cost = cost if self.cost is None else self.smoothing * cost + (1 - self.smoothing) * self.cost
+            self.sizes_used[size] += 1
+
+    def timed(self, size, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) and record its processing time for `size`."""
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.record(size, time.perf_counter() - start)
+
+    def usage(self):
+        """Return how many jobs ran at each size and how many were degraded."""
+        with self._lock:
+            degraded = sum(count for size, count in self.sizes_used.items() if size < self.max_size)
+            return {'sizes': dict(self.sizes_used), 'degraded': degraded,
+                    'jobs': sum(self.sizes_used.values())}
@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.image_io import IMAGE_SIZE
+
+
+def _entry_nbytes(outputs):
+    return sum(len(data) for data in outputs)
+
+
+def _pack(outputs):
+    """One file per entry: the number of images, their lengths, then the images."""
+    header = struct.pack(f">I{len(outputs)}I", len(outputs), *(len(data) for data in outputs))
+    return header + b''.join(outputs)
+
+
+def _unpack(blob):
+    count, = struct.unpack_from(">I", blob)
+    lengths = struct.unpack_from(f">{count}I", blob, 4)
+    outputs, offset = [], 4 + 4 * count
+    for length in lengths:
+        outputs.append(blob[offset:offset + length])
+        offset += length
+    return outputs
+
+
+class ResultCache:
+    """
+    Cache of finished results (the encoded JPEG bytes) keyed by everything
+    that determines them: content and style images, mode, alpha, decoder
+    and output size.
+
+    Results are kept in memory up to max_bytes, least recently used first
+    out. With disk_dir set, they are also written there (up to
+    disk_max_bytes), so results survive a restart and outlive the memory
+    tier. Alpha is quantized to alpha_step, so near-identical requests
+    share an entry; callers render the quantized value. model_version (see
+    ModelRegistry.fingerprint) is part of every key, so results of other
+    weights or precision settings on disk are never served. Disk reads and
+    writes run on a thread of their own, so they never block the event loop.
+
+    claim() and release() let identical requests that arrive while the
+    first one is still running wait for its result instead of computing
+    it again.
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024, disk_dir=None, disk_max_bytes=1024 * 1024 * 1024,
+                 alpha_step=0.05, model_version=''):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.alpha_step = alpha_step
+        self.model_version = model_version
+        self.nbytes = 0
+        self.disk_nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._entries = OrderedDict()
+        self._disk_entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._io = None
+        if disk_dir:
+            self._load_disk_index()
+            self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache-io")
+
+    def quantize(self, alpha):
+        """Round alpha to the cache's step."""
+        if not self.alpha_step:
+            return alpha
+        return round(round(alpha / self.alpha_step) * self.alpha_step, 6)
+
+    def make_key(self, content_bytes, style, mode, alphas, decoder, image_size=IMAGE_SIZE, tiling=None):
+        """
+        Build the key of a result. style is the style image or, for
+        pre-saved styles, their name.
+        """
+        if isinstance(style, str):
+            style = style.encode()
+        digest = hashlib.sha256(content_bytes)
+        digest.update(hashlib.sha256(style or b'').digest())
+        alphas = ','.join(str(self.quantize(alpha)) for alpha in alphas)
+        digest.update(f"|{mode}|{alphas}|{decoder}|{image_size}|{tiling}|{self.model_version}".encode())
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # --- Disk tier ---
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.bin")
+
+    def _load_disk_index(self):
+        """Index the results already on disk, oldest first."""
+        found = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith('.bin'):
+                    stat = os.stat(os.path.join(root, name))
+                    found.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(found):
+            self._disk_entries[key] = size
+            self.disk_nbytes += size
+
+    def _read_disk(self, key):
+        if key not in self._disk_entries:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                outputs = _unpack(f.read())
+            # The modification time orders the entries after a restart
+            os.utime(path)
+        except (OSError, struct.error) as e:
+            print(f"Dropping unreadable cached result {key}: {e}")
+            self._remove_disk(key)
+            return None
+        self._disk_entries.move_to_end(key)
+        return outputs
+
+    def _write_disk(self, key, outputs):
+        blob = _pack(outputs)
+        if len(blob) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name first so a crash never leaves a truncated entry
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+        self.disk_nbytes += len(blob) - self._disk_entries.pop(key, 0)
+        self._disk_entries[key] = len(blob)
+        while self.disk_nbytes > self.disk_max_bytes:
+            self._remove_disk(next(iter(self._disk_entries)))
+
+    def _remove_disk(self, key):
+        self.disk_nbytes -= self._disk_entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    # --- Memory tier ---
+
+    def _remember(self, key, outputs):
+        nbytes = _entry_nbytes(outputs)
+        if nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= _entry_nbytes(old)
+        self._entries[key] = outputs
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _entry_nbytes(evicted)
+
+    def _get_memory(self, key):
+        with self._lock:
+            outputs = self._entries.get(key)
+            if outputs is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return outputs
+
+    def _get_disk(self, key):
+        outputs = None
+        if self.disk_dir:
+            with self._disk_lock:
+                outputs = self._read_disk(key)
+        with self._lock:
+            if outputs is None:
+                self.misses += 1
+            else:
+                self._remember(key, outputs)
+                self.disk_hits += 1
+        return outputs
+
+    def _put_disk(self, key, outputs):
+        with self._disk_lock:
+            try:
+                self._write_disk(key, outputs)
+            except OSError as e:
+                print(f"Could not write cached result {key}: {e}")
+
+    def get(self, key):
+        """Return the cached list of JPEG bytes or None; blocks on the disk tier."""
+        outputs = self._get_memory(key)
+        return outputs if outputs is not None else self._get_disk(key)
+
+    async def lookup(self, key):
+        """Like get(), but reads the disk tier on the cache's I/O thread."""
+        outputs = self._get_memory(key)
+        if outputs is not None:
+            return outputs
+        if self._io is None:
+            # Memory only: just counts the miss
+            return self._get_disk(key)
+        return await asyncio.get_running_loop().run_in_executor(self._io, self._get_disk, key)
+
+    def put(self, key, outputs):
+        """
+        Store a result, given as a list of JPEG bytes. It is written to the
+        disk tier in the background.
+        """
+        outputs = [bytes(data) for data in outputs]
+        with self._lock:
+            self._remember(key, outputs)
+        if self._io is not None:
+            self._io.submit(self._put_disk, key, outputs)
+
+    def close(self):
+        """Finish pending disk writes."""
+        if self._io is not None:
+            self._io.shutdown(wait=True)
+
+    # --- In-flight deduplication (event loop only) ---
+
+    async def claim(self, key):
+        """
+        Return the cached result of key, waiting for an identical request
+        that is already running if there is one. None means the caller has
+        to compute the result, and must call release() when done.
+        """
+        outputs = await self.lookup(key)
+        while outputs is None:
+            pending = self._inflight.get(key)
+            if pending is None:
+                self._inflight[key] = asyncio.get_running_loop().create_future()
+                return None
+            outputs = await asyncio.shield(pending)
+            if outputs is not None:
+                self.shared += 1
+            # Otherwise the running request failed, so one of the waiters takes over
+        return outputs
+
+    def release(self, key, outputs=None):
+        """
+        End the computation of key claimed with claim(), handing its
+        result (None if it failed) to the waiting requests.
+        """
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(outputs)
+
+    def usage(self):
+        """Return usage counters of the cache."""
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.nbytes,
+                    'disk_entries': len(self._disk_entries), 'disk_bytes': self.disk_nbytes,
+                    'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'shared': self.shared}
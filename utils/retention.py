@@ -0,0 +1,316 @@
+"""
+Retention, compaction and quotas for saved user images.
+
+Usage:
+    python -m utils.retention [--max-age-days 30] [--max-results 50] [--max-total-mb 1024] [--stats]
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+
+from PIL import Image
+
+from utils.user_storage import USER_DATA_DIR, BlobStore
+
+INDEX_FILE = os.path.join(USER_DATA_DIR, "artifact_index.db")
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 60
+
+
+def _manifest_digests(manifest, outputs_only=False):
+    digests = [manifest['output']] + list(manifest.get('extra_outputs', {}).values())
+    if not outputs_only:
+        digests += [manifest['content'], manifest['style']]
+    return [digest for digest in digests if digest]
+
+
+def _legacy_created(name):
+    """Creation time of a result_<timestamp>/ folder written before manifests existed"""
+    try:
+        return datetime.strptime(name, "result_%Y-%m-%d_%H-%M-%S").timestamp()
+    except ValueError:
+        return None
+
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """Re-encode a JPEG with its longer side at most `size` pixels"""
+    image = Image.open(BytesIO(data)).convert('RGB')
+    image.thumbnail((size, size))
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+class RetentionManager:
+    """
+    Applies retention policies to the saved results in user_data/.
+
+    Policies (None disables one):
+        max_age_days: delete results older than this
+        max_results_per_user: keep only the newest results of every user
+        max_total_mb: delete the oldest results until the results fit
+        thumbnail_after_days: replace the outputs of older results with
+            small, low-quality thumbnails
+
+    Results and blob sizes are kept in an SQLite index. A run only rescans
+    user folders whose modification time changed since the last run; blobs
+    no longer referenced by any result are deleted. Results saved before
+    the blob store (result_<timestamp>/ folders) are indexed with their
+    total size and can only be deleted.
+    """
+    def __init__(self, data_dir=USER_DATA_DIR, blob_store=None, index_path=None, max_age_days=None,
+                 max_results_per_user=None, max_total_mb=None, thumbnail_after_days=None):
+        self.data_dir = data_dir
+        self.blob_store = blob_store or BlobStore(os.path.join(data_dir, 'blobs'))
+        self.max_age_days = max_age_days
+        self.max_results_per_user = max_results_per_user
+        self.max_total_mb = max_total_mb
+        self.thumbnail_after_days = thumbnail_after_days
+        self._stop = threading.Event()
+        self._thread = None
+
+        index_path = index_path or os.path.join(data_dir, os.path.basename(INDEX_FILE))
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(index_path, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS dirs (user_id TEXT PRIMARY KEY, mtime REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT PRIMARY KEY, user_id TEXT NOT NULL, created REAL NOT NULL,
+                legacy_size INTEGER, thumbnailed INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS refs (path TEXT NOT NULL, digest TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS refs_path ON refs (path);
+            CREATE INDEX IF NOT EXISTS refs_digest ON refs (digest);
+            CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+        """)
+
+    # --- Index ---
+
+    def _blob_size(self, digest):
+        try:
+            return os.path.getsize(self.blob_store.path(digest))
+        except FileNotFoundError:
+            return 0
+
+    def _index_result(self, path, user_id):
+        if os.path.isdir(path):
+            created = _legacy_created(os.path.basename(path))
+            if created is None:
+                return
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            self._db.execute("INSERT INTO results (path, user_id, created, legacy_size) VALUES (?, ?, ?, ?)",
+                             (path, user_id, created, size))
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping unreadable manifest {path}: {e}")
+            return
+        self._db.execute("INSERT INTO results (path, user_id, created, thumbnailed) VALUES (?, ?, ?, ?)",
+                         (path, user_id, datetime.fromisoformat(manifest['created']).timestamp(),
+                          int(manifest.get('thumbnail', False))))
+        for digest in set(_manifest_digests(manifest)):
+            self._db.execute("INSERT INTO refs (path, digest) VALUES (?, ?)", (path, digest))
+            self._db.execute("INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)",
+                             (digest, self._blob_size(digest)))
+
+    def refresh(self):
+        """Bring the index up to date with user folders changed since the last run"""
+        known = dict(self._db.execute("SELECT user_id, mtime FROM dirs"))
+        present = set()
+        with self._db:
+            for entry in os.scandir(self.data_dir):
+                if not entry.is_dir() or entry.path == self.blob_store.root:
+                    continue
+                user_id = entry.name
+                present.add(user_id)
+                mtime = entry.stat().st_mtime
+                if known.get(user_id) == mtime:
+                    continue
+                rows = self._db.execute("SELECT path FROM results WHERE user_id = ?", (user_id,))
+                indexed = {path for (path,) in rows}
+                current = {item.path for item in os.scandir(entry.path)
+                           if item.name.startswith('result_') and (item.is_dir() or item.name.endswith('.json'))}
+                for path in indexed - current:
+                    self._forget(path)
+                for path in current - indexed:
+                    self._index_result(path, user_id)
+                self._db.execute("INSERT OR REPLACE INTO dirs (user_id, mtime) VALUES (?, ?)", (user_id, mtime))
+            for user_id in set(known) - present:
+                for (path,) in self._db.execute("SELECT path FROM results WHERE user_id = ?", (user_id,)).fetchall():
+                    self._forget(path)
+                self._db.execute("DELETE FROM dirs WHERE user_id = ?", (user_id,))
+
+    def _forget(self, path):
+        self._db.execute("DELETE FROM results WHERE path = ?", (path,))
+        self._db.execute("DELETE FROM refs WHERE path = ?", (path,))
+
+    # --- Compaction ---
+
+    def _delete_result(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        self._forget(path)
+
+    def _collect_blobs(self):
+        """Delete blobs that no result references any more; returns the freed bytes"""
+        orphans = self._db.execute(
+            "SELECT digest, size FROM blobs WHERE digest NOT IN (SELECT digest FROM refs)").fetchall()
+        for digest, _ in orphans:
+            self.blob_store.delete(digest)
+            self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        return sum(size for _, size in orphans)
+
+    def _thumbnail_result(self, path):
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        replaced = {}
+        for digest in set(_manifest_digests(manifest, outputs_only=True)):
+            try:
+                data = make_thumbnail(self.blob_store.get(digest))
+            except (OSError, ValueError) as e:
+                print(f"Cannot thumbnail {digest}: {e}")
+                continue
+            replaced[digest] = self.blob_store.put(data)
+        manifest['output'] = replaced.get(manifest['output'], manifest['output'])
+        manifest['extra_outputs'] = {name: replaced.get(digest, digest)
+                                     for name, digest in manifest.get('extra_outputs', {}).items()}
+        manifest['thumbnail'] = True
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+        self._db.execute("DELETE FROM refs WHERE path = ?", (path,))
+        for digest in set(_manifest_digests(manifest)):
+            self._db.execute("INSERT INTO refs (path, digest) VALUES (?, ?)", (path, digest))
+            self._db.execute("INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)",
+                             (digest, self._blob_size(digest)))
+        self._db.execute("UPDATE results SET thumbnailed = 1 WHERE path = ?", (path,))
+
+    def total_bytes(self):
+        blobs = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        legacy = self._db.execute("SELECT COALESCE(SUM(legacy_size), 0) FROM results").fetchone()[0]
+        return blobs + legacy
+
+    def run(self, now=None):
+        """
+        Refresh the index and apply the policies once.
+
+        Returns a dict with the number of deleted and thumbnailed results and
+        the bytes in use afterwards.
+        """
+        now = now or time.time()
+        deleted = thumbnailed = 0
+        # Hold the blob store lock so no result is saved while blobs are collected
+        with self.blob_store.lock:
+            self.refresh()
+            with self._db:
+                if self.max_age_days is not None:
+                    cutoff = now - self.max_age_days * 86400
+                    for (path,) in self._db.execute("SELECT path FROM results WHERE created < ?",
+                                                    (cutoff,)).fetchall():
+                        self._delete_result(path)
+                        deleted += 1
+
+                if self.max_results_per_user is not None:
+                    for (user_id,) in self._db.execute("SELECT DISTINCT user_id FROM results").fetchall():
+                        old = self._db.execute(
+                            "SELECT path FROM results WHERE user_id = ? ORDER BY created DESC LIMIT -1 OFFSET ?",
+                            (user_id, self.max_results_per_user)).fetchall()
+                        for (path,) in old:
+                            self._delete_result(path)
+                            deleted += 1
+
+                if self.thumbnail_after_days is not None:
+                    cutoff = now - self.thumbnail_after_days * 86400
+                    for (path,) in self._db.execute(
+                            "SELECT path FROM results WHERE created < ? AND thumbnailed = 0 "
+                            "AND legacy_size IS NULL", (cutoff,)).fetchall():
+                        self._thumbnail_result(path)
+                        thumbnailed += 1
+
+                self._collect_blobs()
+
+                if self.max_total_mb is not None:
+                    budget = self.max_total_mb * 1024 * 1024
+                    oldest = self._db.execute("SELECT path FROM results ORDER BY created").fetchall()
+                    for (path,) in oldest:
+                        if self.total_bytes() <= budget:
+                            break
+                        self._delete_result(path)
+                        self._collect_blobs()
+                        deleted += 1
+
+        return {'deleted': deleted, 'thumbnailed': thumbnailed, 'bytes': self.total_bytes()}
+
+    def usage(self):
+        """
+        Per-user usage: {user_id: {'results': n, 'bytes': b}}. Blobs shared by
+        several results of a user count once; blobs shared between users
+        count for each of them.
+        """
+        with self.blob_store.lock:
+            self.refresh()
+        usage = {}
+        for user_id, results, legacy in self._db.execute(
+                "SELECT user_id, COUNT(*), COALESCE(SUM(legacy_size), 0) FROM results GROUP BY user_id"):
+            usage[user_id] = {'results': results, 'bytes': legacy}
+        for user_id, size in self._db.execute(
+                "SELECT user_id, SUM(size) FROM (SELECT DISTINCT results.user_id, blobs.digest, blobs.size "
+                "FROM results JOIN refs ON refs.path = results.path JOIN blobs ON blobs.digest = refs.digest) "
+                "GROUP BY user_id"):
+            usage[user_id]['bytes'] += size
+        return usage
+
+    # --- Background job ---
+
+    def _loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                print(f"Retention run: {self.run()}")
+            except Exception as e:
+                print(f"Retention run failed: {e}")
+
+    def start(self, interval=3600):
+        """Run the policies every `interval` seconds on a background thread"""
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name="retention", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default=USER_DATA_DIR)
+    parser.add_argument('--max-age-days', type=float)
+    parser.add_argument('--max-results', type=int)
+    parser.add_argument('--max-total-mb', type=float)
+    parser.add_argument('--thumbnail-after-days', type=float)
+    parser.add_argument('--stats', action='store_true', help="only print per-user usage")
+    args = parser.parse_args()
+
+    manager = RetentionManager(args.data_dir, max_age_days=args.max_age_days, max_results_per_user=args.max_results,
+                               max_total_mb=args.max_total_mb, thumbnail_after_days=args.thumbnail_after_days)
+    if not args.stats:
+        print(manager.run())
+    for user_id, stats in sorted(manager.usage().items()):
+        print(f"{user_id}: {stats['results']} results, {stats['bytes'] / 1024:.0f} KB")
+    manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,63 +1,347 @@
+import hashlib
 import json
 import os
+import queue
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime
 from io import BytesIO
 
 USER_DATA_FILE = "user_data/user_preferences.json"
+USER_DB_FILE = "user_data/user_preferences.db"
 USER_DATA_DIR = 'user_data'
+BLOB_DIR = os.path.join(USER_DATA_DIR, 'blobs')
 
 
-def load_user_data():
-    # Create directory if it doesn't exist
-    os.makedirs(os.path.dirname(USER_DATA_FILE), exist_ok=True)
+class StorageBackend(ABC):
+    """Persistent store of per-user settings dicts, keyed by user id."""
+    @abstractmethod
+    def get(self, user_id):
+        """Return the settings of a user or None."""
 
-    # Create file with empty dict if it doesn't exist
-    if not os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump({}, f)
+    @abstractmethod
+    def put_many(self, items):
+        """Store {user_id: settings} atomically."""
 
-    # Read and return the data
-    with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    @abstractmethod
+    def count(self):
+        """Return the number of stored users."""
 
+    def close(self):
+        pass
 
-def save_user_data(data):
-    with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
 
+class SQLiteBackend(StorageBackend):
+    """
+    Settings in an SQLite table with one JSON row per user.
+
+    The database runs in WAL mode, so a write touches only the changed rows
+    and an interrupted write leaves the previous state intact.
+    """
+    def __init__(self, path=USER_DB_FILE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, settings TEXT NOT NULL)")
+        self._conn.commit()
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute("SELECT settings FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_many(self, items):
+        rows = [(str(user_id), json.dumps(settings, ensure_ascii=False)) for user_id, settings in items.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO users (user_id, settings) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET settings = excluded.settings",
+                rows
+            )
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class UserStore:
+    """
+    Write-behind cache in front of a StorageBackend.
+
+    Settings are read from the backend once per user and then served from
+    memory. Updates are applied in memory and flushed to the backend in one
+    batch, at most `flush_interval` seconds later (immediately with 0), so a
+    crash loses at most that window of changes. Clean entries beyond
+    `max_cached` users are dropped least recently used first. Backend reads
+    happen outside the lock, so a miss never holds up other users.
+    """
+    def __init__(self, backend, flush_interval=1.0, max_cached=10000):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="user-store-flush", daemon=True)
+            self._flusher.start()
+
+    def get(self, user_id):
+        """Return a copy of the settings of a user ({} for unknown users)."""
+        uid = str(user_id)
+        with self._lock:
+            settings = self._cache.get(uid)
+            if settings is not None:
+                self._cache.move_to_end(uid)
+                return dict(settings)
+        loaded = self.backend.get(uid) or {}
+        with self._lock:
+            # An update made meanwhile is newer than what was read
+            settings = self._cache.setdefault(uid, loaded)
+            self._cache.move_to_end(uid)
+            self._evict()
+            return dict(settings)
+
+    def update(self, user_id, updates):
+        """Apply updates to the settings of a user."""
+        uid = str(user_id)
+        loaded = self.get(uid)
+        with self._lock:
+            settings = self._cache.get(uid, loaded)
+            self._cache[uid] = {**settings, **updates}
+            self._cache.move_to_end(uid)
+            self._dirty.add(uid)
+            self._evict()
+        if self._flusher is None:
+            self.flush()
+
+    def _evict(self):
+        for uid in list(self._cache):
+            if len(self._cache) <= self.max_cached:
+                break
+            if uid not in self._dirty:
+                del self._cache[uid]
+
+    def flush(self):
+        """Write all pending updates to the backend in one transaction."""
+        with self._lock:
+            items = {uid: dict(self._cache[uid]) for uid in self._dirty}
+            self._dirty.clear()
+            self._evict()
+        if not items:
+            return
+        try:
+            self.backend.put_many(items)
+        except Exception:
+            # Retry with the next flush, keeping newer values from the cache
+            with self._lock:
+                for uid, settings in items.items():
+                    self._cache.setdefault(uid, settings)
+                    self._dirty.add(uid)
+            raise
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush user settings: {e}")
+
+    def close(self):
+        """Flush pending updates and close the backend."""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self.backend.close()
+
+
+def migrate_json(json_path, backend):
+    """
+    One-time import of the legacy JSON settings file into an empty backend.
+    The file is renamed to <name>.migrated afterwards. Returns the number of
+    imported users.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    if backend.count() > 0:
+        print(f"Not migrating {json_path}: the user store is not empty")
+        return 0
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    backend.put_many(data)
+    os.replace(json_path, json_path + ".migrated")
+    print(f"Migrated {len(data)} users from {json_path}")
+    return len(data)
 
-def get_user_settings(user_data, user_id):
-    return user_data.get(str(user_id), {})
 
+def load_user_data(path=USER_DB_FILE, json_path=USER_DATA_FILE, flush_interval=1.0):
+    """Open the user settings store, migrating the legacy JSON file if present."""
+    backend = SQLiteBackend(path)
+    migrate_json(json_path, backend)
+    return UserStore(backend, flush_interval=flush_interval)
 
-def update_user_settings(user_data, user_id, updates: dict):
-    uid = str(user_id)
-    if uid not in user_data:
-        user_data[uid] = {}
-    user_data[uid].update(updates)
-    save_user_data(user_data)
 
+def get_user_settings(store, user_id):
+    return store.get(user_id)
 
-def save_user_images(user_id: str, content: bytes, style: bytes, output: BytesIO):
+
+def update_user_settings(store, user_id, updates: dict):
+    store.update(user_id, updates)
+
+
+class BlobStore:
+    """
+    Content-addressed store of image files: every distinct file is written
+    once under its SHA-256, e.g. blobs/ab/abcdef....jpg, so style presets
+    and repeated uploads are stored only once.
+
+    `lock` is held while a result is saved, so that compaction (see
+    utils.retention) never deletes a blob a new manifest is about to use.
+    """
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+        self.lock = threading.RLock()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], f"{digest}.jpg")
+
+    def put(self, data):
+        """Store data if it is not stored yet and return its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary name first so a crash never leaves a truncated blob
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+
+def save_user_images(user_id: str, content: bytes, style: bytes, output: bytes, extra_outputs: dict = None,
+                     blob_store: BlobStore = None, created: datetime = None):
     """
-    Saves content, style, and output images in a user-specific timestamped folder.
+    Saves content, style, and output images of one result.
+
+    The images go to the blob store and a manifest referencing them by
+    digest is written to user_data/<user_id>/result_<timestamp>.json.
+    Additional results (e.g. an alpha preview) are listed under
+    extra_outputs; the style is null when several styles were applied.
+    Images may be bytes or BytesIO buffers. Returns the manifest path.
     """
-    # Create user directory and timestamped subfolder
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    user_dir = os.path.join(USER_DATA_DIR, user_id, f"result_{timestamp}")
-    os.makedirs(user_dir, exist_ok=True)
+    blob_store = blob_store or BlobStore()
+    created = created or datetime.now()
+
+    def put(image):
+        if image is None:
+            return None
+        return blob_store.put(image.getvalue() if isinstance(image, BytesIO) else image)
+
+    user_dir = os.path.join(USER_DATA_DIR, str(user_id))
+    manifest_path = os.path.join(user_dir, f"result_{created.strftime('%Y-%m-%d_%H-%M-%S_%f')}.json")
+    with blob_store.lock:
+        manifest = {
+            'user_id': str(user_id),
+            'created': created.isoformat(),
+            'content': put(content),
+            'style': put(style),
+            'output': put(output),
+            'extra_outputs': {name: put(extra) for name, extra in (extra_outputs or {}).items()}
+        }
+        os.makedirs(user_dir, exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    print(f"Saved images for user {user_id} in {manifest_path}")
+    return manifest_path
+
+
+class ArtifactWriter:
+    """
+    Saves user images on a background thread, off the request path.
+
+    Jobs wait in a queue of at most `max_queue` entries; when it is full,
+    the result is not saved rather than delaying the reply to the user.
+    With `metrics` (a utils.metrics.Metrics), the time to save each result
+    is recorded.
+    """
+    def __init__(self, blob_store=None, max_queue=64, metrics=None):
+        self.blob_store = blob_store or BlobStore()
+        self.metrics = metrics
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, content, style, output, extra_outputs=None):
+        """Queue the images of one result for saving; returns False if the queue is full."""
+        # Copy the buffers now, they are read again when sent to the user
+        job = dict(
+            user_id=user_id,
+            content=content,
+            style=style,
+            output=output.getvalue(),
+            extra_outputs={name: extra.getvalue() for name, extra in (extra_outputs or {}).items()},
+            created=datetime.now()
+        )
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            print(f"Not saving images for user {user_id}: writer queue is full")
+            return False
 
-    # Save content image
-    with open(os.path.join(user_dir, "content.jpg"), "wb") as f:
-        f.write(content)
+    @property
+    def pending(self):
+        """Number of results waiting to be saved."""
+        return self._queue.qsize()
 
-    # Save style image
-    with open(os.path.join(user_dir, "style.jpg"), "wb") as f:
-        f.write(style)
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                started = time.perf_counter()
+                save_user_images(blob_store=self.blob_store, **job)
+                if self.metrics is not None:
+                    self.metrics.observe('artifact_save_seconds', time.perf_counter() - started,
+                                         help="Time to save the images of one result")
+            except Exception as e:
+                print(f"Failed to save images for user {job['user_id']}: {e}")
+            finally:
+                self._queue.task_done()
 
-    # Save output image
-    output_path = os.path.join(user_dir, "output.jpg")
-    with open(output_path, "wb") as f:
-        f.write(output.getbuffer())
+    def join(self):
+        """Wait until all queued jobs are written."""
+        self._queue.join()
 
-    print(f"Saved images for user {user_id} in {user_dir}")
+    def close(self):
+        """Write the queued jobs and stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,42 @@
+"""
+Convert the model_weights/*.pth checkpoints to .safetensors files.
+
+The converted files sit next to the originals and are preferred by
+utils.functional.load_weights. They are memory-mapped on load, so only the
+tensors actually used are read from disk and no unpickling is involved.
+
+Usage:
+    python -m utils.weights [--weights-dir model_weights]
+"""
+import argparse
+import glob
+import os
+
+import torch
+
+from utils.functional import WEIGHTS_DIR
+
+
+def convert_to_safetensors(path):
+    """Write `path` (a .pth state dict) as .safetensors next to it and return the new path"""
+    from safetensors.torch import save_file
+
+    state_dict = torch.load(path, map_location='cpu', weights_only=True)
+    # safetensors does not store shared or non-contiguous views
+    state_dict = {key: value.contiguous().clone() for key, value in state_dict.items()}
+    output = os.path.splitext(path)[0] + '.safetensors'
+    save_file(state_dict, output)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights-dir', default=WEIGHTS_DIR)
+    args = parser.parse_args()
+
+    for path in sorted(glob.glob(os.path.join(args.weights_dir, '*.pth'))):
+        print(convert_to_safetensors(path))
+
+
+if __name__ == '__main__':
+    main()